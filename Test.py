@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# Test.py
+# Checks of the King & Assassins engines (run with: python3 -m unittest Test)
+
+import contextlib
+import io
+import json
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+
+import kingandassassins_Original as kingandassassins
+from benchmark import ACTIONS, fixture
+from lib import game, latency, replay
+
+ENGINES = (kingandassassins.KingAndAssassinsState, kingandassassins.BitboardKingAndAssassinsState)
+
+
+class ApplyUndoTest(unittest.TestCase):
+    '''Taking an action back must give the state before it, whatever was read in between.'''
+
+    def roundtrip(self, stateclass, read):
+        for name, player, action in ACTIONS:
+            with self.subTest(engine=stateclass.__name__, action=name):
+                state = fixture(stateclass)
+                # The butcher, next to the knight on (2, 4), is an assassin to arrest
+                state.setassassins({'butcher', 'monk', 'shepherd'})
+                fresh = state.copy()
+                record = state.apply(action, player)
+                read(state)
+                state.undo(record)
+                self.assertEqual(str(state), str(fresh))
+                self.assertEqual(state.zobrist(), fresh.zobrist())
+                self.assertEqual(state.assassinsleft(), fresh.assassinsleft())
+                self.assertEqual(state.winner(), fresh.winner())
+                self.assertEqual(state.position('butcher'), fresh.position('butcher'))
+
+    def test_untouched(self):
+        for stateclass in ENGINES:
+            self.roundtrip(stateclass, lambda state: None)
+
+    def test_winner(self):
+        for stateclass in ENGINES:
+            self.roundtrip(stateclass, lambda state: state.winner())
+
+    def test_assassinsleft(self):
+        for stateclass in ENGINES:
+            self.roundtrip(stateclass, lambda state: state.assassinsleft())
+
+
+class BoardEdgeTest(unittest.TestCase):
+    '''Both engines must reject the actions leaving the board or starting outside of it.'''
+
+    MOVES = (
+        (1, ('move', 9, 9, 'S')),
+        (1, ('move', 9, 9, 'E')),
+        (1, ('move', 5, 0, 'W')),
+        (1, ('arrest', 5, 0, 'W')),
+        (1, ('move', -1, 9, 'S')),
+        (1, ('move', 0, 19, 'S')),
+        (0, ('attack', -1, 8, 'E')),
+        (0, ('reveal', -7, 6))
+    )
+
+    def test_outside(self):
+        for stateclass in ENGINES:
+            for player, action in self.MOVES:
+                with self.subTest(engine=stateclass.__name__, action=action):
+                    state = fixture(stateclass)
+                    fresh = state.copy()
+                    with self.assertRaises(kingandassassins.game.InvalidMoveException):
+                        state.update([action], player)
+                    self.assertEqual(str(state), str(fresh))
+
+
+class DeltaCodecTest(unittest.TestCase):
+    '''Binary deltas must decode to the changes that were encoded.'''
+
+    def test_roundtrip(self):
+        stateclass = kingandassassins.KingAndAssassinsState
+        for delta in ({}, {'people': [[1, 2, 'knight'], [3, 4, None], [9, 9, 'monk']]},
+                      {'card': [1, 6, True, 5], 'king': 'injured', 'arrested': ['monk', 'butcher'],
+                       'killed': {'knights': 1, 'assassins': 2}}, {'card': None}):
+            with self.subTest(delta=delta):
+                self.assertEqual(stateclass.decodedelta(stateclass.encodedelta(delta)), delta)
+
+
+class BinaryCodecTest(unittest.TestCase):
+    '''States and moves must decode to what was encoded, in far fewer bytes than JSON.'''
+
+    MOVES = (
+        {'assassins': ['monk', 'butcher', 'farmer']},
+        {'actions': []},
+        {'actions': [['move', 7, 8, 'N'], ['arrest', 2, 4, 'W'], ['kill', 3, 3, 'S'], ['attack', 0, 9, 'E'], ['reveal', 9, 0]]}
+    )
+
+    def test_state(self):
+        for stateclass in ENGINES:
+            with self.subTest(engine=stateclass.__name__):
+                state = fixture(stateclass)
+                state._state['visible']['arrested'] = ['monk']
+                state._state['visible']['lastopponentmove'] = [['move', 1, 2, 'E'], ['reveal', 3, 4]]
+                data = state.encode()
+                self.assertEqual(str(stateclass.decode(data)), str(state))
+                # Twice, the second time with the board already decoded
+                self.assertEqual(str(stateclass.decode(data)), str(state))
+                self.assertLess(len(data), len(str(state)) // 10)
+
+    def test_move(self):
+        stateclass = kingandassassins.KingAndAssassinsState
+        for move in self.MOVES:
+            with self.subTest(move=move):
+                data = stateclass.encodemove(move)
+                self.assertEqual(stateclass.decodemove(data), move)
+                self.assertEqual(stateclass.encodemove(json.dumps(move)), data)
+                self.assertEqual(len(data), 2 + len(move.get('assassins', [])) + 2 * len(move.get('actions', [])))
+
+
+def frame(message):
+    # Message as sent on a framed connection
+    return struct.pack('!I', len(message)) + message
+
+
+def scripted(options, received):
+    # Client asking for 'options', keeping the messages received up to its first state
+    def client(channel):
+        server = game.Connection(channel, kingandassassins.KingAndAssassinsState.buffersize())
+        server.recv()
+        server.send(' '.join(['READY', 'scripted'] + options))
+        server.requestframing()
+        while not received or not received[-1].startswith(b'PLAY'):
+            received.append(server.recvbytes())
+        received.append(server.framed)
+        server.close()
+    return client
+
+
+class FramingTest(unittest.TestCase):
+    '''Framed messages must be read whole, however they are split, once framing is negotiated.'''
+
+    def test_frames(self):
+        mine, theirs = socket.socketpair()
+        with mine, theirs:
+            connection = game.Connection(theirs, buffersize=16)
+            connection.requestframing()
+            # The first frames come with 'FRAMED', a large one is read over several recv
+            mine.sendall(b'FRAMED' + frame(b'one') + frame(b'two'))
+            mine.sendall(frame(b'x' * 1000) + frame(b'') + frame(b'three')[:5])
+            mine.sendall(frame(b'three')[5:])
+            for message in (b'one', b'two', b'x' * 1000, b'', b'three'):
+                self.assertEqual(connection.recvbytes(), message)
+            self.assertTrue(connection.framed)
+            mine.close()
+            with self.assertRaises(ConnectionError):
+                connection.recvbytes()
+
+    def test_unframed(self):
+        mine, theirs = socket.socketpair()
+        with mine, theirs:
+            connection = game.Connection(theirs)
+            connection.requestframing()
+            mine.sendall(b'START 0')
+            self.assertEqual(connection.recv(), 'START 0')
+            self.assertFalse(connection.framed)
+
+    def test_options(self):
+        self.assertEqual(game._parseready('READY bob +framed +delta'), (True, 'bob', ['+framed', '+delta']))
+        self.assertEqual(game._parseready('READY'), (True, 'Anonymous', []))
+        self.assertFalse(game._parseready('NOTREADY bob')[0])
+
+    def negotiate(self, options):
+        # Messages received by a client asking for 'options', up to its first state
+        received = []
+        clients = [scripted(options, received),
+                   lambda channel: kingandassassins.RandomKingAndAssassinsClient('random', channel, seed=1)]
+        server = kingandassassins.KingAndAssassinsServer(seed=1)
+        with contextlib.redirect_stdout(io.StringIO()), self.assertRaises(ConnectionError):
+            server.runconnected(clients, game.PairTransport('socketpair'))
+        return received
+
+    def test_negotiation(self):
+        *messages, play, framed = self.negotiate([game.FRAMED_OPTION, game.BINARY_OPTION, game.DELTA_OPTION])
+        self.assertTrue(framed)
+        self.assertEqual(messages, [b'BINARY'])
+        state = kingandassassins.KingAndAssassinsState.decode(play[len(b'PLAY '):])
+        self.assertIsNone(state._state['visible']['card'])
+
+    def test_binary_needs_framing(self):
+        *messages, play, framed = self.negotiate([game.BINARY_OPTION])
+        self.assertFalse(framed)
+        self.assertEqual(messages, [])
+        state = kingandassassins.KingAndAssassinsState.parse(play[len(b'PLAY '):].decode())
+        self.assertIsNone(state._state['visible']['card'])
+
+
+class PairTransportTest(unittest.TestCase):
+    '''A game between clients of the same process must be the one played in-process.'''
+
+    def test_game(self):
+        local = kingandassassins.KingAndAssassinsServer(seed=3)
+        winner = local.runlocal([kingandassassins.RandomKingAndAssassinsClient(str(i), None, seed=i) for i in range(2)])[0]
+        for kind in ('queue', 'socketpair'):
+            with self.subTest(kind=kind):
+                clients = []
+
+                def client(channel, i):
+                    clients.append(kingandassassins.RandomKingAndAssassinsClient(str(i), channel, seed=i))
+
+                server = kingandassassins.KingAndAssassinsServer(seed=3)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    result = server.runconnected([lambda channel, i=i: client(channel, i) for i in range(2)],
+                                                 game.PairTransport(kind))
+                self.assertEqual(result, winner)
+                self.assertEqual(server.turns, local.turns)
+                self.assertEqual(str(server._state), str(local._state))
+                self.assertEqual([c.played for c in clients], [1, 1])
+
+    def test_kind(self):
+        with self.assertRaises(ValueError):
+            game.PairTransport('pipe')
+
+
+def quitter(channel):
+    # Client answering the handshake, then leaving on its first turn
+    server = game.Connection(channel)
+    server.recv()
+    server.send('READY quitter')
+    server.recv()
+    server.close()
+
+
+class DisconnectTest(unittest.TestCase):
+    '''A player leaving in the middle of a game must not leave the other one waiting.'''
+
+    def test_quitter(self):
+        for kind in ('queue', 'socketpair'):
+            with self.subTest(kind=kind):
+                server = kingandassassins.KingAndAssassinsServer(seed=1)
+                threads = threading.active_count()
+                start = time.perf_counter()
+                clients = [lambda channel: kingandassassins.RandomKingAndAssassinsClient('random', channel, seed=1),
+                           quitter]
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output), self.assertRaises(ConnectionError):
+                    server.runconnected(clients, game.PairTransport(kind))
+                self.assertLess(time.perf_counter() - start, game.CLIENT_TIMEOUT)
+                self.assertEqual(threading.active_count(), threads)
+                # The client that stayed was connected, and saw the game end
+                self.assertIn('Connection lost', output.getvalue())
+                self.assertNotIn('Impossible to connect', output.getvalue())
+
+
+
+class HistogramTest(unittest.TestCase):
+    '''Durations must be counted in power-of-two buckets, with percentiles as upper bounds.'''
+
+    def test_buckets(self):
+        histogram = latency.Histogram()
+        for ns in (0, 1, 2, 3, 4, 1000, 2 ** 70):
+            histogram.add(ns)
+        self.assertEqual({b: n for b, n in enumerate(histogram.buckets) if n > 0}, {0: 1, 1: 1, 2: 2, 3: 1, 10: 1, 64: 1})
+        self.assertEqual((histogram.count, histogram.min, histogram.max), (7, 0, 2 ** 70))
+
+    def test_percentile(self):
+        histogram = latency.Histogram()
+        self.assertIsNone(histogram.percentile(50))
+        for ns in (5, 6, 7, 100):
+            histogram.add(ns)
+        self.assertEqual(histogram.percentile(50), 7)
+        self.assertEqual(histogram.percentile(100), 100)
+
+    def test_merge(self):
+        first, second = latency.Histogram(), latency.Histogram()
+        first.add(3)
+        second.add(1000)
+        first.merge(second)
+        first.merge(latency.Histogram())
+        self.assertEqual((first.count, first.total, first.min, first.max), (2, 1003, 3, 1000))
+        self.assertEqual(first.snapshot()['buckets'], {2: 1, 10: 1})
+
+    def test_turns(self):
+        events = []
+        timing = latency.Latency(events.append)
+        timing.startgame()
+        timing.lap('send')
+        timing.begin(1)
+        timing.lap('send')
+        timing.lap('wait')
+        timing.end()
+        timing.endgame(winner=1)
+        turn, end = events
+        self.assertEqual((turn['event'], turn['player'], sorted(turn['phases'])), ('turn', 1, ['send', 'wait']))
+        self.assertEqual((end['event'], end['turns'], end['winner']), ('game', 1, 1))
+        self.assertEqual(end['phases']['wait']['count'], 1)
+
+
+class ReplayFileTest(unittest.TestCase):
+    '''Recorded games must be read back as written, whatever the blocks, codecs and index.'''
+
+    GAMES = [(b'header %d' % n, [(n % 2, b'move %d' % i) for i in range(n)], b'summary' * (n % 3)) for n in range(7)]
+
+    def write(self, path, compression):
+        with replay.ReplayWriter(path, batch=3, compression=compression) as recorder:
+            for game in self.GAMES:
+                recorder.append(*game)
+
+    def test_roundtrip(self):
+        for compression in replay.CODECS:
+            with self.subTest(compression=compression), tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'games.rpl')
+                self.write(path, compression)
+                reader = replay.ReplayReader(path)
+                self.assertEqual(len(reader), len(self.GAMES))
+                self.assertEqual(list(reader), self.GAMES)
+                self.assertEqual(reader[4], self.GAMES[4])
+                self.assertEqual(reader[-1], self.GAMES[-1])
+                with self.assertRaises(IndexError):
+                    reader[len(self.GAMES)]
+
+    def test_without_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'games.rpl')
+            self.write(path, 'zlib')
+            os.remove(path + '.idx')
+            self.assertEqual(list(replay.ReplayReader(path)), self.GAMES)
+            # A block written partially, at the end of the file, is ignored
+            with open(path, 'ab') as file:
+                file.write(replay.BLOCK.pack(replay.MAGIC, 0, 1, 10, 10) + b'trunc')
+            self.assertEqual(list(replay.ReplayReader(path)), self.GAMES)
+
+    def test_nosummary(self):
+        # Blocks written before the games had a summary
+        header, turns = b'header', [(0, b'move'), (1, b'')]
+        raw = replay.GAME_NOSUMMARY.pack(len(header), len(turns)) + header
+        raw += b''.join(replay.TURN.pack(player, len(move)) + move for player, move in turns)
+        data = zlib.compress(raw)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'games.rpl')
+            with open(path, 'wb') as file:
+                file.write(replay.BLOCK.pack(replay.MAGIC_NOSUMMARY, replay.CODECS['zlib'], 1, len(raw), len(data)) + data)
+            self.assertEqual(list(replay.ReplayReader(path)), [(header, turns, b'')])
+
+
+def stubborn(state):
+    # Client choosing its assassins, then always trying the same invalid move
+    if state._state['visible']['card'] is None:
+        return json.dumps({'assassins': ['monk', 'butcher', 'farmer']})
+    return json.dumps({'actions': [['move', 0, 0, 'N']]})
+
+
+class ReplayResultTest(unittest.TestCase):
+    '''A recorded game must be read back with its winner, also when it ended by forfeit.'''
+
+    def test_forfeit(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'games.rpl')
+            with replay.ReplayWriter(path) as recorder, contextlib.redirect_stdout(io.StringIO()):
+                server = kingandassassins.KingAndAssassinsServer(seed=1, recorder=recorder)
+                server.runlocal([stubborn, kingandassassins.RandomKingAndAssassinsClient('random', None, seed=1)])
+            self.assertEqual((server.winner, server.forfeited), (1, 0))
+            (header, turns, summary), = replay.ReplayReader(path)
+            replayed = kingandassassins.KingAndAssassinsServer.fromreplay(header, turns, summary)
+            self.assertEqual((replayed.winner, replayed.forfeited), (1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# analytics.py
+# Columnar statistics over recorded King & Assassins games (see lib/replay.py)
+# Unlike the rest of the project, which only uses the standard library, this module
+# needs NumPy 1.15 or later (pip install numpy).
+
+import argparse
+import json
+import os
+from multiprocessing import Pool
+
+try:
+    import numpy as np
+except ImportError as e:
+    raise ImportError('analytics.py needs NumPy, which can be installed with: pip install numpy') from e
+
+import kingandassassins_Original as kingandassassins
+from kingandassassins_Original import CARDS, PIECES, PIECE_CODES, VILLAGERS, BitboardKingAndAssassinsState
+from lib import replay
+
+# Columns with one row per game, as (name, dtype, shape of a row)
+COLUMNS = (
+    ('winner', np.int8, ()),
+    ('forfeited', np.int8, ()),
+    ('turns', np.int16, ()),
+    ('assassins', np.uint8, (3,)),
+    ('assassincells', np.uint8, (3,)),
+    ('cards', np.uint8, (len(CARDS),)),
+    ('killedknights', np.uint8, ()),
+    ('killedassassins', np.uint8, ()),
+    ('arrested', np.uint8, ()),
+    ('arrestedassassins', np.uint8, ())
+)
+# Index of each card of CARDS among the distinct cards, sorted
+CARD_TYPES = tuple(sorted(set(CARDS)))
+CARD_TYPE_OF = np.array([CARD_TYPES.index(card) for card in CARDS], dtype=np.uint8)
+
+
+def gamerow(header, turns, summary=b''):
+    '''Return the values of the columns for one recorded game.
+    Pre: 'header', 'turns' and 'summary' are a game read from a replay file.
+    Post: The returned value is a pair: a dictionary with one value per column of
+          COLUMNS, and the list of the cells (10 * x + y) of the king after each of
+          its turns, starting with its initial cell. The game is only replayed when
+          it was recorded without summary.
+    '''
+    server = kingandassassins.KingAndAssassinsServer
+    content = server.readreplayheader(header)
+    if len(summary) == 0:
+        summary = server.fromreplay(header, turns, stateclass=BitboardKingAndAssassinsState).replaysummary()
+    result = server.readreplaysummary(summary)
+    cells = {name: 10 * x + y for name, (x, y) in zip(content['layout'], sorted(VILLAGERS))}
+    assassins = content['assassins'] or []
+    row = {
+        'winner': -1 if result['winner'] is None else result['winner'],
+        'forfeited': -1 if result['forfeited'] is None else result['forfeited'],
+        'turns': result['turns'],
+        'assassins': [PIECE_CODES[p] for p in assassins] + [0] * (3 - len(assassins)),
+        'assassincells': [cells[p] for p in assassins] + [255] * (3 - len(assassins)),
+        # In the order they are drawn, the last card of the list first
+        'cards': [CARDS.index(card) for card in reversed(content['cards'])],
+        'killedknights': result['killedknights'],
+        'killedassassins': result['killedassassins'],
+        'arrested': result['arrested'],
+        'arrestedassassins': result['arrestedassassins']
+    }
+    return row, result['kingpath']
+
+
+def _readfile(path):
+    # Columns of the games of one replay file, built in a worker process
+    rows, kingpath, lengths = [], [], []
+    for header, turns, summary in replay.ReplayReader(path):
+        row, cells = gamerow(header, turns, summary)
+        rows.append(row)
+        kingpath.extend(cells)
+        lengths.append(len(cells))
+    columns = {name: np.array([row[name] for row in rows], dtype=dtype).reshape((len(rows),) + shape)
+               for name, dtype, shape in COLUMNS}
+    return columns, np.array(kingpath, dtype=np.uint8), np.array(lengths, dtype=np.int64)
+
+
+def buildcolumns(paths, directory, processes=None):
+    '''Write the columns of the games of replay files to a directory.
+    Pre: 'paths' is a list of replay files and 'directory' an existing directory.
+    Post: The directory contains one .npy file per column of COLUMNS, plus 'kingpath'
+          (the cells of the king after each of its turns, all games one after the
+          other) and 'kingpathoffsets' (where the path of game i starts, and ends
+          for i + 1). The returned value is the number of games.
+    '''
+    total = sum(len(replay.ReplayReader(path)) for path in paths)
+    columns = {
+        name: np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+', dtype=dtype, shape=(total,) + shape)
+        for name, dtype, shape in COLUMNS
+    }
+    kingpaths, lengths = [], []
+    i = 0
+    with Pool(processes) as pool:
+        for chunk, kingpath, chunklengths in pool.imap(_readfile, paths):
+            n = len(chunklengths)
+            for name, column in columns.items():
+                column[i:i + n] = chunk[name]
+            kingpaths.append(kingpath)
+            lengths.append(chunklengths)
+            i += n
+    for column in columns.values():
+        column.flush()
+    offsets = np.concatenate(([0], np.cumsum(np.concatenate(lengths)) if lengths else [])).astype(np.int64)
+    np.save(os.path.join(directory, 'kingpath.npy'), np.concatenate(kingpaths) if kingpaths else np.zeros(0, np.uint8))
+    np.save(os.path.join(directory, 'kingpathoffsets.npy'), offsets)
+    return total
+
+
+def loadcolumns(directory):
+    '''Return the columns written by buildcolumns, memory-mapped read-only, in a dictionary.'''
+    names = [name for name, dtype, shape in COLUMNS] + ['kingpath', 'kingpathoffsets']
+    return {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in names}
+
+
+def _winrate(keys, wins, size):
+    # Games and king's wins for each value of 'keys', between 0 and size - 1
+    games = np.bincount(keys, minlength=size)
+    won = np.bincount(keys, weights=wins.astype(np.float64), minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return games, won / games
+
+
+def winratebycell(columns):
+    '''Return, for each cell, the number of games with an assassin starting on it and the king's win rate.'''
+    cells = np.asarray(columns['assassincells']).ravel()
+    wins = np.repeat(np.asarray(columns['winner']) == 1, 3)
+    known = cells != 255
+    return _winrate(cells[known], wins[known], 100)
+
+
+def winratebyfirstcard(columns):
+    '''Return, for each card of CARD_TYPES, the number of games starting with it and the king's win rate.'''
+    first = CARD_TYPE_OF[np.asarray(columns['cards'][:, 0])]
+    return _winrate(first, np.asarray(columns['winner']) == 1, len(CARD_TYPES))
+
+
+def winratebyturns(columns):
+    '''Return, for each number of turns, the number of games of that length and the king's win rate.'''
+    turns = np.asarray(columns['turns']).astype(np.intp)
+    return _winrate(turns, np.asarray(columns['winner']) == 1, int(turns.max(initial=0)) + 1)
+
+
+def winratebytriple(columns):
+    '''Return the (assassins' codes, games, king's win rate) of each assassin triple played, sorted by codes.'''
+    triples = np.sort(np.asarray(columns['assassins']), axis=1)
+    keys = (triples[:, 0].astype(np.int64) * len(PIECES) + triples[:, 1]) * len(PIECES) + triples[:, 2]
+    unique, inverse = np.unique(keys, return_inverse=True)
+    games, rates = _winrate(inverse, np.asarray(columns['winner']) == 1, len(unique))
+    codes = np.stack((unique // len(PIECES) ** 2, unique // len(PIECES) % len(PIECES), unique % len(PIECES)), axis=1)
+    return codes, games, rates
+
+
+def summary(columns):
+    '''Return the main aggregates of the columns, as a JSON-serialisable dictionary.'''
+    winner = np.asarray(columns['winner'])
+    cells, cellrates = winratebycell(columns)
+    cards, cardrates = winratebyfirstcard(columns)
+    return {
+        'games': int(len(winner)),
+        'king': int(np.count_nonzero(winner == 1)),
+        'assassins': int(np.count_nonzero(winner == 0)),
+        'draws': int(np.count_nonzero(winner == -1)),
+        'forfeits': int(np.count_nonzero(np.asarray(columns['forfeited']) != -1)),
+        'turns': float(np.mean(columns['turns'])) if len(winner) > 0 else 0.0,
+        'killedknights': float(np.mean(columns['killedknights'])) if len(winner) > 0 else 0.0,
+        'arrested': float(np.mean(columns['arrested'])) if len(winner) > 0 else 0.0,
+        'bycell': {'{},{}'.format(i // 10, i % 10): [int(cells[i]), float(cellrates[i])] for i in np.flatnonzero(cells)},
+        'byfirstcard': {str(CARD_TYPES[i]): [int(cards[i]), float(cardrates[i])] for i in np.flatnonzero(cards)}
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='King & Assassins replay analytics')
+    subparsers = parser.add_subparsers(dest='command')
+    build_parser = subparsers.add_parser('build', help='write the columns of replay files')
+    build_parser.add_argument('replays', nargs='+', help='replay files')
+    build_parser.add_argument('-o', '--output', required=True, help='directory of the columns')
+    build_parser.add_argument('-j', '--processes', type=int, help='worker processes (default: one per CPU)')
+    report_parser = subparsers.add_parser('report', help='print the aggregates of columns')
+    report_parser.add_argument('directory', help='directory of the columns')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        os.makedirs(args.output, exist_ok=True)
+        print('{} games'.format(buildcolumns(args.replays, args.output, args.processes)))
+    elif args.command == 'report':
+        print(json.dumps(summary(loadcolumns(args.directory)), indent=2))
+    else:
+        parser.print_help()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# assassinchoice.py
+# Finds the best start cells for the assassins by simulating games on all the cores
+
+import argparse
+import inspect
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import zlib
+
+import kingandassassins_Original as kingandassassins
+from kingandassassins_Original import BOARD, KNIGHTS, VILLAGERS
+from tournament import loadclass
+
+DEFAULT_BOT = 'kingandassassins_Original:RandomKingAndAssassinsClient'
+DEFAULT_STATE = 'kingandassassins_Original:BitboardKingAndAssassinsState'
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assassinchoice.json')
+# All the triples of villagers' start cells
+TRIPLES = tuple(itertools.combinations(sorted(VILLAGERS), 3))
+
+# Results of the cache files and keys of the bots, computed once per process
+_cache = {}
+_keys = {}
+
+
+def botversion(spec):
+    '''Return the version of a bot: a checksum of the source of the module defining it.'''
+    return zlib.crc32(inspect.getsource(inspect.getmodule(loadclass(spec))).encode())
+
+
+def cachekey(kingbot=DEFAULT_BOT, assassinsbot=DEFAULT_BOT):
+    '''Return the key of the results for the board layout and the versions of both bots.'''
+    if (kingbot, assassinsbot) not in _keys:
+        layout = [BOARD, sorted(KNIGHTS), sorted(VILLAGERS)]
+        bots = [[spec, botversion(spec)] for spec in (kingbot, assassinsbot)]
+        _keys[kingbot, assassinsbot] = '{:08x}'.format(zlib.crc32(json.dumps([layout, bots]).encode()))
+    return _keys[kingbot, assassinsbot]
+
+
+def _fixedassassins(cls, cells):
+    # Subclass of a bot always choosing the villagers starting on 'cells' as assassins
+    class FixedAssassinsClient(cls):
+        def chooseassassins(self, state):
+            people = state._state['visible']['people']
+            return [people[x][y] for x, y in cells]
+    return FixedAssassinsClient
+
+
+def _newbot(cls, spec, seed):
+    # Bots accepting a seed are seeded, to replay the same game
+    if 'seed' in inspect.signature(cls).parameters:
+        return cls(spec, None, seed=seed)
+    return cls(spec, None)
+
+
+def playgame(task):
+    '''Play one game in this process.
+    Pre: 'task' is a tuple (triple, seed, kingbot, assassinsbot, stateclass) where 'triple'
+         is an index in TRIPLES and the others are 'module:Class' specifications.
+    Post: The returned value is the tuple (triple, winner, assassins left at the end).
+    '''
+    triple, seed, kingbot, assassinsbot, stateclass = task
+    random.seed(seed)
+    server = kingandassassins.KingAndAssassinsServer(stateclass=loadclass(stateclass), seed=seed)
+    assassins = _newbot(_fixedassassins(loadclass(assassinsbot), TRIPLES[triple]), assassinsbot, seed)
+    king = _newbot(loadclass(kingbot), kingbot, seed + 1)
+    winner, turns, moves = server.runlocal([assassins, king])
+    return triple, winner, server._state.assassinsleft()
+
+
+def evaluate(games=20, seed=0, kingbot=DEFAULT_BOT, assassinsbot=DEFAULT_BOT, stateclass=DEFAULT_STATE, processes=None):
+    '''Simulate games for every triple of TRIPLES on a pool of processes.
+    Pre: 'games' > 0.
+    Post: The returned value is a list with, for each triple, the list [cells, games, wins,
+          survivors] where 'wins' counts the games won by the assassins and 'survivors'
+          the assassins neither killed nor arrested at the end of all the games. All the
+          triples are played with the same seeds, drawn from 'seed', so that they face
+          the same games.
+    '''
+    rng = random.Random(seed)
+    seeds = [rng.getrandbits(32) for i in range(games)]
+    tasks = [(triple, s, kingbot, assassinsbot, stateclass) for triple in range(len(TRIPLES)) for s in seeds]
+    wins = [0] * len(TRIPLES)
+    survivors = [0] * len(TRIPLES)
+    with multiprocessing.Pool(processes) as pool:
+        for triple, winner, left in pool.imap_unordered(playgame, tasks, chunksize=8):
+            if winner == 0:
+                wins[triple] += 1
+            survivors[triple] += left
+    return [[[list(cell) for cell in cells], games, wins[i], survivors[i]] for i, cells in enumerate(TRIPLES)]
+
+
+def score(result):
+    '''Return the sort key of a triple's result: its win rate, then its survivors per game.'''
+    cells, games, wins, survivors = result
+    return wins / games, survivors / games
+
+
+def loadresults(key, cachefile=CACHE_FILE):
+    '''Return the results cached under 'key', as returned by evaluate(), or None.'''
+    if cachefile not in _cache:
+        try:
+            with open(cachefile) as file:
+                _cache[cachefile] = json.load(file)
+        except (OSError, ValueError):
+            _cache[cachefile] = {}
+    return _cache[cachefile].get(key)
+
+
+def saveresults(key, results, cachefile=CACHE_FILE):
+    '''Store results returned by evaluate() under 'key' in the cache file.'''
+    loadresults(key, cachefile)
+    _cache[cachefile][key] = results
+    with open(cachefile, 'w') as file:
+        json.dump(_cache[cachefile], file, separators=(',', ':'))
+
+
+def besttriple(state, key=None, cachefile=CACHE_FILE):
+    '''Return the names of the villagers to choose as assassins, or None.
+    Pre: 'state' is the initial state of a game.
+    Post: The returned villagers start on the cells of the best triple, according to
+          score(), in the cached results for 'key' (by default the one of the board
+          layout and the default bots), None if there are no such results.
+    '''
+    results = loadresults(cachekey() if key is None else key, cachefile)
+    if not results:
+        return None
+    cells = max(results, key=score)[0]
+    people = state._state['visible']['people']
+    return [people[x][y] for x, y in cells]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='King & Assassins assassins\' start cells optimiser')
+    parser.add_argument('-n', '--games', type=int, help='games per triple (default: 20)', default=20)
+    parser.add_argument('--seed', type=int, help='seed of the games (default: 0)', default=0)
+    parser.add_argument('-j', '--processes', type=int, help='number of processes (default: all cores)')
+    parser.add_argument('--king', help='king\'s bot as module:Class', default=DEFAULT_BOT)
+    parser.add_argument('--assassins', help='assassins\' bot as module:Class', default=DEFAULT_BOT)
+    parser.add_argument('--state', help='state engine as module:Class', default=DEFAULT_STATE)
+    parser.add_argument('--cache', help='cache file (default: {})'.format(CACHE_FILE), default=CACHE_FILE)
+    parser.add_argument('--top', type=int, help='number of triples printed (default: 10)', default=10)
+    args = parser.parse_args()
+
+    key = cachekey(args.king, args.assassins)
+    results = loadresults(key, args.cache)
+    if results is None or results[0][1] < args.games:
+        results = evaluate(args.games, args.seed, args.king, args.assassins, args.state, args.processes)
+        saveresults(key, results, args.cache)
+    for cells, games, wins, survivors in sorted(results, key=score, reverse=True)[:args.top]:
+        print('{}: {}/{} won ({:.0%}), {:.2f} assassins left per game'.format(
+            ' '.join('({},{})'.format(*cell) for cell in cells), wins, games, wins / games, survivors / games))
@@ -0,0 +1,129 @@
+# belief.py
+# Probabilities of the hidden assassins, as seen from the king's side
+
+import bisect
+import itertools
+
+from kingandassassins_Original import POPULATION, distance
+
+NAMES = tuple(sorted(POPULATION))
+# All the possible triples of assassins, as sorted tuples of names
+TRIPLES = tuple(itertools.combinations(NAMES, 3))
+# Indices in TRIPLES of the triples containing each villager, and of the other ones
+CONTAINING = {name: tuple(i for i, t in enumerate(TRIPLES) if name in t) for name in NAMES}
+NOT_CONTAINING = {name: tuple(i for i, t in enumerate(TRIPLES) if name not in t) for name in NAMES}
+# Likelihood ratio, for a villager moved closer to the king, of being an assassin rather than not
+APPROACH = 1.3
+
+
+class AssassinBelief:
+    '''Class representing the probability of each triple of TRIPLES being the assassins.
+
+    The weights of the triples are updated from what the king's side sees between two
+    of its turns, each piece of evidence only touching the triples it is about:
+    - a villager that left the board without being arrested has been revealed, so the
+      triples without it are impossible;
+    - the game going on after arrests rules out the triples whose assassins would all
+      be arrested or killed;
+    - a villager moved closer to the king multiplies the weight of the triples with it
+      by 'approach'.
+    The marginals and the table used to sample are only rebuilt when read after a change.
+    '''
+    def __init__(self, prior=None, approach=APPROACH):
+        self.approach = approach
+        self.__prior = prior
+        self.reset()
+
+    def reset(self):
+        '''Forget all the evidence, going back to the prior (uniform by default).
+        Pre: The prior, if any, is a dictionary mapping triples of TRIPLES to weights.
+        '''
+        prior = self.__prior
+        self.__weights = [1.0] * len(TRIPLES) if prior is None else [float(prior.get(t, 0.0)) for t in TRIPLES]
+        self.__revealed = set()
+        self.__positions = None
+        self.__king = None
+        self.__neutralised = (0, 0)
+        self.__marginals = None
+        self.__cumulative = None
+
+    @property
+    def revealed(self):
+        return frozenset(self.__revealed)
+
+    def _scale(self, indices, factor):
+        weights = self.__weights
+        for i in indices:
+            weights[i] *= factor
+        self.__marginals = None
+        self.__cumulative = None
+
+    def observe(self, state):
+        '''Update the probabilities with what happened since the last state seen.
+        Pre: 'state' is a KingAndAssassinsState (either engine) at the start of a turn of
+             the king's side, and played() has been given the state at the end of its
+             previous turn, if any, so that the changes are the assassins' side ones.
+        '''
+        visible = state._state['visible']
+        positions = {name: state.position(name) for name in NAMES}
+        king = state.position('king')
+        arrested = set(visible['arrested'])
+        for name in NAMES:
+            if positions[name] is None and name not in arrested and name not in self.__revealed:
+                self.__revealed.add(name)
+                self._scale(NOT_CONTAINING[name], 0.0)
+        previous, before = self.__positions, self.__king
+        if previous is not None and before is not None and king is not None:
+            for name in NAMES:
+                old, new = previous[name], positions[name]
+                if old is not None and new is not None and old != new:
+                    if distance(new, king) < distance(old, before):
+                        self._scale(CONTAINING[name], self.approach)
+        neutralised = (len(arrested), visible['killed']['assassins'])
+        if neutralised != self.__neutralised:
+            self.__neutralised = neutralised
+            killed = neutralised[1]
+            self._scale([i for i, t in enumerate(TRIPLES) if killed + len(arrested.intersection(t)) >= 3], 0.0)
+        self.played(state)
+
+    def played(self, state):
+        '''Take 'state', the one after a turn of the king's side, as the next reference.'''
+        self.__positions = {name: state.position(name) for name in NAMES}
+        self.__king = state.position('king')
+
+    def total(self):
+        return sum(self.__weights)
+
+    def probability(self, triple):
+        '''Return the probability of a triple of names (in any order).'''
+        total = self.total()
+        return self.__weights[TRIPLES.index(tuple(sorted(triple)))] / total if total > 0 else 0.0
+
+    def marginals(self):
+        '''Return a dictionary with, for each villager, the probability of being an assassin.'''
+        if self.__marginals is None:
+            total = self.total()
+            weights = self.__weights
+            self.__marginals = {
+                name: sum(weights[i] for i in CONTAINING[name]) / total if total > 0 else 0.0
+                for name in NAMES
+            }
+        return dict(self.__marginals)
+
+    def suspects(self, names):
+        '''Return the given villagers sorted from the most to the least likely assassin.'''
+        marginals = self.marginals() if self.__marginals is None else self.__marginals
+        return sorted(names, key=lambda name: (-marginals.get(name, 0.0), name))
+
+    def sample(self, rng):
+        '''Return a triple of TRIPLES drawn with its probability, using the random generator 'rng'.'''
+        if self.__cumulative is None:
+            self.__cumulative = list(itertools.accumulate(self.__weights))
+        cumulative = self.__cumulative
+        if cumulative[-1] <= 0:
+            return rng.choice(TRIPLES)
+        return TRIPLES[min(bisect.bisect_right(cumulative, rng.random() * cumulative[-1]), len(TRIPLES) - 1)]
+
+    def sampleassassins(self, rng):
+        '''Return the names of the assassins not revealed yet of a sampled triple, for determinize().'''
+        return [name for name in self.sample(rng) if name not in self.__revealed]
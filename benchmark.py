@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# benchmark.py
+# Measures the speed of the hot paths of the King & Assassins engines against a saved baseline
+
+import argparse
+import contextlib
+import copy
+import gc
+import io
+import itertools
+import json
+import random
+import sys
+import time
+
+import kingandassassins_Original as kingandassassins
+from kingandassassins_Original import CARDS, KA_INITIAL_STATE
+from tournament import loadclass
+
+ENGINES = (
+    'kingandassassins_Original:KingAndAssassinsState',
+    'kingandassassins_Original:BitboardKingAndAssassinsState'
+)
+
+# One action of each type, as (name, player, action), on the board of fixture()
+ACTIONS = (
+    ('move', 1, ('move', 9, 9, 'N')),
+    ('push', 1, ('move', 5, 0, 'E')),
+    ('arrest', 1, ('arrest', 2, 4, 'E')),
+    ('kill-assassin', 1, ('kill', 7, 3, 'E')),
+    ('kill-knight', 0, ('kill', 9, 8, 'N')),
+    ('attack', 0, ('attack', 9, 8, 'E')),
+    ('reveal', 0, ('reveal', 3, 6))
+)
+
+
+def fixture(stateclass):
+    '''Return a state where every action of ACTIONS can be played.
+
+    The knight on (5, 0) pushes a chain of three villagers, the knight on (7, 3) is
+    next to an assassin and the assassin on (9, 8) is next to the king and a knight.
+    '''
+    visible = copy.deepcopy(KA_INITIAL_STATE)
+    people = [[None] * 10 for i in range(10)]
+    people[9][9] = 'king'
+    for x, y in ((5, 0), (7, 3), (2, 4), (8, 8)):
+        people[x][y] = 'knight'
+    for (x, y), name in zip(((5, 1), (5, 2), (5, 3), (2, 5), (3, 6)), ('farmer', 'squire', 'hooker', 'butcher', 'monk')):
+        people[x][y] = name
+    people[7][4] = people[9][8] = 'assassin'
+    visible['people'] = people
+    visible['card'] = CARDS[0]
+    state = stateclass(visible)
+    state._state['hidden'] = {'assassins': {'monk', 'shepherd', 'carpenter'}, 'cards': list(CARDS[1:])}
+    return state
+
+
+def measure(run, number, repeat, prepare=None):
+    '''Return the best number of operations per second of 'repeat' runs.
+    Pre: 'run' is a function taking what 'prepare' returned, or nothing.
+    Post: Each run calls 'run' 'number' times, after calling 'prepare' 'number' times
+          outside of the measured time. The garbage collector is off during the runs.
+    '''
+    best = 0.0
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(repeat):
+            if prepare is None:
+                start = time.perf_counter()
+                for j in range(number):
+                    run()
+            else:
+                args = [prepare() for j in range(number)]
+                start = time.perf_counter()
+                for arg in args:
+                    run(arg)
+            elapsed = time.perf_counter() - start
+            best = max(best, number / elapsed)
+    finally:
+        if enabled:
+            gc.enable()
+    return best
+
+
+def benchmarks(stateclass, number, repeat):
+    '''Yield (name, operations per second) for each benchmark of a state engine.'''
+    name = stateclass.__name__
+    state = fixture(stateclass)
+    for action, player, move in ACTIONS:
+        # Each update plays on its own copy, made beforehand
+        yield '{}.update[{}]'.format(name, action), measure(lambda s: s.update([move], player), number, repeat, state.copy)
+    yield '{}.update[drawcard]'.format(name), measure(lambda s: s.update([], 0), number, repeat, state.copy)
+    yield '{}.winner'.format(name), measure(state.winner, number, repeat)
+    yield '{}._getcoord'.format(name), measure(lambda: state._getcoord((5, 5, 'N')), number, repeat)
+    with contextlib.redirect_stdout(io.StringIO()):
+        ops = measure(state.prettyprint, number // 10 or 1, repeat)
+    yield '{}.prettyprint'.format(name), ops
+    text = str(state)
+    yield '{}.__str__'.format(name), measure(state.__str__, number // 10 or 1, repeat)
+    yield '{}.parse'.format(name), measure(lambda: stateclass.parse(text), number // 10 or 1, repeat)
+    server = kingandassassins.KingAndAssassinsServer(stateclass=stateclass, seed=0)
+    yield '{}.GameServer.state'.format(name), measure(lambda: server.state, number, repeat)
+
+
+def games(stateclass, number, repeat, seed=0):
+    '''Return the best number of full games per second between random bots, each run playing the same games.'''
+    def play(game):
+        random.seed(game)
+        server = kingandassassins.KingAndAssassinsServer(stateclass=stateclass, seed=game)
+        clients = [kingandassassins.RandomKingAndAssassinsClient(str(i), None, seed=game + i) for i in range(2)]
+        server.runlocal(clients)
+    seeds = itertools.cycle(range(seed, seed + number))
+    return measure(lambda: play(next(seeds)), number, repeat)
+
+
+def compare(results, baseline, tolerance):
+    '''Return the lines comparing results with a baseline and the names of the regressions.'''
+    lines, regressions = [], []
+    for name, ops in results.items():
+        if name not in baseline:
+            lines.append('{:55} {:>14,.0f} ops/s'.format(name, ops))
+            continue
+        ratio = ops / baseline[name]
+        slower = ratio < 1 - tolerance
+        if slower:
+            regressions.append(name)
+        lines.append('{:55} {:>14,.0f} ops/s {:>7.2f}x{}'.format(name, ops, ratio, '  REGRESSION' if slower else ''))
+    return lines, regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='King & Assassins engine benchmarks')
+    parser.add_argument('--state', action='append', help='state engine as module:Class (default: both engines)')
+    parser.add_argument('-n', '--number', type=int, help='operations per run (default: 2000)', default=2000)
+    parser.add_argument('-r', '--repeat', type=int, help='runs, the best one being kept (default: 5)', default=5)
+    parser.add_argument('-g', '--games', type=int, help='full games per run (default: 20)', default=20)
+    parser.add_argument('--save', help='save the results as a baseline in this file')
+    parser.add_argument('--compare', help='compare the results with the baseline in this file')
+    parser.add_argument('--tolerance', type=float, help='slowdown reported as a regression (default: 0.1)', default=0.1)
+    args = parser.parse_args()
+
+    results = {}
+    for spec in args.state or ENGINES:
+        stateclass = loadclass(spec)
+        for name, ops in benchmarks(stateclass, args.number, args.repeat):
+            results[name] = ops
+        results['{}.runlocal[game]'.format(stateclass.__name__)] = games(stateclass, args.games, args.repeat)
+    baseline = {}
+    if args.compare is not None:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    lines, regressions = compare(results, baseline, args.tolerance)
+    print('\n'.join(lines))
+    if args.save is not None:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+    if len(regressions) > 0:
+        print('{} regression(s) beyond {:.0%}'.format(len(regressions), args.tolerance))
+        sys.exit(1)
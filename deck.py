@@ -0,0 +1,82 @@
+# deck.py
+# Exact probabilities of the next cards of the King & Assassins deck, from the cards already seen
+
+import functools
+from math import comb
+
+from kingandassassins_Original import CARDS
+
+# Index of each field in a card: (AP King, AP Knight, Fetter, AP Population/Assassins)
+FIELDS = {'king': 0, 'knight': 1, 'fetter': 2, 'villager': 3}
+# The distinct cards, sorted, and how many of each the deck has
+CARD_TYPES = tuple(sorted(set(CARDS)))
+CARD_INDEX = {card: i for i, card in enumerate(CARD_TYPES)}
+FULL_DECK = tuple(CARDS.count(card) for card in CARD_TYPES)
+
+
+def remaining(seen):
+    '''Return the multiset of the cards left in the deck, as counts of each card of CARD_TYPES.
+    Pre: 'seen' contains the cards already drawn, the current one included, as lists or tuples.
+    Raises ValueError: If a card has been seen more often than the deck has it.
+    '''
+    counts = list(FULL_DECK)
+    for card in seen:
+        i = CARD_INDEX[tuple(card)]
+        counts[i] -= 1
+        if counts[i] < 0:
+            raise ValueError('{} seen more often than in the deck'.format(tuple(card)))
+    return tuple(counts)
+
+
+@functools.lru_cache(maxsize=None)
+def _distribution(counts, field, turns):
+    # Distribution of the sum of a field over the next 'turns' cards, as sorted (value, probability)
+    # pairs: the next cards are a uniformly random subset of the remaining ones, so the number of
+    # ways of drawing j copies of each card is counted with one DP over the distinct cards
+    total = sum(counts)
+    turns = min(turns, total)
+    ways = {(0, 0): 1}
+    for card, n in zip(CARD_TYPES, counts):
+        value = int(card[field])
+        merged = {}
+        for (drawn, s), w in ways.items():
+            for j in range(min(n, turns - drawn) + 1):
+                key = (drawn + j, s + j * value)
+                merged[key] = merged.get(key, 0) + w * comb(n, j)
+        ways = merged
+    outcomes = comb(total, turns)
+    return tuple(sorted((s, w / outcomes) for (drawn, s), w in ways.items() if drawn == turns))
+
+
+def distribution(seen, field, turns=1):
+    '''Return the distribution of the sum of a field of the next cards.
+    Pre: 'field' is a key of FIELDS ('fetter' counting the cards allowing arrests) and
+         'turns' > 0, the number of cards drawn (one per turn of the assassins' side).
+    Post: The returned dictionary maps each possible sum to its probability. When fewer
+          than 'turns' cards are left, the sum is over all of them; with no card left,
+          the sum is 0.
+    '''
+    return dict(_distribution(remaining(seen), FIELDS[field], turns))
+
+
+def nextcard(seen):
+    '''Return a dictionary mapping each card that may be drawn next to its probability (empty if none is left).'''
+    counts = remaining(seen)
+    total = sum(counts)
+    if total == 0:
+        return {}
+    return {card: n / total for card, n in zip(CARD_TYPES, counts) if n > 0}
+
+
+def expected(seen, field, turns=1):
+    '''Return the expected sum of a field of the next 'turns' cards.'''
+    return sum(s * p for s, p in _distribution(remaining(seen), FIELDS[field], turns))
+
+
+def atleast(seen, field, value, turns=1):
+    '''Return the probability that the sum of a field of the next 'turns' cards is at least 'value'.
+
+    For example, atleast(seen, 'fetter', 1, k) is the probability of being allowed to arrest
+    at least once in the next k turns.
+    '''
+    return sum(p for s, p in _distribution(remaining(seen), FIELDS[field], turns) if s >= value)
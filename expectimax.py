@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# expectimax.py
+# Expectimax (Star1) search client for the King & Assassins game
+
+import argparse
+import random
+import socket
+import time
+from collections import Counter
+
+from kingandassassins_Original import CARDS
+from lib.transposition import TranspositionTable, EXACT, LOWER, UPPER
+from search import SearchKingAndAssassinsClient, evaluate, terminalvalue
+
+# Keys of the side to move and of the multiset of cards left in the deck
+_keyrandom = random.Random(20160502)
+SIDE_KEYS = (_keyrandom.getrandbits(64), _keyrandom.getrandbits(64), _keyrandom.getrandbits(64))
+CHANCE = 2
+DECK_KEYS = {card: tuple(_keyrandom.getrandbits(64) for i in range(len(CARDS) + 1)) for card in sorted(set(CARDS))}
+
+
+def deckkey(deck):
+    '''Return the hash of the multiset of cards 'deck', a Counter of card tuples.'''
+    h = 0
+    for card, count in deck.items():
+        h ^= DECK_KEYS[card][count]
+    return h
+
+
+class ExpectimaxKingAndAssassinsClient(SearchKingAndAssassinsClient):
+    '''Class representing an expectimax search client for the King & Assassins game.
+
+    The tree alternates the turns of both teams with a chance node each time a card
+    is drawn. A chance node has one child per distinct card left in the deck, weighted
+    by its number of copies, rather than one per card: CARDS has only six distinct
+    tuples, so drawing any copy of the same card leads to the same subtree. Chance
+    nodes are pruned with Star1 bounds, values being between 0 and 1, and every node
+    is memoised by the Zobrist hash of its state, the side to move and the multiset
+    of cards left, so that transpositions are searched once.
+
+    Turns cannot be enumerated exhaustively, so each decision node only considers
+    'width' candidate turns: passing and the best, according to evaluate(), of
+    'samples' random action sequences. The search stops after 'depth' turns. The
+    king's side searches with one sampled guess of the hidden assassins.
+    '''
+    def __init__(self, name, server, verbose=False, depth=2, width=4, samples=12, seed=None, latency=None, games=1):
+        self.depth = depth
+        self.width = width
+        self.samples = samples
+        self.lastsearch = None
+        self.__table = TranspositionTable(1 << 16)
+        self.__nodes = 0
+        self.__verbose = verbose
+        super().__init__(name, server, verbose=verbose, seed=seed, latency=latency, games=games)
+
+    def search(self, state):
+        '''Search the actions to play in 'state' for 'depth' turns.
+        Pre: 'state' is a BitboardKingAndAssassinsState where this client has to play.
+        Post: The returned value is the list of actions to play. The number of
+              searched nodes and the time taken are stored in 'lastsearch'.
+        '''
+        player = self._playernb
+        deck = Counter(self.remainingcards())
+        state.zobrist()
+        state = self.determinize(state, self.sampleassassins(state), list(deck.elements()))
+        self.__table.newsearch()
+        self.__nodes = 0
+        start = time.perf_counter()
+        best, bestvalue = [], None
+        alpha, beta = 0.0, 1.0
+        for actions, child in self.candidates(state, player):
+            value = self._after(child, player, deck, self.depth - 1, alpha, beta)
+            if bestvalue is None or (value > bestvalue if player == 1 else value < bestvalue):
+                best, bestvalue = actions, value
+                if player == 1:
+                    alpha = max(alpha, value)
+                else:
+                    beta = min(beta, value)
+        elapsed = time.perf_counter() - start
+        self.lastsearch = {'nodes': self.__nodes, 'seconds': elapsed, 'value': bestvalue}
+        if self.__verbose:
+            print('   Expectimax: {} nodes in {:.2f}s, value {:.3f}'.format(self.__nodes, elapsed, bestvalue))
+        return best
+
+    def candidates(self, state, player):
+        '''Return the (actions, state) pairs of the turns considered for 'player' in 'state'.'''
+        card = state._visible['card']
+        turns = {state.zobrist(): ([], state.copy())}
+        for i in range(self.samples):
+            child = state.copy()
+            actions = self.randomsequence(child, player, card)
+            turns.setdefault(child.zobrist(), (actions, child))
+        passing = turns.pop(state.zobrist())
+        ranked = sorted(turns.values(), key=lambda turn: self._score(turn[1]), reverse=player == 1)
+        return [passing] + ranked[:self.width - 1]
+
+    def _score(self, state):
+        winner = state.winner()
+        return evaluate(state) if winner == -1 else terminalvalue(winner)
+
+    def _after(self, state, player, deck, depth, alpha, beta):
+        # Value of 'state' once 'player' has played its turn
+        winner = state.winner()
+        if winner != -1:
+            return terminalvalue(winner)
+        if player == 1:
+            return self._turn(state, 0, deck, depth, alpha, beta)
+        return self._chance(state, deck, depth, alpha, beta)
+
+    def _turn(self, state, player, deck, depth, alpha, beta):
+        # Value of a decision node of 'player', with alpha-beta pruning
+        self.__nodes += 1
+        if depth <= 0:
+            return evaluate(state)
+        key = state.zobrist() ^ SIDE_KEYS[player] ^ deckkey(deck)
+        value = self._lookup(key, depth, alpha, beta)
+        if value is not None:
+            return value
+        low, high = alpha, beta
+        best = None
+        for actions, child in self.candidates(state, player):
+            value = self._after(child, player, deck, depth - 1, low, high)
+            if player == 1:
+                best = value if best is None else max(best, value)
+                low = max(low, value)
+            else:
+                best = value if best is None else min(best, value)
+                high = min(high, value)
+            if low >= high:
+                break
+        self._store(key, depth, best, alpha, beta)
+        return best
+
+    def _chance(self, state, deck, depth, alpha, beta):
+        # Expected value over the next card drawn, with Star1 pruning
+        total = sum(deck.values())
+        if total <= 1:
+            # The last card is drawn and the game ends
+            return 0.0
+        key = state.zobrist() ^ SIDE_KEYS[CHANCE] ^ deckkey(deck)
+        value = self._lookup(key, depth, alpha, beta)
+        if value is not None:
+            return value
+        rest = 1.0
+        expected = 0.0
+        for card, count in sorted(deck.items(), key=lambda item: -item[1]):
+            p = count / total
+            rest -= p
+            remaining = deck.copy()
+            remaining[card] -= 1
+            if remaining[card] == 0:
+                del remaining[card]
+            child = state.copy()
+            child._data['hidden']['cards'] = list(remaining.elements()) + [card]
+            child._drawcard(child._visible, child._data['hidden'])
+            low = (alpha - expected - rest) / p
+            high = (beta - expected) / p
+            value = self._turn(child, 1, remaining, depth, max(0.0, low), min(1.0, high))
+            if value <= low:
+                value = expected + p * value + rest
+                self._store(key, depth, value, alpha, beta)
+                return value
+            if value >= high:
+                value = expected + p * value
+                self._store(key, depth, value, alpha, beta)
+                return value
+            expected += p * value
+        self._store(key, depth, expected, alpha, beta)
+        return expected
+
+    def _lookup(self, key, depth, alpha, beta):
+        entry = self.__table.get(key)
+        if entry is None or entry[0] < depth:
+            return None
+        value, kind = entry[1], entry[2]
+        if kind == EXACT or (kind == LOWER and value >= beta) or (kind == UPPER and value <= alpha):
+            return value
+        return None
+
+    def _store(self, key, depth, value, alpha, beta):
+        kind = UPPER if value <= alpha else LOWER if value >= beta else EXACT
+        self.__table.put(key, depth, value, kind)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='King & Assassins expectimax client')
+    parser.add_argument('name', help='name of the player')
+    parser.add_argument('--host', help='hostname of the server (default: localhost)',
+                        default=socket.gethostbyname(socket.gethostname()))
+    parser.add_argument('--port', help='port of the server (default: 5000)', default=5000)
+    parser.add_argument('--depth', type=int, help='number of turns searched (default: 2)', default=2)
+    parser.add_argument('--width', type=int, help='turns considered at each node (default: 4)', default=4)
+    parser.add_argument('--games', type=int, help='games to play on the connection, 0 for no limit (default: 1)', default=1)
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    ExpectimaxKingAndAssassinsClient(args.name, (args.host, int(args.port)), verbose=args.verbose,
+                                     depth=args.depth, width=args.width, games=args.games or None)
@@ -4,13 +4,18 @@
 # Version: April 29, 2016
 
 import argparse
+import copy
+import heapq
 import json
+import os
 import random
 import socket
+import struct
 from random import randint
 import sys
+import zlib
 
-from lib import game
+from lib import game, latency, replay
 
 
 global TURN
@@ -37,6 +42,18 @@ CARDS = (
     (1, 5, False, 4)
 )
 
+# Action points spent by each kind of action
+AP_COSTS = {
+    'move': 1,
+    'arrest': 1,
+    'kill': 1,
+    'attack': 1,
+    'reveal': 1
+}
+
+# Extra action points needed to climb on a roof from the ground
+ROOF_COST = 1
+
 POPULATION = {
     'monk', 'plumwoman', 'appleman', 'hooker', 'fishwoman', 'butcher',
     'blacksmith', 'shepherd', 'squire', 'carpenter', 'witchhunter', 'farmer'
@@ -72,11 +89,159 @@ PEOPLE[9][9] = 'king'
 for coord in KNIGHTS:
     PEOPLE[coord[0]][coord[1]] = 'knight'
 
-# Place the villagers on the board
-# random.sample(A, len(A)) returns a list where the elements are shuffled
-# this randomizes the position of the villagers
-for villager, coord in zip(random.sample(POPULATION, len(POPULATION)), VILLAGERS):
-    PEOPLE[coord[0]][coord[1]] = villager
+
+
+def placevillagers(people, rng=random):
+    # Place the villagers on the board
+    # rng.sample(A, len(A)) returns a list where the elements are shuffled
+    # this randomizes the position of the villagers
+    for villager, coord in zip(rng.sample(sorted(POPULATION), len(POPULATION)), sorted(VILLAGERS)):
+        people[coord[0]][coord[1]] = villager
+
+
+placevillagers(PEOPLE)
+
+# Codes used by the binary encoding of states and moves
+PIECES = (None,) + tuple(sorted(POPULATION)) + ('king', 'knight', 'assassin')
+PIECE_CODES = {p: i for i, p in enumerate(PIECES)}
+KING_STATUS = ('healthy', 'injured', 'dead')
+ACTIONS = ('move', 'arrest', 'kill', 'attack', 'reveal')
+DIRECTION_NAMES = ('E', 'W', 'S', 'N')
+NO_CARD = 255
+# Lookup tables of the binary codec: the pair of people coded by a byte of the board
+# and the other way round, the (x, y) cell of an index 10 * x + y, and the (action,
+# direction) coded by an action byte (None for a reveal, which has no direction) and
+# the other way round. The castle doors are encoded as actions with code 15.
+PEOPLE_PAIRS = {p << 4 | q: (PIECES[p], PIECES[q]) for p in range(len(PIECES)) for q in range(len(PIECES))}
+PEOPLE_BYTES = {pair: byte for byte, pair in PEOPLE_PAIRS.items()}
+CELLS = tuple((i // 10, i % 10) for i in range(100))
+ACTION_NAMES = {
+    code << 4 | d: (name, None if name == 'reveal' else direction)
+    for code, name in list(enumerate(ACTIONS)) + [(15, 'door')]
+    for d, direction in enumerate(DIRECTION_NAMES)
+    if name != 'reveal' or d == 0
+}
+ACTION_BYTES = {action: byte for byte, action in ACTION_NAMES.items()}
+# Most actions (or assassins) in a move, their number being encoded on one byte
+MAX_ACTIONS = 255
+
+# Zobrist keys: one per (person, cell), king status, card and arrested villager.
+# The people code 0 stands for an empty cell, whose keys are all 0.
+_zobristrandom = random.Random(20160429)
+ZOBRIST_PEOPLE = ((0,) * 100,) + tuple(
+    tuple(_zobristrandom.getrandbits(64) for i in range(100)) for p in PIECES[1:]
+)
+ZOBRIST_KING = {status: _zobristrandom.getrandbits(64) for status in KING_STATUS}
+ZOBRIST_CARDS = {card: _zobristrandom.getrandbits(64) for card in sorted(set(CARDS))}
+ZOBRIST_CARDS[None] = 0
+ZOBRIST_ARRESTED = {p: _zobristrandom.getrandbits(64) for p in sorted(POPULATION)}
+
+# All-pairs path tables, see paths(). The file, if any, caches the tables between runs.
+PATHS_CACHE = os.environ.get('KA_PATHS_CACHE')
+_paths = {}
+
+
+def _boardkey(board):
+    # Identifies the board and the move costs that the tables were built with
+    return zlib.crc32(json.dumps([board, AP_COSTS['move'], ROOF_COST]).encode())
+
+
+def _buildpaths(board, king):
+    # Backward Dijkstra from every target cell on the empty board
+    roofs = [board[i // 10][i % 10] == 'R' for i in range(100)]
+    allowed = [not (king and roofs[i]) for i in range(100)]
+    steps, costs, nexts = [None] * 10000, [None] * 10000, [None] * 10000
+    neighbours = [[] for i in range(100)]
+    for i in range(100):
+        x, y = i // 10, i % 10
+        for d, (dx, dy) in zip(DIRECTION_NAMES, ((0, 1), (0, -1), (1, 0), (-1, 0))):
+            if 0 <= x + dx <= 9 and 0 <= y + dy <= 9:
+                neighbours[i].append((d, 10 * (x + dx) + y + dy))
+    for target in range(100):
+        if not allowed[target]:
+            continue
+        best = {target: (0, 0)}
+        heap = [(0, 0, target)]
+        while len(heap) > 0:
+            cost, step, j = heapq.heappop(heap)
+            if best[j] < (cost, step):
+                continue
+            for d, i in neighbours[j]:
+                if not allowed[i]:
+                    continue
+                entry = (cost + AP_COSTS['move'] + (ROOF_COST if roofs[j] and not roofs[i] else 0), step + 1)
+                if i not in best or entry < best[i]:
+                    best[i] = entry
+                    heapq.heappush(heap, entry + (i,))
+        for i, (cost, step) in best.items():
+            costs[100 * i + target], steps[100 * i + target] = cost, step
+            # First step of a cheapest path, the shortest one among them
+            for d, j in neighbours[i]:
+                if j in best and i != target:
+                    movecost = AP_COSTS['move'] + (ROOF_COST if roofs[j] and not roofs[i] else 0)
+                    if (movecost + best[j][0], best[j][1] + 1) == (cost, step):
+                        nexts[100 * i + target] = d
+                        break
+    return {'steps': steps, 'costs': costs, 'next': nexts}
+
+
+def paths(board=BOARD, cachefile=None):
+    '''Return the all-pairs path tables of a board.
+    Pre: 'board' is a 10x10 grid of 'G' and 'R' cells, 'cachefile' the path of a cache
+         file, PATHS_CACHE by default, or None.
+    Post: The returned value is a dictionary with a 'king' and a 'people' entry, one for
+          the king who cannot go on roofs and one for the other pawns. Each entry maps
+          'steps', 'costs' and 'next' to a list indexed by 100 * src + dst, where cells
+          are numbered 10 * x + y, giving the number of moves and of action points of
+          the cheapest path from src to dst on an empty board and the direction of
+          its first move. Unreachable cells and the 'next' of a cell to itself are None.
+          The tables are built once per board, or loaded from the cache file when it
+          was written for the same board and move costs.
+    '''
+    key = _boardkey(board)
+    if key in _paths:
+        return _paths[key]
+    cachefile = PATHS_CACHE if cachefile is None else cachefile
+    tables = None
+    if cachefile is not None:
+        try:
+            with open(cachefile) as file:
+                cached = json.load(file)
+            if cached['key'] == key:
+                tables = cached['tables']
+        except (OSError, ValueError, KeyError):
+            pass
+    if tables is None:
+        tables = {'king': _buildpaths(board, True), 'people': _buildpaths(board, False)}
+        if cachefile is not None:
+            try:
+                with open(cachefile, 'w') as file:
+                    json.dump({'key': key, 'tables': tables}, file, separators=(',', ':'))
+            except OSError:
+                pass
+    _paths[key] = tables
+    return tables
+
+
+def distance(src, dst, king=False, board=None):
+    '''Return the number of moves from cell 'src' to cell 'dst', given as (x, y), or None.'''
+    tables = PATHS if board is None else paths(board)
+    return tables['king' if king else 'people']['steps'][100 * (10 * src[0] + src[1]) + 10 * dst[0] + dst[1]]
+
+
+def pathcost(src, dst, king=False, board=None):
+    '''Return the action points needed to go from cell 'src' to cell 'dst', or None.'''
+    tables = PATHS if board is None else paths(board)
+    return tables['king' if king else 'people']['costs'][100 * (10 * src[0] + src[1]) + 10 * dst[0] + dst[1]]
+
+
+def nextstep(src, dst, king=False, board=None):
+    '''Return the direction of the first move from cell 'src' to cell 'dst', or None.'''
+    tables = PATHS if board is None else paths(board)
+    return tables['king' if king else 'people']['next'][100 * (10 * src[0] + src[1]) + 10 * dst[0] + dst[1]]
+
+
+PATHS = paths()
 
 KA_INITIAL_STATE = {
     'board': BOARD,
@@ -102,9 +267,119 @@ class KingAndAssassinsState(game.GameState):
         'S': (1, 0),
         'N': (-1, 0)
     }
+    OPPOSITE = {'E': 'W', 'W': 'E', 'S': 'N', 'N': 'S'}
 
     def __init__(self, initialstate=KA_INITIAL_STATE):
         super().__init__(initialstate)
+        # Zobrist hash, computed on first use and then updated by each action
+        self._hash = None
+        # Index of the people, built on first use and then updated by each action
+        self._where = None
+        # Cells changed by the action being applied, see apply()
+        self._journal = None
+        # Board and its roofs encoded by encode(), computed on first use
+        self._roofbytes = None
+
+    def zobrist(self):
+        '''Return the Zobrist hash of the visible state.
+        Pre: -
+        Post: The returned value is a 64-bit hash of the people on each cell, the king
+              status, the current card and the arrested villagers. Once computed, it is
+              kept up to date by update() at the cost of a few XORs per action.
+        '''
+        if self._hash is None:
+            visible = self._state['visible']
+            card = visible['card']
+            h = ZOBRIST_KING[visible['king']] ^ ZOBRIST_CARDS[None if card is None else tuple(card)]
+            for x, row in enumerate(visible['people']):
+                for y, p in enumerate(row):
+                    h ^= ZOBRIST_PEOPLE[PIECE_CODES[p]][10 * x + y]
+            for p in visible['arrested']:
+                h ^= ZOBRIST_ARRESTED[p]
+            self._hash = h
+        return self._hash
+
+    def checksum(self, snapshot=None):
+        # The Zobrist hash is kept up to date, only the killed counters are not in it
+        killed = self._state['visible']['killed']
+        h = self.zobrist() ^ (killed['knights'] << 8 | killed['assassins'])
+        return (h ^ h >> 32) & 0xFFFFFFFF
+
+    def _buildindex(self):
+        visible = self._state['visible']
+        hidden = self._state['hidden']
+        # Cell of the king and of each villager, cells of the knights and revealed assassins
+        self._where, self._knightcells, self._assassincells = {}, set(), set()
+        for x, row in enumerate(visible['people']):
+            for y, p in enumerate(row):
+                if p is not None:
+                    self._indexcell(p, (x, y))
+        self._doorcells = {self._getcoord(door) for door in visible['castle']}
+        assassins = hidden['assassins'] if hidden is not None else None
+        self._caught = len(set(visible['arrested']) & assassins) if assassins else 0
+
+    def _indexcell(self, p, cell):
+        if p == 'knight':
+            self._knightcells.add(cell)
+        elif p == 'assassin':
+            self._assassincells.add(cell)
+        else:
+            self._where[p] = cell
+
+    def _setcell(self, people, x, y, p):
+        if self._hash is not None:
+            i = 10 * x + y
+            self._hash ^= ZOBRIST_PEOPLE[PIECE_CODES[people[x][y]]][i] ^ ZOBRIST_PEOPLE[PIECE_CODES[p]][i]
+        if self._journal is not None:
+            self._journal.append((x, y, people[x][y]))
+        if self._where is not None:
+            old = people[x][y]
+            if old == 'knight':
+                self._knightcells.discard((x, y))
+            elif old == 'assassin':
+                self._assassincells.discard((x, y))
+            # A pushed villager may already have been indexed on its new cell
+            elif old is not None and self._where.get(old) == (x, y):
+                del self._where[old]
+            if p is not None:
+                self._indexcell(p, (x, y))
+        people[x][y] = p
+
+    def position(self, name):
+        '''Return the cell of a person.
+        Pre: 'name' is 'king' or the name of a villager.
+        Post: The returned value is the (x, y) cell of the person, or None if the person
+              is not on the board (arrested, or revealed as an assassin).
+        '''
+        if self._where is None:
+            self._buildindex()
+        return self._where.get(name)
+
+    def knightcells(self):
+        '''Return the set of the (x, y) cells of the knights.'''
+        if self._where is None:
+            self._buildindex()
+        return frozenset(self._knightcells)
+
+    def assassinsleft(self):
+        '''Return the number of assassins neither killed nor arrested.
+        Pre: The assassins have been chosen.
+        '''
+        if self._where is None:
+            self._buildindex()
+        return 3 - self._state['visible']['killed']['assassins'] - self._caught
+
+    def _setking(self, visible, status):
+        if self._hash is not None:
+            self._hash ^= ZOBRIST_KING[visible['king']] ^ ZOBRIST_KING[status]
+        visible['king'] = status
+
+    def _drawcard(self, visible, hidden):
+        card = hidden['cards'].pop()
+        if self._hash is not None:
+            old = visible['card']
+            self._hash ^= ZOBRIST_CARDS[None if old is None else tuple(old)] ^ ZOBRIST_CARDS[tuple(card)]
+        visible['card'] = card
 
     def _nextfree(self, x, y, d):
         people = self._state['visible']['people']
@@ -123,112 +398,203 @@ class KingAndAssassinsState(game.GameState):
         return None
 
     def update(self, moves, player):
+        # A move is played as a whole or not at all
+        records = []
+        try:
+            for move in moves:
+                # None would end the turn in apply()
+                if move is None:
+                    raise game.InvalidMoveException('None is not an action')
+                records.append(self.apply(move, player))
+        except Exception:
+            for record in reversed(records):
+                self.undo(record)
+            raise
+        # If assassins' team just played, draw a new card
+        if player == 0:
+            self._drawcard(self._state['visible'], self._state['hidden'])
+
+    def apply(self, action, player):
+        '''Play one action and return what is needed to take it back.
+        Pre: 'action' is an action of 'player', or None for the end of the turn of
+             'player', which draws a card after the assassins' team's turn.
+        Post: The action has been played as update() does. The returned value is an
+              undo record for undo(), valid until another action is applied.
+        Raises InvalidMoveException: If the action is invalid, the state is unchanged (as
+                                     for any other error raised by the action).
+        '''
+        record = self._record()
+        journal = self._journal = []
+        try:
+            if action is not None:
+                self._playaction(action, player)
+            elif player == 0:
+                self._drawcard(self._state['visible'], self._state['hidden'])
+        except Exception:
+            self._journal = None
+            self.undo(record + (tuple(journal),))
+            raise
+        finally:
+            self._journal = None
+        return record + (tuple(journal),)
+
+    def _record(self):
+        # Everything an action may change but the people on the board
         visible = self._state['visible']
         hidden = self._state['hidden']
+        caught = self._caught if self._where is not None else None
+        return (self._hash, caught, visible['card'], 0 if hidden is None else len(hidden['cards']),
+                visible['king'], len(visible['arrested']), visible['killed']['knights'], visible['killed']['assassins'])
+
+    def undo(self, record):
+        '''Take back the action whose undo record is given.
+        Pre: 'record' has been returned by apply() and the actions applied after
+             it have already been taken back.
+        Post: The state is exactly the one before apply().
+        '''
+        visible = self._state['visible']
         people = visible['people']
-        for move in moves:
-            print(move)
-            # ('move', x, y, dir): moves person at position (x,y) of one cell in direction dir
-            if move[0] == 'move':
-                x, y, d = int(move[1]), int(move[2]), move[3]
-                p = people[x][y]
-                if p is None:
-                    raise game.InvalidMoveException('{}: there is no one to move'.format(move))
-                nx, ny = self._getcoord((x, y, d))
-                new = people[nx][ny]
-                # King, assassins, villagers can only move on a free cell
-                if p != 'knight' and new is not None:
-                    raise game.InvalidMoveException('{}: cannot move on a cell that is not free'.format(move))
-                if p == 'king' and BOARD[nx][ny] == 'R':
-                    raise game.InvalidMoveException('{}: the king cannot move on a roof'.format(move))
-                if p in {'assassin'}.union(POPULATION) and player != 0:
-                    raise game.InvalidMoveException('{}: villagers and assassins can only be moved by player 0'.format(move))
-                if p in {'king', 'knight'} and player != 1:
-                    raise game.InvalidMoveException('{}: the king and knights can only be moved by player 1'.format(move))
-                # Move granted if cell is free
-                if new is None:
-                    people[x][y], people[nx][ny] = people[nx][ny], people[x][y]
-                # If cell is not free, check if the knight can push villagers
-                else:
-                    nf = self._nextfree((x, y, d))
-                    if nf is None:
-                        raise game.InvalidMoveException('{}: cannot move-and-push in the given direction'.format(move))
-                    nfx, nfy = nf
-                    while (nfx, nfy) != (x, y):
-                        px, py = self._getcoord((nfx, nfx, {'E': 'W', 'W': 'E', 'S': 'N', 'N': 'S'}[d]))
-                        people[nfx][nfy] = people[px][py]
-                        nfx, nfy = px, py
-            # ('arrest', x, y, dir): arrests the villager in direction dir with knight at position (x, y)
-            elif move[0] == 'arrest':
-                if player != 1:
-                    raise game.InvalidMoveException('arrest action only possible for player 1')
-                x, y, d = int(move[1]), int(move[2]), move[3]
-                arrester = people[x][y]
-                if arrester != 'knight':
-                    raise game.InvalidMoveException('{}: the attacker is not a knight'.format(move))
-                tx, ty = self._getcoord((x, y, d))
-                target = people[tx][ty]
-                if target not in POPULATION:
-                    raise game.InvalidMoveException('{}: only villagers can be arrested'.format(move))
-                visible['arrested'].append(people[tx][ty])
-                people[tx][ty] = None
-            # ('kill', x, y, dir): kills the assassin/knight in direction dir with knight/assassin at position (x, y)
-            elif move[0] == 'kill':
-                x, y, d = int(move[1]), int(move[2]), move[3]
-                killer = people[x][y]
-                if killer == 'assassin' and player != 0:
-                    raise game.InvalidMoveException('{}: kill action for assassin only possible for player 0'.format(move))
-                if killer == 'knight' and player != 1:
-                    raise game.InvalidMoveException('{}: kill action for knight only possible for player 1'.format(move))
-                tx, ty = self._getcoord((x, y, d))
-                target = people[tx][ty]
-                if target is None:
-                    raise game.InvalidMoveException('{}: there is no one to kill'.format(move))
-                if killer == 'assassin' and target == 'knight':
-                    visible['killed']['knights'] += 1
-                    people[tx][tx] = None
-                elif killer == 'knight' and target == 'assassin':
-                    visible['killed']['assassins'] += 1
-                    people[tx][tx] = None
-                else:
-                    raise game.InvalidMoveException('{}: forbidden kill'.format(move))
-            # ('attack', x, y, dir): attacks the king in direction dir with assassin at position (x, y)
-            elif move[0] == 'attack':
-                if player != 0:
-                    raise game.InvalidMoveException('attack action only possible for player 0')
-                x, y, d = int(move[1]), int(move[2]), move[3]
-                attacker = people[x][y]
-                if attacker != 'assassin':
-                    raise game.InvalidMoveException('{}: the attacker is not an assassin'.format(move))
-                tx, ty = self._getcoord((x, y, d))
-                target = people[tx][ty]
-                if target != 'king':
-                    raise game.InvalidMoveException('{}: only the king can be attacked'.format(move))
-                visible['king'] = 'injured' if visible['king'] == 'healthy' else 'dead'
-            # ('reveal', x, y): reveals villager at position (x,y) as an assassin
-            elif move[0] == 'reveal':
-                if player != 0:
-                    raise game.InvalidMoveException('raise action only possible for player 0')
-                x, y = int(move[1]), int(move[2])
-                p = people[x][y]
-                if p not in hidden['assassins']:
-                    raise game.InvalidMoveException('{}: the specified villager is not an assassin'.format(move))
-                people[x][y] = 'assassin'
-        # If assassins' team just played, draw a new card
-        if player == 0:
-            visible['card'] = hidden['cards'].pop()
+        h, caught, card, cards, king, arrested, knights, assassins, cells = record
+        for x, y, p in reversed(cells):
+            self._setcell(people, x, y, p)
+        if cards > 0 and len(self._state['hidden']['cards']) < cards:
+            self._state['hidden']['cards'].append(visible['card'])
+        visible['card'] = card
+        visible['king'] = king
+        del visible['arrested'][arrested:]
+        visible['killed']['knights'], visible['killed']['assassins'] = knights, assassins
+        self._hash = h
+        # An index built after apply() counted the arrests of the action taken back
+        if caught is None:
+            self._where = None
+        elif self._where is not None:
+            self._caught = caught
+
+    def _playaction(self, move, player):
+        visible = self._state['visible']
+        hidden = self._state['hidden']
+        people = visible['people']
+        # ('move', x, y, dir): moves person at position (x,y) of one cell in direction dir
+        if move[0] == 'move':
+            x, y, d = int(move[1]), int(move[2]), move[3]
+            self._checkcell(move, x, y)
+            p = people[x][y]
+            if p is None:
+                raise game.InvalidMoveException('{}: there is no one to move'.format(move))
+            nx, ny = self._target(move, x, y, d)
+            new = people[nx][ny]
+            # King, assassins, villagers can only move on a free cell
+            if p != 'knight' and new is not None:
+                raise game.InvalidMoveException('{}: cannot move on a cell that is not free'.format(move))
+            if p == 'king' and BOARD[nx][ny] == 'R':
+                raise game.InvalidMoveException('{}: the king cannot move on a roof'.format(move))
+            if p in {'assassin'}.union(POPULATION) and player != 0:
+                raise game.InvalidMoveException('{}: villagers and assassins can only be moved by player 0'.format(move))
+            if p in {'king', 'knight'} and player != 1:
+                raise game.InvalidMoveException('{}: the king and knights can only be moved by player 1'.format(move))
+            # Move granted if cell is free
+            if new is None:
+                self._setcell(people, nx, ny, p)
+                self._setcell(people, x, y, None)
+            # If cell is not free, check if the knight can push villagers
+            else:
+                nf = self._nextfree(x, y, d)
+                if nf is None:
+                    raise game.InvalidMoveException('{}: cannot move-and-push in the given direction'.format(move))
+                nfx, nfy = nf
+                while (nfx, nfy) != (x, y):
+                    px, py = self._getcoord((nfx, nfy, self.OPPOSITE[d]))
+                    self._setcell(people, nfx, nfy, people[px][py])
+                    nfx, nfy = px, py
+                self._setcell(people, x, y, None)
+        # ('arrest', x, y, dir): arrests the villager in direction dir with knight at position (x, y)
+        elif move[0] == 'arrest':
+            if player != 1:
+                raise game.InvalidMoveException('arrest action only possible for player 1')
+            x, y, d = int(move[1]), int(move[2]), move[3]
+            self._checkcell(move, x, y)
+            arrester = people[x][y]
+            if arrester != 'knight':
+                raise game.InvalidMoveException('{}: the attacker is not a knight'.format(move))
+            tx, ty = self._target(move, x, y, d)
+            target = people[tx][ty]
+            if target not in POPULATION:
+                raise game.InvalidMoveException('{}: only villagers can be arrested'.format(move))
+            visible['arrested'].append(target)
+            if self._hash is not None:
+                self._hash ^= ZOBRIST_ARRESTED[target]
+            if self._where is not None and hidden is not None and hidden['assassins'] and target in hidden['assassins']:
+                self._caught += 1
+            self._setcell(people, tx, ty, None)
+        # ('kill', x, y, dir): kills the assassin/knight in direction dir with knight/assassin at position (x, y)
+        elif move[0] == 'kill':
+            x, y, d = int(move[1]), int(move[2]), move[3]
+            self._checkcell(move, x, y)
+            killer = people[x][y]
+            if killer == 'assassin' and player != 0:
+                raise game.InvalidMoveException('{}: kill action for assassin only possible for player 0'.format(move))
+            if killer == 'knight' and player != 1:
+                raise game.InvalidMoveException('{}: kill action for knight only possible for player 1'.format(move))
+            tx, ty = self._target(move, x, y, d)
+            target = people[tx][ty]
+            if target is None:
+                raise game.InvalidMoveException('{}: there is no one to kill'.format(move))
+            if killer == 'assassin' and target == 'knight':
+                visible['killed']['knights'] += 1
+                self._setcell(people, tx, ty, None)
+            elif killer == 'knight' and target == 'assassin':
+                visible['killed']['assassins'] += 1
+                self._setcell(people, tx, ty, None)
+            else:
+                raise game.InvalidMoveException('{}: forbidden kill'.format(move))
+        # ('attack', x, y, dir): attacks the king in direction dir with assassin at position (x, y)
+        elif move[0] == 'attack':
+            if player != 0:
+                raise game.InvalidMoveException('attack action only possible for player 0')
+            x, y, d = int(move[1]), int(move[2]), move[3]
+            self._checkcell(move, x, y)
+            attacker = people[x][y]
+            if attacker != 'assassin':
+                raise game.InvalidMoveException('{}: the attacker is not an assassin'.format(move))
+            tx, ty = self._target(move, x, y, d)
+            target = people[tx][ty]
+            if target != 'king':
+                raise game.InvalidMoveException('{}: only the king can be attacked'.format(move))
+            self._setking(visible, 'injured' if visible['king'] == 'healthy' else 'dead')
+        # ('reveal', x, y): reveals villager at position (x,y) as an assassin
+        elif move[0] == 'reveal':
+            if player != 0:
+                raise game.InvalidMoveException('raise action only possible for player 0')
+            x, y = int(move[1]), int(move[2])
+            self._checkcell(move, x, y)
+            p = people[x][y]
+            if p not in hidden['assassins']:
+                raise game.InvalidMoveException('{}: the specified villager is not an assassin'.format(move))
+            self._setcell(people, x, y, 'assassin')
 
     def _getcoord(self, coord):
         return tuple(coord[i] + KingAndAssassinsState.DIRECTIONS[coord[2]][i] for i in range(2))
 
+    def _checkcell(self, move, x, y):
+        # Both engines reject the actions of cells outside of the board
+        if not (0 <= x <= 9 and 0 <= y <= 9):
+            raise game.InvalidMoveException('{}: the cell is outside of the board'.format(move))
+
+    def _target(self, move, x, y, d):
+        # Cell next to (x, y) in direction d, which must be on the board
+        nx, ny = self._getcoord((x, y, d))
+        if not (0 <= nx <= 9 and 0 <= ny <= 9):
+            raise game.InvalidMoveException('{}: cannot go outside of the board'.format(move))
+        return nx, ny
+
     def winner(self):
         visible = self._state['visible']
         hidden = self._state['hidden']
+        if self._where is None:
+            self._buildindex()
         # The king reached the castle
-        for doors in visible['castle']:
-            coord = self._getcoord(doors)
-            if visible['people'][coord[0]][coord[1]] == 'king':
-                return 1
+        if self._where.get('king') in self._doorcells:
+            return 1
         # The are no more cards
         if len(hidden['cards']) == 0:
             return 0
@@ -236,7 +602,7 @@ class KingAndAssassinsState(game.GameState):
         if visible['king'] == 'dead':
             return 0
         # All the assassins have been arrested or killed
-        if visible['killed']['assassins'] + len(set(visible['arrested']) & hidden['assassins']) == 3:
+        if visible['killed']['assassins'] + self._caught == 3:
             return 1
         return -1
 
@@ -245,6 +611,120 @@ class KingAndAssassinsState(game.GameState):
     
     def setassassins(self, assassins):
         self._state['hidden']['assassins'] = set(assassins)
+        self._where = None
+
+    def copy(self):
+        '''Return an independent copy of this state.'''
+        state = self.__class__(copy.deepcopy(self._state['visible']))
+        hidden = self._state['hidden']
+        if hidden is not None:
+            state._state['hidden'] = {'assassins': hidden['assassins'], 'cards': list(hidden['cards'])}
+        state._hash = self._hash
+        if self._where is not None:
+            state._where, state._knightcells, state._assassincells = dict(self._where), set(self._knightcells), set(self._assassincells)
+            state._doorcells, state._caught = self._doorcells, self._caught
+        return state
+
+    def _cellat(self, x, y):
+        return self._state['visible']['people'][x][y]
+
+    def _isroof(self, x, y):
+        return self._state['visible']['board'][x][y] == 'R'
+
+    def _positions(self, player):
+        # Yield (x, y, person) for every person that 'player' can act with
+        for x, row in enumerate(self._state['visible']['people']):
+            for y, p in enumerate(row):
+                if p is not None and (p in ('king', 'knight')) == (player == 1):
+                    yield x, y, p
+
+    def _movecost(self, x, y, nx, ny):
+        return AP_COSTS['move'] + (ROOF_COST if self._isroof(nx, ny) and not self._isroof(x, y) else 0)
+
+    def _actions(self, player, budgets, fetter, assassins):
+        # Yield (action, pool, cost, reverse) for every single action of 'player' whose pool
+        # (0: king, 1: knights, 2: villagers) still has action points left, where 'reverse'
+        # is the move cancelling a plain move and None for any other action
+        for x, y, p in self._positions(player):
+            pool = 0 if p == 'king' else 1 if player == 1 else 2
+            if budgets[pool] <= 0:
+                continue
+            if assassins and p in assassins:
+                yield ('reveal', x, y), pool, AP_COSTS['reveal'], None
+            for d, (dx, dy) in self.DIRECTIONS.items():
+                nx, ny = x + dx, y + dy
+                if not (0 <= nx <= 9 and 0 <= ny <= 9):
+                    continue
+                target = self._cellat(nx, ny)
+                if target is None:
+                    if p != 'king' or not self._isroof(nx, ny):
+                        yield ('move', x, y, d), pool, self._movecost(x, y, nx, ny), ('move', nx, ny, self.OPPOSITE[d])
+                elif p == 'knight':
+                    if target in POPULATION:
+                        if fetter:
+                            yield ('arrest', x, y, d), pool, AP_COSTS['arrest'], None
+                        if self._nextfree(x, y, d) is not None:
+                            yield ('move', x, y, d), pool, self._movecost(x, y, nx, ny), None
+                    elif target == 'assassin':
+                        yield ('kill', x, y, d), pool, AP_COSTS['kill'], None
+                elif p == 'assassin':
+                    if target == 'king':
+                        yield ('attack', x, y, d), pool, AP_COSTS['attack'], None
+                    elif target == 'knight':
+                        yield ('kill', x, y, d), pool, AP_COSTS['kill'], None
+
+    def _budgets(self, card):
+        card = self._state['visible']['card'] if card is None else card
+        return [card[0], card[1], card[3]], card[2]
+
+    def _knownassassins(self, assassins):
+        if assassins is None and self._state['hidden'] is not None:
+            return self._state['hidden']['assassins']
+        return assassins
+
+    def legalactions(self, player, card=None, assassins=None):
+        '''Generate the legal single actions of a player.
+        Pre: 'player' is 0 or 1, 'card' is one of CARDS (default: the current card)
+             and 'assassins' are the names of the assassins (default: the hidden ones,
+             if known) which is only needed to generate the 'reveal' actions.
+        Post: The actions that 'player' can play first with 'card' have been yielded
+              one at a time, in the format accepted by update().
+        '''
+        budgets, fetter = self._budgets(card)
+        assassins = self._knownassassins(assassins)
+        for action, pool, cost, reverse in self._actions(player, budgets, fetter, assassins):
+            if cost <= budgets[pool]:
+                yield action
+
+    def legalsequences(self, player, card=None, assassins=None):
+        '''Generate the legal sequences of actions of a player.
+        Pre: Same as legalactions().
+        Post: Every sequence of actions (a list, starting with the empty one) that 'player'
+              can play with the action points of 'card' has been yielded one at a time.
+              The sequences are explored depth-first on a single copy of this state,
+              each action being applied then taken back, branches without enough
+              action points are cut before being expanded and moves directly
+              cancelling the previous move are skipped.
+        '''
+        budgets, fetter = self._budgets(card)
+        assassins = self._knownassassins(assassins)
+        state = self.copy()
+        state._state['hidden'] = {'assassins': assassins, 'cards': []}
+        yield []
+        yield from state._sequences(player, budgets, fetter, assassins, [], None)
+
+    def _sequences(self, player, budgets, fetter, assassins, prefix, last):
+        # The actions are listed before any is applied, the state changing in between
+        for action, pool, cost, reverse in list(self._actions(player, budgets, fetter, assassins)):
+            if cost > budgets[pool] or action == last:
+                continue
+            record = self.apply(action, player)
+            sequence = prefix + [action]
+            yield sequence
+            budgets[pool] -= cost
+            yield from self._sequences(player, budgets, fetter, assassins, sequence, reverse)
+            budgets[pool] += cost
+            self.undo(record)
 
     def prettyprint(self):
         visible = self._state['visible']
@@ -262,21 +742,696 @@ class KingAndAssassinsState(game.GameState):
             result += '   +{}\n'.format(''.join(['----+' if e == 'G' else '^^^^+' for e in visible['board'][i]]))
         print(result)
 
+    def snapshot(self):
+        visible = self._state['visible']
+        card = visible['card']
+        return (
+            tuple(p for row in visible['people'] for p in row),
+            None if card is None else tuple(card),
+            visible['king'],
+            tuple(visible['arrested']),
+            visible['killed']['knights'],
+            visible['killed']['assassins']
+        )
+
+    def delta(self, old, new):
+        # Only the cells of 'people' that changed, and the arrested villagers since 'old'
+        delta = {}
+        cells = [[i // 10, i % 10, p] for i, (p, q) in enumerate(zip(new[0], old[0])) if p != q]
+        if len(cells) > 0:
+            delta['people'] = cells
+        if new[1] != old[1]:
+            delta['card'] = new[1]
+        if new[2] != old[2]:
+            delta['king'] = new[2]
+        if new[3] != old[3]:
+            delta['arrested'] = new[3][len(old[3]):]
+        if new[4:] != old[4:]:
+            delta['killed'] = {'knights': new[4], 'assassins': new[5]}
+        return delta
+
+    def applydelta(self, delta):
+        state = self._state
+        visible = state['visible']
+        for x, y, p in delta.get('people', []):
+            visible['people'][x][y] = p
+        for key in ('card', 'king', 'killed'):
+            if key in delta:
+                visible[key] = delta[key]
+        visible['arrested'].extend(delta.get('arrested', []))
+        # Engines deriving data from the visible state reload it
+        self._state = state
+        self._hash = None
+        self._where = None
+
+    # Binary encoding: a header with the card index in CARDS, the king status and the
+    # killed counters, then the people (one nibble per cell), the roofs (one bit per
+    # cell), and the castle doors, arrested villagers and last opponent's move, each
+    # preceded by its length. Actions take two bytes: action and direction nibbles,
+    # then the index 10 * x + y of the cell.
+    HEADER = struct.Struct('!BBBB')
+    # Board decoded from its roofs, shared by the decoded states as it never changes
+    _BOARDS = {}
+
+    def encode(self):
+        visible = self._state['visible']
+        card = visible['card']
+        data = bytearray(self.HEADER.pack(
+            NO_CARD if card is None else CARDS.index(tuple(card)),
+            KING_STATUS.index(visible['king']),
+            visible['killed']['knights'],
+            visible['killed']['assassins']
+        ))
+        data += bytes(PEOPLE_BYTES[pair] for row in visible['people'] for pair in zip(row[::2], row[1::2]))
+        # The roofs are only encoded once, for the board they were computed for
+        board = visible['board']
+        if self._roofbytes is None or self._roofbytes[0] is not board:
+            roofs = sum(1 << (10 * x + y) for x, row in enumerate(board) for y, e in enumerate(row) if e == 'R')
+            self._roofbytes = (board, roofs.to_bytes(13, 'big'))
+        data += self._roofbytes[1]
+        data.append(len(visible['castle']))
+        data += KingAndAssassinsState._encodeactions(('door', x, y, d) for x, y, d in visible['castle'])
+        data.append(len(visible['arrested']))
+        data += bytes(PIECE_CODES[p] for p in visible['arrested'])
+        data.append(len(visible['lastopponentmove']))
+        data += KingAndAssassinsState._encodeactions(visible['lastopponentmove'])
+        return bytes(data)
+
+    @classmethod
+    def decode(cls, data):
+        card, king, knights, assassins = cls.HEADER.unpack_from(data)
+        i = cls.HEADER.size
+        cells = []
+        for byte in data[i:i + 50]:
+            cells += PEOPLE_PAIRS[byte]
+        people = [cells[j:j + 10] for j in range(0, 100, 10)]
+        i += 50
+        roofs = data[i:i + 13]
+        board = cls._BOARDS.get(roofs)
+        if board is None:
+            roofs = int.from_bytes(roofs, 'big')
+            board = [['R' if roofs >> (10 * x + y) & 1 else 'G' for y in range(10)] for x in range(10)]
+            cls._BOARDS[data[i:i + 13]] = board
+        i += 13
+        castle = [[x, y, d] for e, x, y, d in cls._decodeactions(data, i + 1, data[i])]
+        i += 1 + 2 * data[i]
+        arrested = [PIECES[e] for e in data[i + 1:i + 1 + data[i]]]
+        i += 1 + data[i]
+        return cls({
+            'board': board,
+            'people': people,
+            'castle': castle,
+            'card': None if card == NO_CARD else list(CARDS[card]),
+            'king': KING_STATUS[king],
+            'lastopponentmove': cls._decodeactions(data, i + 1, data[i]),
+            'arrested': arrested,
+            'killed': {'knights': knights, 'assassins': assassins}
+        })
+
+    # Binary delta: a byte of flags telling which of the card, king status, arrested
+    # villagers and killed counters changed, the changed cells (their number, then the
+    # index and people code of each) and the changed values, in that order.
+    DELTA_CARD, DELTA_KING, DELTA_ARRESTED, DELTA_KILLED = 1, 2, 4, 8
+
+    @classmethod
+    def encodedelta(cls, delta):
+        flags = 0
+        data = bytearray()
+        cells = delta.get('people', [])
+        data.append(len(cells))
+        for x, y, p in cells:
+            data += bytes((10 * x + y, PIECE_CODES[p]))
+        if 'card' in delta:
+            flags |= cls.DELTA_CARD
+            card = delta['card']
+            data.append(NO_CARD if card is None else CARDS.index(tuple(card)))
+        if 'king' in delta:
+            flags |= cls.DELTA_KING
+            data.append(KING_STATUS.index(delta['king']))
+        if 'arrested' in delta:
+            flags |= cls.DELTA_ARRESTED
+            data.append(len(delta['arrested']))
+            data += bytes(PIECE_CODES[p] for p in delta['arrested'])
+        if 'killed' in delta:
+            flags |= cls.DELTA_KILLED
+            data += bytes((delta['killed']['knights'], delta['killed']['assassins']))
+        return bytes([flags]) + bytes(data)
+
+    @classmethod
+    def decodedelta(cls, data):
+        flags, n = data[0], data[1]
+        delta = {}
+        if n > 0:
+            delta['people'] = [[*CELLS[data[j]], PIECES[data[j + 1]]] for j in range(2, 2 + 2 * n, 2)]
+        i = 2 + 2 * n
+        if flags & cls.DELTA_CARD:
+            delta['card'] = None if data[i] == NO_CARD else list(CARDS[data[i]])
+            i += 1
+        if flags & cls.DELTA_KING:
+            delta['king'] = KING_STATUS[data[i]]
+            i += 1
+        if flags & cls.DELTA_ARRESTED:
+            delta['arrested'] = [PIECES[e] for e in data[i + 1:i + 1 + data[i]]]
+            i += 1 + data[i]
+        if flags & cls.DELTA_KILLED:
+            delta['killed'] = {'knights': data[i], 'assassins': data[i + 1]}
+        return delta
+
+    @staticmethod
+    def _encodeactions(actions):
+        data = bytearray()
+        for action in actions:
+            data.append(ACTION_BYTES[action[0], action[3] if len(action) > 3 else None])
+            data.append(10 * int(action[1]) + int(action[2]))
+        return data
+
+    @staticmethod
+    def _decodeactions(data, i, n):
+        actions = []
+        for j in range(i, i + 2 * n, 2):
+            name, direction = ACTION_NAMES[data[j]]
+            x, y = CELLS[data[j + 1]]
+            actions.append([name, x, y] if direction is None else [name, x, y, direction])
+        return actions
+
+    @classmethod
+    def encodemove(cls, move):
+        # Moves are encoded from their dictionary, only the JSON ones are parsed first
+        if isinstance(move, str):
+            move = json.loads(move)
+        if 'assassins' in move:
+            return b'S' + bytes([len(move['assassins'])]) + bytes(PIECE_CODES[p] for p in move['assassins'])
+        return b'A' + bytes([len(move['actions'])]) + cls._encodeactions(move['actions'])
+
+    @classmethod
+    def decodemove(cls, data):
+        try:
+            if data[:1] == b'S':
+                return {'assassins': [PIECES[e] for e in data[2:2 + data[1]]]}
+            if data[:1] == b'A':
+                return {'actions': cls._decodeactions(data, 2, data[1])}
+        except (IndexError, KeyError, ValueError):
+            pass
+        raise game.InvalidMoveException('A valid binary move must start with S or A followed by its length')
+
     @classmethod
     def buffersize(cls):
         return BUFFER_SIZE
 
 
+def _bits(mask):
+    # Yield the index of each set bit of 'mask', lowest first
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def _neighbours(d):
+    dx, dy = KingAndAssassinsState.DIRECTIONS[d]
+    return tuple(
+        10 * (i // 10 + dx) + i % 10 + dy if 0 <= i // 10 + dx <= 9 and 0 <= i % 10 + dy <= 9 else -1
+        for i in range(100)
+    )
+
+
+class BitboardKingAndAssassinsState(KingAndAssassinsState):
+    '''Class representing a state for the King & Assassins game stored as bitboards.
+
+    The king, the knights, the hidden villagers, the revealed assassins and the
+    roofs are each kept as a 100-bit integer where bit 10 * x + y stands for the
+    cell (x, y). The 'people' grid of the visible state is only rebuilt from the
+    masks when the state is read through '_state' (for example to be serialised).
+    '''
+
+    # NEIGHBOURS[d][i] is the index of the cell next to cell i in direction d, or -1
+    NEIGHBOURS = {d: _neighbours(d) for d in KingAndAssassinsState.DIRECTIONS}
+
+    def __init__(self, initialstate=KA_INITIAL_STATE):
+        super().__init__(initialstate)
+
+    @property
+    def _state(self):
+        if self._dirty:
+            self._data['visible']['people'] = self._peoplegrid()
+            self._dirty = False
+        return self._data
+
+    @_state.setter
+    def _state(self, state):
+        visible = dict(state['visible'])
+        visible['arrested'] = list(visible['arrested'])
+        visible['killed'] = dict(visible['killed'])
+        self._data = {'visible': visible, 'hidden': state['hidden']}
+        self._visible = visible
+        self._king = self._knights = self._villagers = self._assassins = 0
+        # Name of the villager on each cell, and the other way round
+        self._names = {}
+        self._cells = {}
+        self._roofs = 0
+        for x in range(10):
+            for y in range(10):
+                i = 10 * x + y
+                if visible['board'][x][y] == 'R':
+                    self._roofs |= 1 << i
+                p = visible['people'][x][y]
+                if p == 'king':
+                    self._king |= 1 << i
+                elif p == 'knight':
+                    self._knights |= 1 << i
+                elif p == 'assassin':
+                    self._assassins |= 1 << i
+                elif p is not None:
+                    self._villagers |= 1 << i
+                    self._names[i] = p
+                    self._cells[p] = i
+        self._doors = 0
+        for door in visible['castle']:
+            x, y = self._getcoord(door)
+            self._doors |= 1 << (10 * x + y)
+        self._countcaught()
+        self._hash = None
+        # The input grid is never modified, a fresh one is built on first access
+        self._dirty = True
+
+    def _countcaught(self):
+        hidden = self._data['hidden']
+        assassins = hidden['assassins'] if hidden is not None else None
+        self._caught = len(set(self._visible['arrested']) & assassins) if assassins else 0
+
+    def _peoplegrid(self):
+        people = [[None] * 10 for row in range(10)]
+        for i in _bits(self._king):
+            people[i // 10][i % 10] = 'king'
+        for i in _bits(self._knights):
+            people[i // 10][i % 10] = 'knight'
+        for i in _bits(self._assassins):
+            people[i // 10][i % 10] = 'assassin'
+        for i, name in self._names.items():
+            people[i // 10][i % 10] = name
+        return people
+
+    def copy(self):
+        state = object.__new__(self.__class__)
+        state.__dict__.update(self.__dict__)
+        visible = dict(self._visible)
+        visible['arrested'] = list(visible['arrested'])
+        visible['killed'] = dict(visible['killed'])
+        hidden = self._data['hidden']
+        if hidden is not None:
+            hidden = {'assassins': hidden['assassins'], 'cards': list(hidden['cards'])}
+        state._data = {'visible': visible, 'hidden': hidden}
+        state._visible = visible
+        state._names = dict(self._names)
+        state._cells = dict(self._cells)
+        state._dirty = True
+        return state
+
+    def _cellat(self, x, y):
+        return self._pieceat(10 * x + y)
+
+    def _isroof(self, x, y):
+        return self._roofs >> (10 * x + y) & 1
+
+    def _positions(self, player):
+        if player == 1:
+            for i in _bits(self._king):
+                yield i // 10, i % 10, 'king'
+            for i in _bits(self._knights):
+                yield i // 10, i % 10, 'knight'
+        else:
+            for i in _bits(self._assassins):
+                yield i // 10, i % 10, 'assassin'
+            for i in _bits(self._villagers):
+                yield i // 10, i % 10, self._names[i]
+
+    def _occupied(self):
+        return self._king | self._knights | self._villagers | self._assassins
+
+    def _pieceat(self, i):
+        if self._villagers >> i & 1:
+            return self._names[i]
+        if self._knights >> i & 1:
+            return 'knight'
+        if self._assassins >> i & 1:
+            return 'assassin'
+        if self._king >> i & 1:
+            return 'king'
+        return None
+
+    def _step(self, move, i, d):
+        n = self.NEIGHBOURS[d][i]
+        if n < 0:
+            raise game.InvalidMoveException('{}: cannot go outside of the board'.format(move))
+        return n
+
+    def _move(self, src, dst):
+        # Move the piece on cell 'src' to the free cell 'dst'
+        bits = (1 << src) | (1 << dst)
+        if self._villagers >> src & 1:
+            self._villagers ^= bits
+            p = self._names[dst] = self._names.pop(src)
+            self._cells[p] = dst
+        elif self._knights >> src & 1:
+            self._knights ^= bits
+            p = 'knight'
+        elif self._assassins >> src & 1:
+            self._assassins ^= bits
+            p = 'assassin'
+        else:
+            self._king ^= bits
+            p = 'king'
+        if self._hash is not None:
+            self._hash ^= ZOBRIST_PEOPLE[PIECE_CODES[p]][src] ^ ZOBRIST_PEOPLE[PIECE_CODES[p]][dst]
+
+    def _nextfreecell(self, i, d):
+        step = self.NEIGHBOURS[d]
+        occupied = self._occupied()
+        n = j = step[i]
+        while j >= 0 and occupied >> j & 1:
+            # Must be a villager
+            if not self._villagers >> j & 1:
+                return -1
+            # Cannot be a roof
+            if j != n and self._roofs >> j & 1:
+                return -1
+            j = step[j]
+        return j
+
+    def _nextfree(self, x, y, d):
+        i = self._nextfreecell(10 * x + y, d)
+        return None if i < 0 else (i // 10, i % 10)
+
+    def update(self, moves, player):
+        # A move is played as a whole or not at all
+        records = []
+        try:
+            for move in moves:
+                # None would end the turn in apply()
+                if move is None:
+                    raise game.InvalidMoveException('None is not an action')
+                records.append(self.apply(move, player))
+        except Exception:
+            for record in reversed(records):
+                self.undo(record)
+            raise
+        # If assassins' team just played, draw a new card
+        if player == 0:
+            self._drawcard(self._visible, self._data['hidden'])
+
+    def _hashcell(self, p, i):
+        if self._hash is not None:
+            self._hash ^= ZOBRIST_PEOPLE[PIECE_CODES[p]][i]
+
+    def _playaction(self, move, player):
+        visible = self._visible
+        hidden = self._data['hidden']
+        # ('move', x, y, dir): moves person at position (x,y) of one cell in direction dir
+        if move[0] == 'move':
+            x, y, d = int(move[1]), int(move[2]), move[3]
+            self._checkcell(move, x, y)
+            i = 10 * x + y
+            occupied = self._occupied()
+            if not occupied >> i & 1:
+                raise game.InvalidMoveException('{}: there is no one to move'.format(move))
+            n = self._step(move, i, d)
+            free = not occupied >> n & 1
+            # King, assassins, villagers can only move on a free cell
+            if not self._knights >> i & 1 and not free:
+                raise game.InvalidMoveException('{}: cannot move on a cell that is not free'.format(move))
+            if self._king >> i & 1 and self._roofs >> n & 1:
+                raise game.InvalidMoveException('{}: the king cannot move on a roof'.format(move))
+            if (self._villagers | self._assassins) >> i & 1 and player != 0:
+                raise game.InvalidMoveException('{}: villagers and assassins can only be moved by player 0'.format(move))
+            if (self._king | self._knights) >> i & 1 and player != 1:
+                raise game.InvalidMoveException('{}: the king and knights can only be moved by player 1'.format(move))
+            # Move granted if cell is free
+            if free:
+                self._move(i, n)
+            # If cell is not free, the knight pushes the villagers up to the next free cell
+            else:
+                f = self._nextfreecell(i, d)
+                if f < 0:
+                    raise game.InvalidMoveException('{}: cannot move-and-push in the given direction'.format(move))
+                back = self.NEIGHBOURS[self.OPPOSITE[d]]
+                while f != i:
+                    self._move(back[f], f)
+                    f = back[f]
+        # ('arrest', x, y, dir): arrests the villager in direction dir with knight at position (x, y)
+        elif move[0] == 'arrest':
+            if player != 1:
+                raise game.InvalidMoveException('arrest action only possible for player 1')
+            x, y, d = int(move[1]), int(move[2]), move[3]
+            self._checkcell(move, x, y)
+            i = 10 * x + y
+            if not self._knights >> i & 1:
+                raise game.InvalidMoveException('{}: the attacker is not a knight'.format(move))
+            t = self._step(move, i, d)
+            if not self._villagers >> t & 1:
+                raise game.InvalidMoveException('{}: only villagers can be arrested'.format(move))
+            name = self._names.pop(t)
+            del self._cells[name]
+            self._villagers ^= 1 << t
+            self._hashcell(name, t)
+            visible['arrested'].append(name)
+            if self._hash is not None:
+                self._hash ^= ZOBRIST_ARRESTED[name]
+            if hidden is not None and hidden['assassins'] and name in hidden['assassins']:
+                self._caught += 1
+        # ('kill', x, y, dir): kills the assassin/knight in direction dir with knight/assassin at position (x, y)
+        elif move[0] == 'kill':
+            x, y, d = int(move[1]), int(move[2]), move[3]
+            self._checkcell(move, x, y)
+            i = 10 * x + y
+            assassin = self._assassins >> i & 1
+            knight = self._knights >> i & 1
+            if assassin and player != 0:
+                raise game.InvalidMoveException('{}: kill action for assassin only possible for player 0'.format(move))
+            if knight and player != 1:
+                raise game.InvalidMoveException('{}: kill action for knight only possible for player 1'.format(move))
+            t = self._step(move, i, d)
+            if not self._occupied() >> t & 1:
+                raise game.InvalidMoveException('{}: there is no one to kill'.format(move))
+            if assassin and self._knights >> t & 1:
+                visible['killed']['knights'] += 1
+                self._knights ^= 1 << t
+                self._hashcell('knight', t)
+            elif knight and self._assassins >> t & 1:
+                visible['killed']['assassins'] += 1
+                self._assassins ^= 1 << t
+                self._hashcell('assassin', t)
+            else:
+                raise game.InvalidMoveException('{}: forbidden kill'.format(move))
+        # ('attack', x, y, dir): attacks the king in direction dir with assassin at position (x, y)
+        elif move[0] == 'attack':
+            if player != 0:
+                raise game.InvalidMoveException('attack action only possible for player 0')
+            x, y, d = int(move[1]), int(move[2]), move[3]
+            self._checkcell(move, x, y)
+            i = 10 * x + y
+            if not self._assassins >> i & 1:
+                raise game.InvalidMoveException('{}: the attacker is not an assassin'.format(move))
+            if not self._king >> self._step(move, i, d) & 1:
+                raise game.InvalidMoveException('{}: only the king can be attacked'.format(move))
+            self._setking(visible, 'injured' if visible['king'] == 'healthy' else 'dead')
+        # ('reveal', x, y): reveals villager at position (x,y) as an assassin
+        elif move[0] == 'reveal':
+            if player != 0:
+                raise game.InvalidMoveException('raise action only possible for player 0')
+            x, y = int(move[1]), int(move[2])
+            self._checkcell(move, x, y)
+            i = 10 * x + y
+            assassins = hidden['assassins'] if hidden is not None else None
+            if not assassins or self._names.get(i) not in assassins:
+                raise game.InvalidMoveException('{}: the specified villager is not an assassin'.format(move))
+            name = self._names.pop(i)
+            del self._cells[name]
+            self._hashcell(name, i)
+            self._villagers ^= 1 << i
+            self._assassins |= 1 << i
+            self._hashcell('assassin', i)
+        self._dirty = True
+
+    def winner(self):
+        # The king reached the castle
+        if self._king & self._doors:
+            return 1
+        # The are no more cards
+        if len(self._data['hidden']['cards']) == 0:
+            return 0
+        # The king has been killed
+        if self._visible['king'] == 'dead':
+            return 0
+        # All the assassins have been arrested or killed
+        if self._visible['killed']['assassins'] + self._caught == 3:
+            return 1
+        return -1
+
+    def apply(self, action, player):
+        record = self._record()
+        try:
+            if action is not None:
+                self._playaction(action, player)
+            elif player == 0:
+                self._drawcard(self._visible, self._data['hidden'])
+        except Exception:
+            self.undo(record)
+            raise
+        return record
+
+    def _record(self):
+        # The masks are immutable integers, only the names and their cells need copying
+        visible = self._visible
+        hidden = self._data['hidden']
+        return (self._hash, self._caught, visible['card'], 0 if hidden is None else len(hidden['cards']),
+                visible['king'], len(visible['arrested']), visible['killed']['knights'], visible['killed']['assassins'],
+                self._king, self._knights, self._villagers, self._assassins, dict(self._names), dict(self._cells))
+
+    def undo(self, record):
+        visible = self._visible
+        (self._hash, self._caught, card, cards, visible['king'], arrested, knights, assassins,
+         self._king, self._knights, self._villagers, self._assassins, names, cells) = record
+        self._names, self._cells = names, cells
+        if cards > 0 and len(self._data['hidden']['cards']) < cards:
+            self._data['hidden']['cards'].append(visible['card'])
+        visible['card'] = card
+        del visible['arrested'][arrested:]
+        visible['killed']['knights'], visible['killed']['assassins'] = knights, assassins
+        self._dirty = True
+
+    def position(self, name):
+        if name == 'king':
+            i = self._king.bit_length() - 1
+            return None if i < 0 else (i // 10, i % 10)
+        i = self._cells.get(name)
+        return None if i is None else (i // 10, i % 10)
+
+    def knightcells(self):
+        return frozenset((i // 10, i % 10) for i in _bits(self._knights))
+
+    def assassinsleft(self):
+        return 3 - self._visible['killed']['assassins'] - self._caught
+
+    def isinitial(self):
+        return self._data['hidden']['assassins'] is None
+
+    def setassassins(self, assassins):
+        self._data['hidden']['assassins'] = set(assassins)
+        self._countcaught()
+
+
 class KingAndAssassinsServer(game.GameServer):
     '''Class representing a server for the King & Assassins game'''
 
-    def __init__(self, verbose=False):
-        super().__init__('King & Assassins', 2, KingAndAssassinsState(), verbose=verbose)
+    # Replay header: seed (if any), order of the cards as indices in CARDS, villagers
+    # in sorted(VILLAGERS) order and assassins (sorted) as codes of PIECES
+    REPLAY_HEADER = struct.Struct('!?q{}B{}B3B'.format(len(CARDS), len(VILLAGERS)))
+    # Replay summary, after the result (see lib.game.RESULT): turns, knights and assassins
+    # killed, villagers and assassins arrested, and number of cells of the king's path,
+    # followed by these cells (10 * x + y, 255 off the board)
+    REPLAY_SUMMARY = struct.Struct('!HBBBBH')
+
+    def __init__(self, verbose=False, stateclass=KingAndAssassinsState, seed=None, recorder=None,
+                 layout=None, cards=None, latency=None, timecontrol=None):
+        # Games must not share the mutable parts of the initial state
+        initialstate = copy.deepcopy(KA_INITIAL_STATE)
+        # Every game has its own villagers' layout and cards' order, which only depend on
+        # the seed when one is given
+        rng = random if seed is None else random.Random(seed)
+        placevillagers(initialstate['people'], rng)
+        # A layout or cards given explicitly, to replay a game, replace the random ones
+        if layout is not None:
+            for name, (x, y) in zip(layout, sorted(VILLAGERS)):
+                initialstate['people'][x][y] = name
+        super().__init__('King & Assassins', 2, stateclass(initialstate), verbose=verbose, recorder=recorder,
+                         latency=latency, timecontrol=timecontrol)
+        cards = rng.sample(CARDS, len(CARDS)) if cards is None else list(cards)
         self._state._state['hidden'] = {
             'assassins': None,
-            'cards': random.sample(CARDS, len(CARDS))
+            'cards': cards
+        }
+        self.__seed = seed
+        self.__layout = tuple(initialstate['people'][x][y] for x, y in sorted(VILLAGERS))
+        self.__cards = tuple(cards)
+        # Cell of the king at the start and after each of its turns
+        self.__kingpath = [self.__kingcell()]
+
+    def replayheader(self):
+        hidden = self._state._state['hidden']
+        assassins = sorted(hidden['assassins']) if hidden['assassins'] is not None else [None] * 3
+        seed = self.__seed if isinstance(self.__seed, int) and -2 ** 63 <= self.__seed < 2 ** 63 else None
+        return self.REPLAY_HEADER.pack(
+            seed is not None, 0 if seed is None else seed,
+            *[CARDS.index(tuple(card)) for card in self.__cards],
+            *[PIECE_CODES[p] for p in self.__layout],
+            *[PIECE_CODES[p] for p in assassins]
+        )
+
+    @classmethod
+    def readreplayheader(cls, header):
+        '''Return the content of a header written by replayheader().
+        Pre: 'header' is bytes returned by replayheader().
+        Post: The returned value is a dictionary with the 'seed' (or None), the 'cards'
+              in the order they are drawn from the end, the 'layout' of the villagers
+              in sorted(VILLAGERS) order and the 'assassins' (or None).
+        '''
+        values = cls.REPLAY_HEADER.unpack(header)
+        cards, layout = len(CARDS), len(VILLAGERS)
+        assassins = [PIECES[code] for code in values[2 + cards + layout:]]
+        return {
+            'seed': values[1] if values[0] else None,
+            'cards': [CARDS[i] for i in values[2:2 + cards]],
+            'layout': [PIECES[code] for code in values[2 + cards:2 + cards + layout]],
+            'assassins': None if None in assassins else assassins
         }
 
+    def replaysummary(self):
+        state = self._state
+        visible = state._state['visible']
+        return super().replaysummary() + self.REPLAY_SUMMARY.pack(
+            self.turns, visible['killed']['knights'], visible['killed']['assassins'],
+            len(visible['arrested']), state._caught, len(self.__kingpath)
+        ) + bytes(self.__kingpath)
+
+    @classmethod
+    def readreplaysummary(cls, summary):
+        '''Return the content of a summary written by replaysummary().
+        Pre: 'summary' is bytes returned by replaysummary().
+        Post: The returned value is the dictionary of GameServer.readreplaysummary, with
+              the 'turns', 'killedknights', 'killedassassins', 'arrested', 'arrestedassassins'
+              and the 'kingpath', the list of the cells (10 * x + y) of the king at the
+              start and after each of its turns.
+        '''
+        content = super().readreplaysummary(summary)
+        offset = game.RESULT.size
+        turns, knights, assassins, arrested, caught, length = cls.REPLAY_SUMMARY.unpack_from(summary, offset)
+        offset += cls.REPLAY_SUMMARY.size
+        content.update({
+            'turns': turns,
+            'killedknights': knights,
+            'killedassassins': assassins,
+            'arrested': arrested,
+            'arrestedassassins': caught,
+            'kingpath': list(summary[offset:offset + length])
+        })
+        return content
+
+    @classmethod
+    def fromreplay(cls, header, turns, summary=b'', stateclass=KingAndAssassinsState):
+        '''Return a server where a recorded game has been replayed.
+        Pre: 'header', 'turns' and 'summary' are a game read from a replay file (see lib.replay).
+        Post: The returned server is in the state where the game ended, with the
+              recorded winner and forfeiting player when the summary gives them.
+        '''
+        content = cls.readreplayheader(header)
+        server = cls(stateclass=stateclass, seed=content['seed'], layout=content['layout'], cards=content['cards'])
+        server.replay(turns, summary)
+        return server
+
+    def __kingcell(self):
+        cell = self._state.position('king')
+        return 255 if cell is None else 10 * cell[0] + cell[1]
+
     def _setassassins(self, move):
         state = self._state
         if 'assassins' not in move:
@@ -291,14 +1446,29 @@ class KingAndAssassinsServer(game.GameServer):
         state.setassassins(move['assassins'])
         state.update([], 0)
 
+    def defaultmove(self, player):
+        # A player out of time passes its turn, except for choosing the assassins
+        if self._state.isinitial():
+            return None
+        return json.dumps({'actions': []})
+
     def applymove(self, move):
         try:
             state = self._state
-            move = json.loads(move)
+            # Moves decoded by the binary codec are already dictionaries
+            if isinstance(move, str):
+                move = json.loads(move)
+            if self.latency is not None:
+                self.latency.lap('parse')
+            # Longer moves could not be recorded, no turn has that many action points
+            if len(move.get('assassins' if state.isinitial() else 'actions', ())) > MAX_ACTIONS:
+                raise game.InvalidMoveException('A move cannot have more than {} actions'.format(MAX_ACTIONS))
             if state.isinitial():
                 self._setassassins(move)
             else:
                 self._state.update(move['actions'], self.currentplayer)
+                if self.currentplayer == 1:
+                    self.__kingpath.append(self.__kingcell())
         except game.InvalidMoveException as e:
             raise e
         except Exception as e:
@@ -309,9 +1479,16 @@ class KingAndAssassinsServer(game.GameServer):
 class KingAndAssassinsClient(game.GameClient):
     '''Class representing a client for the King & Assassins game'''
 
-    def __init__(self, name, server, verbose=False):
-        super().__init__(server, KingAndAssassinsState, verbose=verbose)
+    def __init__(self, name, server, verbose=False, latency=None, games=1):
         self.__name = name
+        super().__init__(server, KingAndAssassinsState, verbose=verbose, latency=latency, games=games)
+
+    def _newgame(self):
+        # The strategy keeps the data of the current game in module globals
+        global TURN, path, assassins
+        TURN = -1
+        path = []
+        assassins = []
 
     def _handle(self, message):
         pass
@@ -330,25 +1507,15 @@ class KingAndAssassinsClient(game.GameClient):
         global TURN
         TURN += 1
 
+        view = state
         state = state._state['visible']
 
         def findPos(character):
-            #Function to find character's position
-            l = 0
-            position = []
-            for line in state['people']:
-                l += 1
-                c = 0
-                for n in line :
-                    c += 1
-                    if character == 'knight':
-                        if n == 'knight':
-                            position.append((l-1, c-1))
-
-                    else:
-                        if n == character:
-                            return l-1, c-1
-            return position
+            #Function to find character's position, looked up in the state's index
+            if character == 'knight':
+                return sorted(view.knightcells())
+            position = view.position(character)
+            return [] if position is None else position
 
         def findCharacter(pos):
             return state['people'][pos[0]][pos[1]]
@@ -421,37 +1588,17 @@ class KingAndAssassinsClient(game.GameClient):
             return knightarround
 
         def Goto(start, finish, direction):
-            deltaline = start[0] - finish[0]
-            deltacolu = start[1] - finish[1]
-
-
-            pathv = []
-            for n in range(start[0], finish[0]):
-                pathv.append(n)
-            pathh = []
-            for n in range(start[1], finish[1]):
-                pathh.append(n)
-
-            if pathv[0] == 'G' and pathv[1] == 'R':
-                APv = 2
-            else:
-                APv = 1
-            if pathh[0] == 'G' and pathh[1] == 'R':
-                APh = 2
+            # Number of cells, direction and action points to line up with finish,
+            # vertically ('V') or horizontally ('H'), looked up in the path tables
+            if direction == 'V':
+                delta, target = finish[0] - start[0], (finish[0], start[1])
+                move = 'S' if delta > 0 else 'N'
             else:
-                APh = 1
-
-
-            # Horizontal move
-            if deltaline < 0 and direction == 'V':
-                return -deltaline, 'N', APv
-            elif deltaline > 0 and direction == 'V':
-                return deltaline, 'S', APv
-            # Vertical move
-            elif deltacolu < 0 and direction == 'H':
-                return -deltacolu, 'E', APh
-            elif deltacolu < 0 and direction == 'H':
-                return deltacolu, 'W', APh
+                delta, target = finish[1] - start[1], (start[0], finish[1])
+                move = 'E' if delta > 0 else 'W'
+            if delta == 0:
+                return 0, None, 0
+            return abs(delta), move, pathcost(start, target, king=findCharacter(start) == 'king')
 
         # Initializing turn _ Choice of assassins
         if state['card'] is None:
@@ -564,6 +1711,44 @@ class KingAndAssassinsClient(game.GameClient):
 
                 return json.dumps({'actions': actionslistking}, separators=(',', ':'))
 
+class RandomKingAndAssassinsClient(KingAndAssassinsClient):
+    '''Class representing a client playing random legal moves for the King & Assassins game'''
+
+    def __init__(self, name, server, verbose=False, seed=None, latency=None, games=1):
+        self.__random = random.Random(seed)
+        self.__assassins = None
+        super().__init__(name, server, verbose=verbose, latency=latency, games=games)
+
+    def _newgame(self):
+        super()._newgame()
+        self.__assassins = None
+
+    def _nextmove(self, state):
+        player = self._playernb
+        if state._state['visible']['card'] is None:
+            self.__assassins = self.chooseassassins(state)
+            return {'assassins': self.__assassins}
+        # Play random actions until no action point is left
+        state = state.copy()
+        state._state['hidden'] = {'assassins': self.__assassins, 'cards': []}
+        budgets, fetter = state._budgets(None)
+        actions = []
+        while True:
+            choices = [c for c in state._actions(player, budgets, fetter, self.__assassins) if c[2] <= budgets[c[1]]]
+            if len(choices) == 0:
+                break
+            action, pool, cost, reverse = self.__random.choice(choices)
+            state._playaction(action, player)
+            budgets[pool] -= cost
+            actions.append(action)
+        return {'actions': actions}
+
+    def chooseassassins(self, state):
+        '''Return the names of the three villagers chosen as assassins.'''
+        villagers = sorted(p for row in state._state['visible']['people'] for p in row if p in POPULATION)
+        return self.__random.sample(villagers, 3)
+
+
 if __name__ == '__main__':
     # Create the top-level parser
     parser = argparse.ArgumentParser(description='King & Assassins game')
@@ -577,6 +1762,13 @@ if __name__ == '__main__':
     server_parser = subparsers.add_parser('server', help='launch a server')
     server_parser.add_argument('--host', help='hostname (default: localhost)', default='localhost')
     server_parser.add_argument('--port', help='port to listen on (default: 5000)', default=5000)
+    server_parser.add_argument('--ladder', action='store_true', help='host many concurrent games')
+    server_parser.add_argument('--record', help='append the games played to this replay file')
+    server_parser.add_argument('--latency', help='write the timings of each turn to this file, as JSON lines')
+    server_parser.add_argument('--movetime', type=float, help='seconds per move (default: no limit)')
+    server_parser.add_argument('--gametime', type=float, help='seconds per player for a whole game (default: no limit)')
+    server_parser.add_argument('--ontimeout', choices=('forfeit', 'pass'), default='forfeit',
+                               help='what happens to a player out of time (default: forfeit)')
     server_parser.add_argument('-v', '--verbose', action='store_true')
     # Create the parser for the 'client' subcommand
     client_parser = subparsers.add_parser('client', help='launch a client')
@@ -584,14 +1776,40 @@ if __name__ == '__main__':
     client_parser.add_argument('--host', help='hostname of the server (default: localhost)',
                                default=socket.gethostbyname(socket.gethostname()))
     client_parser.add_argument('--port', help='port of the server (default: 5000)', default=5000)
+    client_parser.add_argument('--latency', help='write the timings of each turn to this file, as JSON lines')
+    client_parser.add_argument('--games', type=int, default=1,
+                               help='games to play on the connection if the server allows it, 0 for no limit (default: 1)')
     client_parser.add_argument('-v', '--verbose', action='store_true')
     # Parse the arguments of sys.args
     args = parser.parse_args()
 
-    if args.component == 'server':
-        KingAndAssassinsServer(verbose=args.verbose).run()
-    else:
-        KingAndAssassinsClient(args.name, (args.host, args.port), verbose=args.verbose)
+    # Each game has its own timings, all written to the same file
+    timings = None if args.latency is None else open(args.latency, 'a')
+    newlatency = lambda: None if timings is None else latency.Latency(latency.JsonLinesSink(timings))
+    try:
+        if args.component == 'server':
+            recorder = None if args.record is None else replay.ReplayWriter(args.record)
+            timecontrol = None
+            if args.movetime is not None or args.gametime is not None:
+                timecontrol = game.TimeControl(args.movetime, args.gametime, args.ontimeout)
+            try:
+                if args.ladder:
+                    factory = lambda: KingAndAssassinsServer(recorder=recorder, latency=newlatency(),
+                                                             timecontrol=timecontrol)
+                    game.AsyncGameServer(factory, args.host, int(args.port), verbose=args.verbose).run()
+                else:
+                    KingAndAssassinsServer(verbose=args.verbose, recorder=recorder, latency=newlatency(),
+                                           timecontrol=timecontrol).run()
+            finally:
+                if recorder is not None:
+                    recorder.close()
+        else:
+            KingAndAssassinsClient(args.name, (args.host, args.port), verbose=args.verbose, latency=newlatency(),
+                                   games=args.games or None)
+    finally:
+        if timings is not None:
+            timings.write(json.dumps({'event': 'process', 'phases': latency.processsnapshot()}) + '\n')
+            timings.close()
 
 
 # Path : 2BA\AdvancedPython2BA_Q2\"Projet King&Assassin's"
@@ -3,10 +3,16 @@
 # Version: April 20, 2016
 
 from abc import *
+import asyncio
 import copy
 import json
+import queue
 import socket
+import struct
 import sys
+import threading
+import time
+import zlib
 
 DEFAULT_BUFFER_SIZE = 1024
 SECTION_WIDTH = 60
@@ -23,6 +29,347 @@ class InvalidMoveException(Exception):
         super().__init__(message)
 
 
+# Option of the READY message asking for length-prefixed messages
+FRAMED_OPTION = '+framed'
+# Option of the READY message asking for DELTA messages instead of full PLAY states
+DELTA_OPTION = '+delta'
+# Option of the READY message asking for the binary codec of the state class (needs framing).
+# With DELTA_OPTION too, the DELTA messages are encoded with the binary codec as well.
+BINARY_OPTION = '+binary'
+# Option of the READY message asking to play the next games on the same connection (needs framing)
+SESSION_OPTION = '+session'
+# Seconds given to a player of a session to ask for another game
+SESSION_TIMEOUT = 10
+# Summary of a recorded game: winner (DRAW for a draw, -1 if not over) and forfeiting player (-1 if none)
+RESULT = struct.Struct('!bb')
+DRAW = -2
+# Seconds given to the clients of runconnected() to end once the game is over
+CLIENT_TIMEOUT = 10
+# Invalid moves in a row after which a player loses the game, as if out of time
+MAX_INVALID_MOVES = 10
+
+
+def _parseready(data):
+    # Split a READY message into (ready, name, options)
+    data = data.split(' ')
+    options = [e for e in data[1:] if e.startswith('+')]
+    names = [e for e in data[1:] if not e.startswith('+')]
+    return data[0] == 'READY', names[0] if len(names) == 1 else 'Anonymous', options
+
+
+class Connection:
+    '''Class representing a connection exchanging text messages over a socket.
+
+    A message is sent as is and read with a single recv, unless the connection is
+    framed: each message is then preceded by its length on 4 bytes (big-endian) and
+    the received bytes are buffered, so that messages split over several reads or
+    received together are all parsed correctly, whatever their size.
+
+    Framing is negotiated during the handshake: the client adds FRAMED_OPTION to its
+    READY message and a server supporting it answers with a 'FRAMED' message, after
+    which both sides only send frames.
+    '''
+    HEADER = struct.Struct('!I')
+
+    def __init__(self, sock, buffersize=DEFAULT_BUFFER_SIZE):
+        self.__socket = sock
+        self.__buffersize = buffersize
+        self.__buffer = bytearray()
+        self.__requested = False
+        self.__deadline = None
+        self.__timeout = None
+        self.framed = False
+
+    def requestframing(self):
+        '''Switch to framing if the next message received is the server's 'FRAMED'.'''
+        self.__requested = True
+
+    def send(self, message):
+        data = message.encode() if isinstance(message, str) else message
+        if self.framed:
+            data = Connection.HEADER.pack(len(data)) + data
+        self.__socket.sendall(data)
+
+    def recv(self):
+        return self.recvbytes().decode()
+
+    def recvbytes(self, timeout=None):
+        '''Return the next message, as bytes.
+        Raises TimeoutError: If no whole message is received within 'timeout' seconds (None
+                             for no limit), the bytes received being kept for the next call.
+        Raises ConnectionError: If the other end closed the connection.
+        '''
+        self.__deadline = None if timeout is None else time.perf_counter() + timeout
+        if self.framed:
+            return self.__recvframe()
+        data = bytes(self.__buffer) if len(self.__buffer) > 0 else self.__recv(self.__buffersize)
+        self.__buffer.clear()
+        if len(data) == 0:
+            raise ConnectionError('Connection closed by peer')
+        if self.__requested:
+            self.__requested = False
+            # The frames following 'FRAMED' may have been received with it
+            if data.startswith(b'FRAMED'):
+                self.framed = True
+                self.__buffer += data[len(b'FRAMED'):]
+                return self.__recvframe()
+        return data
+
+    def __recvframe(self):
+        buffer = self.__buffer
+        header = Connection.HEADER.size
+        while True:
+            if len(buffer) >= header:
+                size = header + Connection.HEADER.unpack_from(buffer)[0]
+                if len(buffer) >= size:
+                    message = bytes(buffer[header:size])
+                    del buffer[:size]
+                    return message
+                # Read the rest of a large message at once
+                missing = size - len(buffer)
+            else:
+                missing = 0
+            data = self.__recv(max(missing, self.__buffersize))
+            if len(data) == 0:
+                raise ConnectionError('Connection closed by peer')
+            buffer += data
+
+    def __recv(self, size):
+        # The socket only has a timeout while a deadline is set
+        timeout = None
+        if self.__deadline is not None:
+            timeout = self.__deadline - time.perf_counter()
+            if timeout <= 0:
+                raise TimeoutError('No message received in time')
+        if timeout is not None or self.__timeout is not None:
+            self.__socket.settimeout(timeout)
+            self.__timeout = timeout
+        return self.__socket.recv(size)
+
+    def getpeername(self):
+        return self.__socket.getpeername()
+
+    def close(self):
+        self.__socket.close()
+
+
+class AsyncConnection:
+    '''Class representing a Connection on asyncio streams, used by AsyncGameServer.'''
+    def __init__(self, reader, writer, buffersize=DEFAULT_BUFFER_SIZE):
+        self.reader = reader
+        self.writer = writer
+        self.__buffersize = buffersize
+        # Size of the frame whose header has been read, while waiting for its content
+        self.__size = None
+        self.framed = False
+        # Options of the READY message, once the player has started its first game
+        self.options = None
+        self.session = False
+
+    async def send(self, message):
+        data = message.encode() if isinstance(message, str) else message
+        if self.framed:
+            data = Connection.HEADER.pack(len(data)) + data
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def recv(self, timeout=None):
+        return (await self.recvbytes(timeout)).decode()
+
+    async def recvbytes(self, timeout=None):
+        '''Return the next message, as bytes.
+        Raises TimeoutError: If no whole message is received within 'timeout' seconds (None
+                             for no limit), the bytes received being kept for the next call.
+        '''
+        if timeout is None:
+            return await self.__recvbytes()
+        try:
+            return await asyncio.wait_for(self.__recvbytes(), max(timeout, 0))
+        except asyncio.TimeoutError:
+            raise TimeoutError('No message received in time')
+
+    async def __recvbytes(self):
+        if not self.framed:
+            return await self.reader.read(self.__buffersize)
+        # StreamReader buffers the bytes received, readexactly does not cost extra reads
+        # and, when cancelled, leaves them for the next call
+        try:
+            if self.__size is None:
+                self.__size = Connection.HEADER.unpack(await self.reader.readexactly(Connection.HEADER.size))[0]
+            data = await self.reader.readexactly(self.__size)
+            self.__size = None
+            return data
+        except asyncio.IncompleteReadError:
+            raise ConnectionError('Connection closed by peer')
+
+    def close(self):
+        self.writer.close()
+
+
+class QueueChannel:
+    '''Class representing one end of an in-memory channel, used as a connected socket.
+
+    Bytes sent on one end are received on the other one, through two queues; see
+    queuepair(). Closing an end makes the other one receive b'', as a socket would.
+    '''
+    def __init__(self, inbox, outbox, name):
+        self.__inbox = inbox
+        self.__outbox = outbox
+        self.__name = name
+        self.__pending = b''
+        self.__timeout = None
+        self.__closed = False
+
+    def sendall(self, data):
+        if self.__closed:
+            raise OSError('The channel is closed')
+        self.__outbox.put(bytes(data))
+
+    def recv(self, size):
+        if len(self.__pending) == 0:
+            try:
+                data = self.__inbox.get(timeout=self.__timeout)
+            except queue.Empty:
+                raise TimeoutError('timed out')
+            if data is None:
+                # Closed by the other end, and for the next calls too
+                self.__inbox.put(None)
+                return b''
+            self.__pending = data
+        data, self.__pending = self.__pending[:size], self.__pending[size:]
+        return data
+
+    def settimeout(self, timeout):
+        self.__timeout = timeout
+
+    def getpeername(self):
+        return self.__name
+
+    def close(self):
+        if not self.__closed:
+            self.__closed = True
+            self.__outbox.put(None)
+
+
+def queuepair(name='memory'):
+    '''Return two QueueChannel connected to each other, as socket.socketpair does.'''
+    left, right = queue.Queue(), queue.Queue()
+    return QueueChannel(left, right, name), QueueChannel(right, left, name)
+
+
+def _describe(address):
+    # Printable address of a socket or a channel
+    if isinstance(address, tuple) and len(address) >= 2:
+        return '{}:{}'.format(*address[:2])
+    return str(address) if address else 'local'
+
+
+class Transport(metaclass=ABCMeta):
+    '''Abstract class representing how the clients connect to a game server.
+
+    The server calls listen() and then accept() once per player, and each client calls
+    connect(). Both get a channel used as a connected socket (sendall, recv, settimeout,
+    getpeername and close), wrapped by the game in a Connection.
+    '''
+    @abstractmethod
+    def listen(self, backlog):
+        '''Start accepting clients, if not done yet.'''
+        ...
+
+    @abstractmethod
+    def accept(self):
+        '''Return the channel to the next client connected.'''
+        ...
+
+    @abstractmethod
+    def connect(self):
+        '''Return the channel of a new client to the server.'''
+        ...
+
+    def close(self):
+        '''Stop accepting clients.'''
+        pass
+
+
+class TCPTransport(Transport):
+    '''Class representing clients connecting to the server over TCP.
+
+    By default, the server listens on port 5000 of the address of the host name; with
+    port 0, it listens on a free port, given by 'address' once listening.
+    '''
+    def __init__(self, host=None, port=5000):
+        self.__host = socket.gethostbyname(socket.gethostname()) if host is None else host
+        self.__port = port
+        self.__socket = None
+
+    @property
+    def address(self):
+        if self.__socket is not None:
+            return self.__socket.getsockname()[:2]
+        return self.__host, self.__port
+
+    def listen(self, backlog):
+        if self.__socket is None:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind((self.__host, int(self.__port)))
+            s.listen(backlog)
+            self.__socket = s
+
+    def accept(self):
+        return self.__socket.accept()[0]
+
+    def connect(self):
+        addrinfos = socket.getaddrinfo(*self.address, socket.AF_INET, socket.SOCK_STREAM)
+        s = socket.socket()
+        try:
+            s.connect(addrinfos[0][4])
+        except OSError:
+            s.close()
+            raise
+        return s
+
+    def close(self):
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+
+    def __str__(self):
+        return _describe(self.address)
+
+
+class PairTransport(Transport):
+    '''Class representing clients connected to a server of the same process.
+
+    Each connect() creates a pair of connected channels, one end being returned and
+    the other one accepted by the server, in the same order: with 'kind' 'socketpair',
+    a pair of sockets (socket.socketpair, through the kernel but without the network),
+    with 'kind' 'queue', a pair of QueueChannel (in memory, threads only).
+    '''
+    def __init__(self, kind='queue'):
+        if kind not in ('queue', 'socketpair'):
+            raise ValueError('Unknown kind of channel: {}'.format(kind))
+        self.__kind = kind
+        self.__accepted = queue.Queue()
+
+    def listen(self, backlog):
+        pass
+
+    def accept(self):
+        return self.__accepted.get()
+
+    def connect(self):
+        if self.__kind == 'queue':
+            mine, theirs = queuepair()
+        else:
+            mine, theirs = socket.socketpair()
+        self.__accepted.put(theirs)
+        return mine
+
+    def __str__(self):
+        return 'a {} of this process'.format(self.__kind)
+
+
 class GameState(metaclass=ABCMeta):
     '''Abstract class representing a generic game state.'''
     def __init__(self, visible, hidden=None):
@@ -52,6 +399,70 @@ class GameState(metaclass=ABCMeta):
         Post: This state has been printed on stdout.'''
         ...
 
+    def snapshot(self):
+        '''Return an immutable and canonical summary of the visible state.
+        Pre: -
+        Post: Two states with the same visible data have equal snapshots, which
+              delta() compares to find what changed.
+        '''
+        visible = self._state['visible']
+        return tuple((key, json.dumps(visible[key], sort_keys=True)) for key in sorted(visible))
+
+    def delta(self, old, new):
+        '''Return the changes between two snapshots, in a JSON-serialisable form.'''
+        old = dict(old)
+        return {key: json.loads(value) for key, value in new if old.get(key) != value}
+
+    def applydelta(self, delta):
+        '''Apply to this state the changes computed by delta().'''
+        self._state['visible'].update(delta)
+
+    def checksum(self, snapshot=None):
+        '''Return a checksum of the visible state, used to detect drifting deltas.
+        Pre: 'snapshot', if given, is the current snapshot() of this state.
+        Post: The returned value is an unsigned 32-bit integer.
+        '''
+        return zlib.crc32(repr(self.snapshot() if snapshot is None else snapshot).encode())
+
+    def encode(self):
+        '''Return the visible state as bytes, for the binary codec (JSON by default).'''
+        return str(self).encode()
+
+    @classmethod
+    def decode(cls, data):
+        '''Return the state encoded by encode().'''
+        return cls.parse(data.decode())
+
+    @classmethod
+    def encodedelta(cls, delta):
+        '''Return changes computed by delta() as bytes, for the binary codec (JSON by default).'''
+        return json.dumps(delta, separators=(',', ':')).encode()
+
+    @classmethod
+    def decodedelta(cls, data):
+        '''Return the changes encoded by encodedelta(), in the form accepted by applydelta().'''
+        return json.loads(data.decode())
+
+    @classmethod
+    def encodemove(cls, move):
+        '''Return a move, given as sent by GameClient._nextmove, as bytes for the binary codec.'''
+        return (move if isinstance(move, str) else json.dumps(move, separators=(',', ':'))).encode()
+
+    @classmethod
+    def decodemove(cls, data):
+        '''Return the move encoded by encodemove(), in a form accepted by GameServer.applymove.
+        Raises InvalidMoveException: If 'data' is not a valid encoded move.
+        '''
+        return data.decode()
+
+    def copy(self):
+        '''Return an independent copy of this state.'''
+        return copy.deepcopy(self)
+
+    def visible(self):
+        '''Return the state seen by the players, with a copy of the visible data of this state.'''
+        return self.__class__(copy.deepcopy(self._state['visible']))
+
     @classmethod
     def parse(cls, state):
         return cls(json.loads(state))
@@ -61,16 +472,81 @@ class GameState(metaclass=ABCMeta):
         return DEFAULT_BUFFER_SIZE
 
 
+class StateView:
+    '''Class representing a read-only view of a game state.
+
+    The view reads the attributes and calls the methods of the state, except the
+    ones listed in MUTATORS, and cannot be assigned to. It shares the data of the
+    state and costs nothing to create: copy() gives an independent state.
+    '''
+    MUTATORS = frozenset(('update', 'apply', 'undo', 'applydelta', 'setassassins'))
+
+    def __init__(self, state):
+        object.__setattr__(self, '_StateView__state', state)
+
+    def __getattr__(self, name):
+        if name in self.MUTATORS:
+            raise AttributeError('{} cannot be called on a read-only view of the state'.format(name))
+        return getattr(self.__state, name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('A read-only view of the state cannot be modified')
+
+    def __str__(self):
+        return str(self.__state)
+
+    def __repr__(self):
+        return repr(self.__state)
+
+
+class TimeControl:
+    '''Class representing the time given to the players to choose their moves.
+
+    A turn starts when the state is first sent to the player, and its move must be
+    received within 'permove' seconds; each player also has 'pergame' seconds for all
+    of its turns (None: no limit). Invalid moves do not stop the clock. A player out of
+    time loses the game if 'ontimeout' is 'forfeit'; if it is 'pass', the server plays
+    its defaultmove() for it instead, when there is one.
+    '''
+    def __init__(self, permove=None, pergame=None, ontimeout='forfeit'):
+        if ontimeout not in ('forfeit', 'pass'):
+            raise ValueError('Unknown action on timeout: {}'.format(ontimeout))
+        self.permove = permove
+        self.pergame = pergame
+        self.ontimeout = ontimeout
+
+
 class GameServer(metaclass=ABCMeta):
     '''Abstract class representing a generic game server.'''
-    def __init__(self, name, nbplayers, initialstate, verbose=False):
+    def __init__(self, name, nbplayers, initialstate, verbose=False, recorder=None, latency=None,
+                 timecontrol=None, maxinvalid=MAX_INVALID_MOVES):
         self.__name = name
         self.__nbplayers = nbplayers
         self.__verbose = verbose
         self._state = initialstate
+        # Replay file receiving the game once ended (see lib.replay), and the moves played
+        self.__recorder = recorder
+        self.__record = []
+        # Timing of the phases of each turn (see lib.latency), None when not timed
+        self.__latency = latency
+        # Time limits (see TimeControl), time used by each player and start of the current turn
+        self.__timecontrol = timecontrol
+        self.__clocks = [{'used': 0.0, 'moves': 0, 'longest': 0.0, 'timeouts': 0} for i in range(nbplayers)]
+        self.__turnstart = None
+        self.__forfeited = None
+        self.__winner = -1
+        # Invalid moves in a row after which a player forfeits (None: no limit), and of each player
+        self.__maxinvalid = maxinvalid
+        self.__invalid = [0] * nbplayers
+        # States sent to each player and not answered yet
+        self.__unanswered = [0] * nbplayers
         # Stats about the running game
         self.__currentplayer = None
         self.__turns = 0
+        # Last snapshot sent to each player asking for deltas (None: send the full state)
+        self.__snapshots = {}
+        # Players using the binary codec of the state
+        self.__binary = set()
 
     @property
     def name(self):
@@ -88,6 +564,30 @@ class GameServer(metaclass=ABCMeta):
     def turns(self):
         return self.__turns
 
+    @property
+    def latency(self):
+        return self.__latency
+
+    @property
+    def clocks(self):
+        '''List, for each player, of its time used in seconds, its moves, its longest move and its timeouts.'''
+        return [dict(clock) for clock in self.__clocks]
+
+    @property
+    def winner(self):
+        '''Winner of the game once ended (as for GameState.winner, counting forfeits), -1 before.'''
+        return self.__winner
+
+    @property
+    def forfeited(self):
+        '''Number of the player that lost the game by running out of time or playing too many
+        invalid moves in a row (see MAX_INVALID_MOVES), None if none.'''
+        return self.__forfeited
+
+    def defaultmove(self, player):
+        '''Return the move played for a player out of time, None if it must forfeit (default).'''
+        return None
+
     @abstractmethod
     def applymove(self, move):
         '''Apply a move.
@@ -99,26 +599,204 @@ class GameServer(metaclass=ABCMeta):
 
     @property
     def state(self):
-        return copy.deepcopy(self._state)
+        '''Read-only view of the current state, see StateView.'''
+        return StateView(self._state)
+
+    def replayheader(self):
+        '''Return the header of the replay of this game.
+        Pre: -
+        Post: The returned value is bytes describing how the game started, such that
+              the recorded moves replayed from it give the same game (empty by default).
+        '''
+        return b''
+
+    def replaysummary(self):
+        '''Return the summary of the replay of this game, once ended.
+        Pre: -
+        Post: The returned value is bytes telling how the game ended, read back by
+              readreplaysummary(): by default, the winner and the forfeiting player,
+              which the recorded moves alone do not give.
+        '''
+        winner, forfeited = self.__winner, self.__forfeited
+        return RESULT.pack(DRAW if winner is None else winner, -1 if forfeited is None else forfeited)
+
+    @classmethod
+    def readreplaysummary(cls, summary):
+        '''Return the content of a summary written by replaysummary(), as a dictionary.
+        Post: The dictionary has the 'winner' (as for GameState.winner, -1 if the game was
+              not over) and the player that 'forfeited' (or None).
+        '''
+        winner, forfeited = RESULT.unpack_from(summary)
+        return {'winner': None if winner == DRAW else winner, 'forfeited': None if forfeited < 0 else forfeited}
+
+    def replay(self, turns, summary=b''):
+        '''Apply the moves of a recorded game.
+        Pre: 'turns' is a list of (player, move), with the moves encoded by the state's
+             encodemove, recorded for a game starting as this one, and 'summary' the
+             one recorded with them, if any.
+        Post: The moves have been applied, each one for its player. With a summary,
+              'winner' and 'forfeited' are the recorded ones.
+        Raises InvalidMoveException: If a recorded move is invalid.
+        '''
+        for player, move in turns:
+            self.__currentplayer = player
+            self.applymove(self._state.decodemove(move))
+            self.__turns += 1
+        if len(summary) > 0:
+            result = self.readreplaysummary(summary)
+            self.__winner, self.__forfeited = result['winner'], result['forfeited']
+        else:
+            self.__winner = self._state.winner()
+
+    def _recordmove(self, player, move):
+        if self.__recorder is not None:
+            self.__record.append((player, move))
+
+    def _recordgame(self, winner):
+        # The moves are only encoded once the game has ended
+        self.__winner = winner
+        if self.__recorder is not None:
+            turns = [(player, self._state.encodemove(move)) for player, move in self.__record]
+            self.__recorder.append(self.replayheader(), turns, self.replaysummary())
+            self.__record = []
+
+    def _setoptions(self, i, options, framed):
+        # Return the messages acknowledging the options granted to player i
+        messages = []
+        if BINARY_OPTION in options and framed:
+            self.__binary.add(i)
+            messages.append('BINARY')
+        if DELTA_OPTION in options:
+            self.__snapshots[i] = None
+        return messages
+
+    def _readmove(self, i, data):
+        # Moves of players using the binary codec are decoded here, the others stay text
+        if i in self.__binary:
+            return self._state.decodemove(data)
+        return data.decode()
+
+    def _playmessage(self, i):
+        # Full PLAY state or DELTA since the last state sent for players asking for it, both
+        # encoded with the binary codec for players using it (the checksum on 4 bytes)
+        binary = i in self.__binary
+        old = None
+        if i in self.__snapshots:
+            old, new = self.__snapshots[i], self._state.snapshot()
+            self.__snapshots[i] = new
+        if old is None:
+            return b'PLAY ' + self._state.encode() if binary else 'PLAY {}'.format(self._state)
+        delta = self._state.delta(old, new)
+        checksum = self._state.checksum(new)
+        if binary:
+            return b'DELTA ' + checksum.to_bytes(4, 'big') + self._state.encodedelta(delta)
+        return 'DELTA {} {}'.format(checksum, json.dumps(delta, separators=(',', ':')))
+
+    def _resync(self, i):
+        # The player's state drifted, send it the full state next time
+        self.__snapshots[i] = None
+
+    def _startturn(self):
+        if self.__turnstart is None:
+            self.__turnstart = time.perf_counter()
+
+    def _timeleft(self, i):
+        # Seconds left to player i for the current turn, None without limit
+        control = self.__timecontrol
+        if control is None:
+            return None
+        limits = [control.permove] if control.permove is not None else []
+        if control.pergame is not None:
+            limits.append(control.pergame - self.__clocks[i]['used'])
+        if len(limits) == 0:
+            return None
+        return min(limits) - (time.perf_counter() - self.__turnstart)
+
+    def _endturn(self, i):
+        clock = self.__clocks[i]
+        elapsed = time.perf_counter() - self.__turnstart
+        clock['used'] += elapsed
+        clock['moves'] += 1
+        clock['longest'] = max(clock['longest'], elapsed)
+        self.__turnstart = None
+        self.__invalid[i] = 0
+
+    def _invalidmove(self, i):
+        # Count an invalid move of player i and return whether it forfeits for playing too many in a row
+        self.__invalid[i] += 1
+        if self.__maxinvalid is None or self.__invalid[i] < self.__maxinvalid:
+            return False
+        if self.__verbose:
+            print('   Player {} played {} invalid moves in a row.'.format(i, self.__invalid[i]))
+        self._endturn(i)
+        self.__forfeited = i
+        return True
 
-    def _waitplayers(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((socket.gethostbyname(socket.gethostname()), 5000))
-        s.listen(self.nbplayers)
+    def _timeout(self, i):
+        # Apply the default move of player i out of time and return it, or None if it forfeits
+        self.__clocks[i]['timeouts'] += 1
+        if self.__verbose:
+            print('   Player {} ran out of time.'.format(i))
+        move = None
+        if self.__timecontrol.ontimeout == 'pass':
+            move = self.defaultmove(i)
+        if move is not None:
+            try:
+                self.applymove(move)
+                return move
+            except InvalidMoveException:
+                pass
+        self._endturn(i)
+        self.__forfeited = i
+        return None
+
+    def _forfeitwinner(self, i):
+        # Winner of a game forfeited by player i: its opponent, or a draw with more players
+        return 1 - i if self.nbplayers == 2 else None
+
+    def _sentstate(self, i):
+        self.__unanswered[i] += 1
+
+    def _recvmove(self, i, player):
+        # Answer of player i to the last state sent, skipping the late answers to the
+        # previous ones, None if it did not come in time
+        while True:
+            try:
+                data = player.recvbytes(self._timeleft(i))
+            except TimeoutError:
+                return None
+            self.__unanswered[i] -= 1
+            if self.__unanswered[i] <= 0:
+                self.__unanswered[i] = 0
+                return data
+
+    async def _asyncrecvmove(self, i, player):
+        # Same as _recvmove, with an AsyncConnection
+        while True:
+            try:
+                data = await player.recvbytes(self._timeleft(i))
+            except TimeoutError:
+                return None
+            self.__unanswered[i] -= 1
+            if self.__unanswered[i] <= 0 or len(data) == 0:
+                self.__unanswered[i] = 0
+                return data
+
+    def _waitplayers(self, transport):
+        transport.listen(self.nbplayers)
         if self.__verbose:
             _printsection('Starting {}'.format(self.name))
-            print(' Game server listening on {}:{}.'.format(socket.gethostbyname(socket.gethostname()), 5000))
+            print(' Game server listening on {}.'.format(transport))
             print(' Waiting for {} players...'.format(self.nbplayers))
         self.__players = []
         # Wait for enough players for a play
         try:
             while len(self.__players) < self.__nbplayers:
-                client = s.accept()[0]
+                client = Connection(transport.accept(), self._state.__class__.buffersize())
                 self.__players.append(client)
                 if self.__verbose:
-                    print(' - Client connected from {}:{} ({}/{}).'
-                          .format(*client.getpeername(), len(self.__players), self.nbplayers)
+                    print(' - Client connected from {} ({}/{}).'
+                          .format(_describe(client.getpeername()), len(self.__players), self.nbplayers)
                           )
         except KeyboardInterrupt:
             for player in self.__players:
@@ -131,15 +809,20 @@ class GameServer(metaclass=ABCMeta):
                 if self.__verbose:
                     print(' Initialising player {}...'.format(i))
                 player = self.__players[i]
-                player.sendall('START {}'.format(i).encode())
-                data = player.recv(self._state.__class__.buffersize()).decode().split(' ')
-                if data[0] != 'READY':
+                player.send('START {}'.format(i))
+                ready, name, options = _parseready(player.recv())
+                if not ready:
                     if self.__verbose:
                         print(' - Player {} not ready to start.'.format(i))
                         _printsection('Current game ended')
                     return False
-                elif self.__verbose:
-                    print(' - Player {} ({}) ready to start.'.format(i, data[1] if len(data) == 2 else 'Anonymous'))
+                if FRAMED_OPTION in options:
+                    player.send('FRAMED')
+                    player.framed = True
+                for message in self._setoptions(i, options, player.framed):
+                    player.send(message)
+                if self.__verbose:
+                    print(' - Player {} ({}) ready to start.'.format(i, name))
         except OSError:
             if self.__verbose:
                 print('Error while notifying player {}.'.format(player))
@@ -152,6 +835,10 @@ class GameServer(metaclass=ABCMeta):
     def _gameloop(self):
         self.__currentplayer = 0
         winner = -1
+        # The timings of a verbose server include its printing
+        latency = self.__latency
+        if latency is not None:
+            latency.startgame()
         if self.__verbose:
             print(' Initial state:')
             self._state.prettyprint()
@@ -160,87 +847,486 @@ class GameServer(metaclass=ABCMeta):
             player = self.__players[self.__currentplayer]
             if self.__verbose:
                 print("\n=> Turn #{} (player {})".format(self.turns, self.__currentplayer))
-            player.sendall('PLAY {}'.format(self.state).encode())
+            if latency is not None:
+                latency.begin(self.__currentplayer)
+            player.send(self._playmessage(self.__currentplayer))
+            self._sentstate(self.__currentplayer)
+            self._startturn()
+            if latency is not None:
+                latency.lap('send')
             try:
-                move = player.recv(self._state.__class__.buffersize()).decode()
-                if self.__verbose:
-                    print('   Move:', move)
-                self.applymove(move)
+                data = self._recvmove(self.__currentplayer, player)
+                if latency is not None:
+                    latency.lap('wait')
+                if data is None:
+                    move = self._timeout(self.__currentplayer)
+                    if move is None:
+                        winner = self._forfeitwinner(self.__currentplayer)
+                        break
+                    player.send('TIMEOUT')
+                else:
+                    move = self._readmove(self.__currentplayer, data)
+                    if latency is not None:
+                        latency.lap('decode')
+                    if self.__verbose:
+                        print('   Move:', move)
+                    if move == 'RESYNC':
+                        self._resync(self.__currentplayer)
+                        continue
+                    self.applymove(move)
+                if latency is not None:
+                    latency.lap('update')
+                self._endturn(self.__currentplayer)
+                self._recordmove(self.__currentplayer, move)
                 self.__turns += 1
                 self.__currentplayer = (self.__currentplayer + 1) % self.nbplayers
             except InvalidMoveException as e:
                 if self.__verbose:
                     print('Invalid move:', e)
-                player.sendall('ERROR {}'.format(e).encode())
+                player.send('ERROR {}'.format(e))
+                if self._invalidmove(self.__currentplayer):
+                    winner = self._forfeitwinner(self.__currentplayer)
+                    break
             if self.__verbose:
                 print('   State:')
                 self._state.prettyprint()
             winner = self._state.winner()
+            if latency is not None:
+                latency.lap('winner')
+                latency.end()
+        self._recordgame(winner)
+        if latency is not None:
+            latency.endgame(winner=winner, clocks=self.clocks)
         if self.__verbose:
             _printsection('Game finished')
+            for i, clock in enumerate(self.__clocks):
+                print(' Player {}: {:.3f}s for {} moves (longest {:.3f}s), {} timeouts.'
+                      .format(i, clock['used'], clock['moves'], clock['longest'], clock['timeouts']))
         # Notify players about won/lost status
         if winner is not None:
             for i in range(self.nbplayers):
-                self.__players[i].sendall(('WON' if winner == i else 'LOST').encode())
+                self.__players[i].send('WON' if winner == i else 'LOST')
             if self.__verbose:
                 print(' The winner is player {}.'.format(winner))
         # Notify players that the game ended
         else:
             for player in self.__players:
-                player.sendall('END'.encode())
+                player.send('END')
         # Close the connexions with the clients
         for player in self.__players:
             player.close()
         if self.__verbose:
             _printsection('Game ended')
+        return winner
+
+    def run(self, transport=None):
+        '''Wait for the players, connecting through 'transport' (by default TCPTransport()), and play.'''
+        transport = TCPTransport() if transport is None else transport
+        self.__players = []
+        try:
+            if self._waitplayers(transport):
+                return self._gameloop()
+        finally:
+            # Also when a player disconnects, so that the other ones do not wait forever
+            for player in self.__players:
+                player.close()
+            transport.close()
+
+    def runconnected(self, clients, transport=None):
+        '''Play a game with clients running in threads of this process.
+        Pre: 'clients' contains, in the order of the players' numbers, functions taking
+             the server to connect to and playing on it, such as GameClient subclasses
+             (for example: lambda server: MyClient('name', server)).
+        Post: The clients have been connected through 'transport' (by default, in memory
+              with PairTransport()) and the returned value contains the winner (as for
+              GameState.winner).
+        '''
+        transport = PairTransport() if transport is None else transport
+        transport.listen(self.nbplayers)
+        threads = []
+        for client in clients:
+            # Connected here so that the players are accepted in the order of 'clients'
+            thread = threading.Thread(target=client, args=(transport.connect(),), daemon=True)
+            thread.start()
+            threads.append(thread)
+        try:
+            return self.run(transport)
+        finally:
+            for thread in threads:
+                thread.join(CLIENT_TIMEOUT)
+
+    async def _asyncgameloop(self, players):
+        '''Play this game with connected players in an asyncio event loop.
+        Pre: 'players' contains one AsyncConnection per player.
+        Post: The returned value contains the winner (as for GameState.winner).
+        Raises ConnectionError: If a player is not ready or disconnects.
+        '''
+        # Notify players that the game started, the ones of a session keeping their options
+        for i, player in enumerate(players):
+            await player.send('START {}'.format(i) if player.options is None else 'NEWGAME {}'.format(i))
+            ready, name, options = _parseready(await player.recv())
+            if not ready:
+                raise ConnectionError('Player {} not ready to start'.format(i))
+            if player.options is None:
+                player.options = options
+                if FRAMED_OPTION in options:
+                    await player.send('FRAMED')
+                    player.framed = True
+                if SESSION_OPTION in options and player.framed:
+                    await player.send('SESSION')
+                    player.session = True
+            for message in self._setoptions(i, player.options, player.framed):
+                await player.send(message)
+        self.__currentplayer = 0
+        winner = -1
+        latency = self.__latency
+        if latency is not None:
+            latency.startgame()
+        # Loop until the game ends with a winner or with a draw
+        while winner == -1:
+            player = players[self.__currentplayer]
+            if latency is not None:
+                latency.begin(self.__currentplayer)
+            await player.send(self._playmessage(self.__currentplayer))
+            self._sentstate(self.__currentplayer)
+            self._startturn()
+            if latency is not None:
+                latency.lap('send')
+            data = await self._asyncrecvmove(self.__currentplayer, player)
+            if latency is not None:
+                latency.lap('wait')
+            if data is not None and len(data) == 0:
+                raise ConnectionError('Player {} disconnected'.format(self.__currentplayer))
+            try:
+                if data is None:
+                    move = self._timeout(self.__currentplayer)
+                    if move is None:
+                        winner = self._forfeitwinner(self.__currentplayer)
+                        break
+                    await player.send('TIMEOUT')
+                else:
+                    move = self._readmove(self.__currentplayer, data)
+                    if latency is not None:
+                        latency.lap('decode')
+                    if move == 'RESYNC':
+                        self._resync(self.__currentplayer)
+                        continue
+                    self.applymove(move)
+                if latency is not None:
+                    latency.lap('update')
+                self._endturn(self.__currentplayer)
+                self._recordmove(self.__currentplayer, move)
+                self.__turns += 1
+                self.__currentplayer = (self.__currentplayer + 1) % self.nbplayers
+            except InvalidMoveException as e:
+                await player.send('ERROR {}'.format(e))
+                if self._invalidmove(self.__currentplayer):
+                    winner = self._forfeitwinner(self.__currentplayer)
+                    break
+            winner = self._state.winner()
+            if latency is not None:
+                latency.lap('winner')
+                latency.end()
+        self._recordgame(winner)
+        if latency is not None:
+            latency.endgame(winner=winner, clocks=self.clocks)
+        # Notify players about won/lost status, or that the game ended with a draw
+        for i, player in enumerate(players):
+            if winner is None:
+                await player.send('END')
+            else:
+                await player.send('WON' if winner == i else 'LOST')
+        return winner
+
+    def runlocal(self, players):
+        '''Play a whole game in this process, without sockets nor serialisation of the state.
+        Pre: 'players' contains, in the order of the players' numbers, a GameClient created
+             without server or a function taking a state and returning a move.
+        Post: The returned value contains the winner (as for GameState.winner), the number
+              of turns and the list of (player, move) that have been applied.
+        '''
+        nextmoves = []
+        for i, player in enumerate(players):
+            if isinstance(player, GameClient):
+                player._playernb = i
+                player._newgame()
+                nextmoves.append(player._nextmove)
+            else:
+                nextmoves.append(player)
+        self.__currentplayer = 0
+        moves = []
+        winner = -1
+        latency = self.__latency
+        if latency is not None:
+            latency.startgame()
+        while winner == -1:
+            if latency is not None:
+                latency.begin(self.__currentplayer)
+            self._startturn()
+            move = nextmoves[self.__currentplayer](self._state.visible())
+            if latency is not None:
+                latency.lap('think')
+            try:
+                # The players cannot be interrupted, a move coming too late is replaced
+                timeleft = self._timeleft(self.__currentplayer)
+                if timeleft is not None and timeleft < 0:
+                    move = self._timeout(self.__currentplayer)
+                    if move is None:
+                        winner = self._forfeitwinner(self.__currentplayer)
+                        break
+                    player = players[self.__currentplayer]
+                    if isinstance(player, GameClient):
+                        player._handle('TIMEOUT')
+                else:
+                    self.applymove(move)
+                if latency is not None:
+                    latency.lap('update')
+                self._endturn(self.__currentplayer)
+                self._recordmove(self.__currentplayer, move)
+                moves.append((self.__currentplayer, move))
+                self.__turns += 1
+                self.__currentplayer = (self.__currentplayer + 1) % self.nbplayers
+            except InvalidMoveException as e:
+                if self.__verbose:
+                    print('Invalid move:', e)
+                player = players[self.__currentplayer]
+                if isinstance(player, GameClient):
+                    player._handle('ERROR {}'.format(e))
+                # A deterministic player could send the same invalid move forever
+                if self._invalidmove(self.__currentplayer):
+                    winner = self._forfeitwinner(self.__currentplayer)
+                    break
+            winner = self._state.winner()
+            if latency is not None:
+                latency.lap('winner')
+                latency.end()
+        self._recordgame(winner)
+        if latency is not None:
+            latency.endgame(winner=winner, clocks=self.clocks)
+        return winner, self.turns, moves
+
+
+class AsyncGameServer:
+    '''Class representing a server hosting many games at once in an asyncio event loop.
+
+    Players are accepted continuously on a single port and paired, in their order of
+    arrival, into games created by 'gamefactory' (a function returning a new GameServer,
+    such as its class). Each game is then played with the applymove and winner methods
+    of that GameServer, just as GameServer.run does.
+
+    Players asking for a session (see SESSION_OPTION) are not disconnected at the end
+    of a game: they answer AGAIN to wait for the next one, which starts with a NEWGAME
+    message, or BYE to leave.
+    '''
+    def __init__(self, gamefactory, host='localhost', port=5000, verbose=False):
+        self.__gamefactory = gamefactory
+        self.__host = host
+        self.__port = port
+        self.__verbose = verbose
+        self.__nextgame = gamefactory()
+        self.__waiting = []
+        self.__games = set()
+        self.__played = 0
+
+    @property
+    def running(self):
+        return len(self.__games)
+
+    @property
+    def played(self):
+        return self.__played
+
+    async def _acceptplayer(self, reader, writer):
+        if self.__verbose:
+            print(' - Client connected from {}:{}.'.format(*writer.get_extra_info('peername')[:2]))
+        self._enqueue(AsyncConnection(reader, writer, self.__nextgame._state.__class__.buffersize()))
+
+    def _enqueue(self, player):
+        # Add a player to the next game, starting it once complete
+        self.__waiting.append(player)
+        if len(self.__waiting) == self.__nextgame.nbplayers:
+            game, players = self.__nextgame, self.__waiting
+            self.__nextgame, self.__waiting = self.__gamefactory(), []
+            task = asyncio.ensure_future(self._playgame(game, players))
+            self.__games.add(task)
+            task.add_done_callback(self.__games.discard)
+
+    async def _playgame(self, game, players):
+        # Players waiting for their next game, the other ones are closed whatever happens
+        kept = []
+        try:
+            winner = await game._asyncgameloop(players)
+            if self.__verbose:
+                print(' Game finished after {} turns, winner: {}.'.format(game.turns, winner))
+                if game.forfeited is not None:
+                    print(' Player {} forfeited.'.format(game.forfeited))
+            # Players of a session wait for their next game, in another order so that
+            # players facing each other again swap sides
+            for player in players[1:] + players[:1]:
+                if player.session and await self._playsagain(player):
+                    kept.append(player)
+                    self._enqueue(player)
+        except Exception as e:
+            # For example a lost connection, a message that is not UTF-8 or a game that
+            # could not be recorded: the opponents must not wait forever
+            if self.__verbose:
+                print(' Game aborted:', e)
+        finally:
+            for player in players:
+                if player not in kept:
+                    player.close()
+            self.__played += 1
+
+    async def _playsagain(self, player):
+        # Whether a player of a session asks for another game
+        try:
+            return await player.recv(SESSION_TIMEOUT) == 'AGAIN'
+        except (OSError, ConnectionError, UnicodeDecodeError):
+            return False
+
+    async def serve(self):
+        server = await asyncio.start_server(self._acceptplayer, self.__host, self.__port)
+        if self.__verbose:
+            _printsection('Starting {}'.format(self.__nextgame.name))
+            print(' Game server listening on {}:{}.'.format(self.__host, self.__port))
+        async with server:
+            await server.serve_forever()
 
     def run(self):
-        if self._waitplayers():
-            self._gameloop()
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            if self.__verbose:
+                _printsection('Game server ended')
 
 
 class GameClient(metaclass=ABCMeta):
-    '''Abstract class representing a game client'''
-    def __init__(self, server, stateclass, verbose=False):
+    '''Abstract class representing a game client
+
+    The client connects to 'server', which is the (host, port) of a TCP server, a
+    Transport to connect through or a channel already connected (see Transport). It
+    plays 'games' games on that connection (None for as many as the server starts) if
+    the server supports sessions, and one otherwise; _newgame() is called before each.
+    '''
+    def __init__(self, server, stateclass, verbose=False, latency=None, games=1):
         self.__stateclass = stateclass
         self.__verbose = verbose
+        self.__binary = False
+        self.__games = games
+        self.__played = 0
+        # Timing of the phases of each turn (see lib.latency), None when not timed
+        self.__latency = latency
+        # Without server, the client is only used to play in-process (see GameServer.runlocal)
+        if server is None:
+            return
         if self.__verbose:
             _printsection('Starting game')
-        addrinfos = socket.getaddrinfo(*server, socket.AF_INET, socket.SOCK_STREAM)
-        s = socket.socket()
+        if isinstance(server, tuple):
+            server = TCPTransport(*server)
         try:
-            s.connect(addrinfos[0][4])
+            channel = server.connect() if isinstance(server, Transport) else server
             if self.__verbose:
-                print(' Connected to the game server on {}:{}.'.format(*addrinfos[0][4]))
-            self.__server = s
-            self._gameloop()
+                print(' Connected to the game server on {}.'.format(_describe(channel.getpeername())))
         except OSError:
-            print(' Impossible to connect to the game server on {}:{}.'.format(*addrinfos[0][4]))
+            print(' Impossible to connect to the game server on {}.'.format(server))
+            return
+        self.__server = Connection(channel, stateclass.buffersize())
+        try:
+            self._gameloop()
+        except ConnectionError:
+            # Closed or reset by the server during a game, after a forfeit for instance
+            self.__server.close()
+            print(' Connection lost with the game server, the game has ended.')
 
     def _gameloop(self):
         server = self.__server
+        latency = self.__latency
+        session = False
+        # Between two games of a session, the server may close the connection at any time
+        waiting = False
         running = True
         while running:
-            data = server.recv(self.__stateclass.buffersize()).decode()
-            command = data[:data.index(' ')] if ' ' in data else data
-            if command == 'START':
+            try:
+                data = server.recvbytes()
+            except ConnectionError:
+                if not waiting:
+                    raise
+                if self.__verbose:
+                    _printsection('Session ended')
+                server.close()
+                break
+            command = data.split(b' ', 1)[0].decode()
+            # Binary states and deltas are the only messages that are not text
+            binary = command in ('PLAY', 'DELTA') and self.__binary
+            if not binary:
+                data = data.decode()
+            if command in ('START', 'NEWGAME'):
                 self._playernb = int(data[data.index(' '):])
-                server.sendall('READY'.encode())
+                self._newgame()
+                waiting = False
+                if command == 'START':
+                    options = [FRAMED_OPTION, DELTA_OPTION, BINARY_OPTION]
+                    if self.__games != 1:
+                        options.append(SESSION_OPTION)
+                    server.send('READY {}'.format(' '.join(options)))
+                    server.requestframing()
+                else:
+                    server.send('READY')
+                if latency is not None:
+                    latency.startgame()
                 if self.__verbose:
                     _printsection('Game started')
                     print("   Player's number: {}".format(self._playernb))
-            elif command == 'PLAY':
-                state = self.__stateclass.parse(data[data.index(' ')+1:])
+            elif command == 'BINARY':
+                self.__binary = True
+            elif command == 'SESSION':
+                session = True
+            elif command in ('PLAY', 'DELTA'):
+                if latency is not None:
+                    latency.begin(self._playernb)
+                if command == 'PLAY' and binary:
+                    state = self.__stateclass.decode(data[len(b'PLAY '):])
+                elif command == 'PLAY':
+                    state = self.__stateclass.parse(data[data.index(' ')+1:])
+                else:
+                    if binary:
+                        i = len(b'DELTA ')
+                        checksum = int.from_bytes(data[i:i + 4], 'big')
+                        state.applydelta(self.__stateclass.decodedelta(data[i + 4:]))
+                    else:
+                        checksum, delta = data.split(' ', 2)[1:]
+                        state.applydelta(json.loads(delta))
+                    # Ask for the full state if this copy drifted from the server's one
+                    if state.checksum() != int(checksum):
+                        server.send('RESYNC')
+                        continue
+                if latency is not None:
+                    latency.lap('decode')
                 if self.__verbose:
                     print("\n=> Player's turn to play")
                     print('   State:')
                     state.prettyprint()
                 move = self._nextmove(state)
+                if latency is not None:
+                    latency.lap('think')
                 if self.__verbose:
                     print('   Move:', move)
-                server.sendall(move.encode())
+                if self.__binary:
+                    move = self.__stateclass.encodemove(move)
+                elif not isinstance(move, str):
+                    move = json.dumps(move, separators=(',', ':'))
+                server.send(move)
+                if latency is not None:
+                    latency.lap('send')
+                    latency.end()
             elif command in ('WON', 'LOST', 'END'):
-                running = False
+                self.__played += 1
+                running = session and (self.__games is None or self.__played < self.__games)
+                waiting = running
+                if session:
+                    server.send('AGAIN' if running else 'BYE')
+                if latency is not None:
+                    latency.endgame(result=command)
                 if self.__verbose:
                     _printsection('Game finished')
                     if command == 'WON':
@@ -250,12 +1336,25 @@ class GameClient(metaclass=ABCMeta):
                     else:
                         print(' It is draw.')
                     _printsection('Game ended')
-                server.close()
+                if not running:
+                    server.close()
             else:
                 if self.__verbose:
                     print('Specific data received:', data)
                 self._handle(data)
 
+    @property
+    def played(self):
+        '''Number of games played on the connection.'''
+        return self.__played
+
+    def _newgame(self):
+        '''Reset the data kept by the client about the current game.
+        Pre: -
+        Post: The client is ready to play a new game, with the number _playernb.
+        '''
+        pass
+
     @abstractmethod
     def _handle(self, command):
         '''Handle a command.
@@ -269,4 +1368,5 @@ class GameClient(metaclass=ABCMeta):
         '''Get the next move to play.
         Pre: 'state' is a valid game' state.
         Post: The returned value contains a valid move to be played by this player
-              in the specified 'state' of the game.'''
\ No newline at end of file
+              in the specified 'state' of the game, as JSON or as the value to send
+              as JSON, which the binary codec then encodes without parsing it.'''
\ No newline at end of file
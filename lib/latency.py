@@ -0,0 +1,173 @@
+# latency.py
+# Timing of the phases of each turn of a game, in per-game and per-process histograms
+
+import itertools
+import json
+import time
+
+# Phases timed by GameServer and GameClient, in the order of a turn
+PHASES = (
+    'send',     # serialising and sending the state to the player
+    'wait',     # waiting for the move: the player thinking, plus the network
+    'decode',   # decoding a received message (move or state)
+    'think',    # the player choosing its move
+    'parse',    # parsing the move, in applymove (JSON for King & Assassins)
+    'update',   # applying the move to the state
+    'winner'    # checking whether the game has ended
+)
+
+_gameids = itertools.count(1)
+# Histograms of all the turns timed in this process, by phase
+_process = {}
+
+
+class Histogram:
+    '''Class representing a distribution of durations in nanoseconds.
+
+    Durations are counted in buckets of powers of two: bucket b holds the durations
+    d such that 2 ** (b - 1) <= d < 2 ** b (bucket 0 holds the null ones), so that
+    adding a duration is cheap and the histogram stays small whatever its count.
+    '''
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * 65
+
+    def add(self, ns):
+        self.count += 1
+        self.total += ns
+        if self.min is None or ns < self.min:
+            self.min = ns
+        if self.max is None or ns > self.max:
+            self.max = ns
+        self.buckets[min(ns.bit_length(), 64)] += 1
+
+    def merge(self, other):
+        '''Add the durations of another histogram to this one.'''
+        self.count += other.count
+        self.total += other.total
+        for bound in (other.min, other.max):
+            if bound is not None:
+                self.min = bound if self.min is None else min(self.min, bound)
+                self.max = bound if self.max is None else max(self.max, bound)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def percentile(self, q):
+        '''Return an upper bound of the q-th percentile (0 <= q <= 100), None if empty.'''
+        if self.count == 0:
+            return None
+        rank = q / 100 * self.count
+        seen = 0
+        for b, n in enumerate(self.buckets):
+            seen += n
+            if n > 0 and seen >= rank:
+                return min(2 ** b - 1 if b > 0 else 0, self.max)
+        return self.max
+
+    def snapshot(self):
+        '''Return the histogram as a JSON-serialisable dictionary.'''
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count > 0 else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': {b: n for b, n in enumerate(self.buckets) if n > 0}
+        }
+
+
+class Latency:
+    '''Class representing the timing of the turns of a game.
+
+    A turn starts with begin(); each lap(phase) then adds the time elapsed since the
+    previous lap (or begin) to that phase, and end() adds the phases of the turn to the
+    histograms of the game and of the process, and sends a 'turn' event to the sink.
+    Laps outside of a turn are ignored. startgame() and endgame() delimit the games,
+    endgame() sending a 'game' event with the histograms of the game.
+
+    Events are dictionaries, given to 'sink' (a function, such as list.append or
+    JsonLinesSink) if there is one. Games played at the same time, such as the ones of
+    an AsyncGameServer, each need their own Latency, which may share a sink.
+    '''
+    def __init__(self, sink=None):
+        self.__sink = sink
+        self.__game = None
+        self.__turns = 0
+        self.__histograms = {}
+        self.__phases = None
+        self.__player = None
+        self.__last = 0
+
+    @property
+    def game(self):
+        return self.__game
+
+    def startgame(self):
+        '''Start timing a new game, with empty histograms.'''
+        self.__game = next(_gameids)
+        self.__turns = 0
+        self.__histograms = {}
+        self.__phases = None
+
+    def begin(self, player):
+        if self.__game is None:
+            self.startgame()
+        self.__player = player
+        self.__phases = {}
+        self.__last = time.perf_counter_ns()
+
+    def lap(self, phase):
+        now = time.perf_counter_ns()
+        phases = self.__phases
+        if phases is not None:
+            phases[phase] = phases.get(phase, 0) + now - self.__last
+            self.__last = now
+
+    def end(self):
+        phases, self.__phases = self.__phases, None
+        if phases is None:
+            return
+        for phase, ns in phases.items():
+            for histograms in (self.__histograms, _process):
+                if phase not in histograms:
+                    histograms[phase] = Histogram()
+                histograms[phase].add(ns)
+        self.__turns += 1
+        if self.__sink is not None:
+            self.__sink({'event': 'turn', 'game': self.__game, 'turn': self.__turns - 1,
+                         'player': self.__player, 'phases': phases})
+
+    def endgame(self, **details):
+        '''End the game, sending a 'game' event with 'details' (such as the winner) to the sink.'''
+        if self.__sink is not None and self.__game is not None:
+            event = {'event': 'game', 'game': self.__game, 'turns': self.__turns, 'phases': self.snapshot()}
+            event.update(details)
+            self.__sink(event)
+
+    def snapshot(self):
+        '''Return the histograms of the current game, by phase, as returned by Histogram.snapshot.'''
+        return {phase: histogram.snapshot() for phase, histogram in self.__histograms.items()}
+
+
+def processsnapshot():
+    '''Return the histograms of all the turns timed in this process, by phase.'''
+    return {phase: histogram.snapshot() for phase, histogram in _process.items()}
+
+
+def resetprocess():
+    '''Empty the histograms of this process.'''
+    _process.clear()
+
+
+class JsonLinesSink:
+    '''Class representing a sink writing each event as one line of JSON to a text file.'''
+    def __init__(self, file):
+        self.__file = file
+
+    def __call__(self, event):
+        self.__file.write(json.dumps(event, separators=(',', ':')) + '\n')
@@ -0,0 +1,250 @@
+# replay.py
+# Append-only recording of played games in compressed blocks, with an index to read them back
+
+import bisect
+import lzma
+import os
+import struct
+import threading
+import zlib
+
+# Magic of the blocks written, whose games have a summary, and of the first ones, without
+MAGIC = b'RPL2'
+MAGIC_NOSUMMARY = b'RPLY'
+CODECS = {'zlib': 0, 'lzma': 1}
+# Block: magic, codec, number of games, size of the games uncompressed and compressed
+BLOCK = struct.Struct('!4sBIII')
+# Index entry: offset of a block in the replay file and number of games in it
+INDEX = struct.Struct('!QI')
+# Game: size of the header, number of turns and size of the summary, followed by the
+# header, the summary and each turn: player and size of the move, then the move
+GAME = struct.Struct('!III')
+GAME_NOSUMMARY = struct.Struct('!II')
+TURN = struct.Struct('!BH')
+
+
+def _compress(codec, data):
+    return zlib.compress(data, 6) if codec == CODECS['zlib'] else lzma.compress(data)
+
+
+def _decompress(codec, data):
+    return zlib.decompress(data) if codec == CODECS['zlib'] else lzma.decompress(data)
+
+
+def encodegame(header, turns, summary=b''):
+    '''Return one game as bytes.
+    Pre: 'header' and 'summary' are bytes and 'turns' a list of (player, move) with 'move' bytes.
+    '''
+    data = [GAME.pack(len(header), len(turns), len(summary)), header, summary]
+    for player, move in turns:
+        data.append(TURN.pack(player, len(move)))
+        data.append(move)
+    return b''.join(data)
+
+
+def decodegames(data, summaries=True):
+    '''Return the list of the (header, turns, summary) of the games encoded one after the other in 'data'.
+    Pre: 'summaries' is False for the games of blocks written without summary, which get b''.
+    '''
+    games = []
+    offset = 0
+    while offset < len(data):
+        if summaries:
+            size, count, summarysize = GAME.unpack_from(data, offset)
+            offset += GAME.size
+        else:
+            (size, count), summarysize = GAME_NOSUMMARY.unpack_from(data, offset), 0
+            offset += GAME_NOSUMMARY.size
+        header = data[offset:offset + size]
+        offset += size
+        summary = data[offset:offset + summarysize]
+        offset += summarysize
+        turns = []
+        for i in range(count):
+            player, size = TURN.unpack_from(data, offset)
+            offset += TURN.size
+            turns.append((player, data[offset:offset + size]))
+            offset += size
+        games.append((header, turns, summary))
+    return games
+
+
+class ReplayWriter:
+    '''Class representing an append-only file of recorded games.
+
+    Games are kept in memory until 'batch' of them are waiting, then compressed
+    together with 'compression' ('zlib' or 'lzma') and appended to the file as
+    one block. Compression and writes happen in a background thread, so that
+    recording a game only costs the game loop the encoding of its moves. Each
+    block is also listed in the index file 'path' + '.idx'.
+    '''
+    def __init__(self, path, batch=32, compression='zlib'):
+        if compression not in CODECS:
+            raise ValueError('Unknown compression: {}'.format(compression))
+        self.__path = path
+        self.__batch = batch
+        self.__codec = CODECS[compression]
+        self.__pending = []
+        self.__lock = threading.Lock()
+        self.__blocks = []
+        self.__wakeup = threading.Condition(self.__lock)
+        self.__writing = False
+        self.__closed = False
+        self.__error = None
+        self.__thread = threading.Thread(target=self.__writeblocks, daemon=True)
+        self.__thread.start()
+
+    @property
+    def path(self):
+        return self.__path
+
+    def append(self, header, turns, summary=b''):
+        '''Record a game.
+        Pre: 'header' and 'summary' (how the game ended) are bytes and 'turns' a list
+             of (player, move) with 'move' bytes.
+        Post: The game will be written with the next block.
+        '''
+        game = encodegame(header, turns, summary)
+        with self.__lock:
+            if self.__closed:
+                raise ValueError('The replay file is closed')
+            self.__pending.append(game)
+            if len(self.__pending) >= self.__batch:
+                self.__blocks.append(self.__pending)
+                self.__pending = []
+                self.__wakeup.notify_all()
+
+    def flush(self):
+        '''Write the games waiting in memory, and wait until every block is written.'''
+        with self.__lock:
+            if len(self.__pending) > 0:
+                self.__blocks.append(self.__pending)
+                self.__pending = []
+                self.__wakeup.notify_all()
+            while len(self.__blocks) > 0 or self.__writing:
+                self.__wakeup.wait()
+            error, self.__error = self.__error, None
+        if error is not None:
+            raise error
+
+    def close(self):
+        self.flush()
+        with self.__lock:
+            self.__closed = True
+            self.__wakeup.notify_all()
+        self.__thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __writeblocks(self):
+        while True:
+            with self.__lock:
+                while len(self.__blocks) == 0 and not self.__closed:
+                    self.__wakeup.wait()
+                if len(self.__blocks) == 0:
+                    return
+                games = self.__blocks.pop(0)
+                self.__writing = True
+            try:
+                self.__writeblock(games)
+            except OSError as e:
+                # Reported to the next flush, the games of the block are lost
+                self.__error = e
+            with self.__lock:
+                self.__writing = False
+                self.__wakeup.notify_all()
+
+    def __writeblock(self, games):
+        raw = b''.join(games)
+        data = _compress(self.__codec, raw)
+        with open(self.__path, 'ab') as file:
+            offset = file.tell()
+            file.write(BLOCK.pack(MAGIC, self.__codec, len(games), len(raw), len(data)))
+            file.write(data)
+        with open(self.__path + '.idx', 'ab') as file:
+            file.write(INDEX.pack(offset, len(games)))
+
+
+class ReplayReader:
+    '''Class representing a file of games recorded by ReplayWriter, read by game number.
+
+    The blocks are found through the index file when it matches the replay file,
+    and by reading the block headers otherwise. A block written partially, at the
+    end of the file, is ignored.
+    '''
+    def __init__(self, path):
+        self.__path = path
+        self.__offsets = []
+        # Number of games before each block
+        self.__firsts = []
+        self.__count = 0
+        self.__cached = (None, None)
+        size = os.path.getsize(path)
+        blocks = self.__readindex(size)
+        if blocks is None:
+            blocks = self.__scan(size)
+        for offset, games in blocks:
+            self.__offsets.append(offset)
+            self.__firsts.append(self.__count)
+            self.__count += games
+
+    def __readindex(self, size):
+        try:
+            with open(self.__path + '.idx', 'rb') as file:
+                data = file.read()
+        except OSError:
+            return None
+        blocks = [INDEX.unpack_from(data, i) for i in range(0, len(data) - INDEX.size + 1, INDEX.size)]
+        # The index must list every block of the file, the last one being complete
+        with open(self.__path, 'rb') as file:
+            if len(blocks) > 0:
+                file.seek(blocks[-1][0])
+                header = file.read(BLOCK.size)
+                if len(header) < BLOCK.size or header[:4] not in (MAGIC, MAGIC_NOSUMMARY) or blocks[-1][0] + BLOCK.size + BLOCK.unpack(header)[4] != size:
+                    return None
+            elif size > 0:
+                return None
+        return blocks
+
+    def __scan(self, size):
+        blocks = []
+        with open(self.__path, 'rb') as file:
+            offset = 0
+            while offset + BLOCK.size <= size:
+                file.seek(offset)
+                magic, codec, games, raw, compressed = BLOCK.unpack(file.read(BLOCK.size))
+                if magic not in (MAGIC, MAGIC_NOSUMMARY) or offset + BLOCK.size + compressed > size:
+                    break
+                blocks.append((offset, games))
+                offset += BLOCK.size + compressed
+        return blocks
+
+    def __len__(self):
+        return self.__count
+
+    def __getitem__(self, n):
+        '''Return the (header, turns, summary) of game number 'n', counted from 0.'''
+        if n < 0:
+            n += self.__count
+        if not 0 <= n < self.__count:
+            raise IndexError('No game {} in the replay file'.format(n))
+        block = bisect.bisect_right(self.__firsts, n) - 1
+        return self.__block(block)[n - self.__firsts[block]]
+
+    def __iter__(self):
+        for block in range(len(self.__offsets)):
+            yield from self.__block(block)
+
+    def __block(self, block):
+        # The last block read is kept, games being mostly read in order
+        if self.__cached[0] != block:
+            with open(self.__path, 'rb') as file:
+                file.seek(self.__offsets[block])
+                magic, codec, games, raw, compressed = BLOCK.unpack(file.read(BLOCK.size))
+                data = _decompress(codec, file.read(compressed))
+                self.__cached = (block, decodegames(data, magic == MAGIC))
+        return self.__cached[1]
@@ -0,0 +1,83 @@
+# transposition.py
+# Bounded transposition table for game tree searches, keyed by Zobrist hashes
+
+# Kinds of stored values
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+
+class TranspositionTable:
+    '''Class representing a bounded transposition table.
+
+    The table has a fixed number of buckets (a power of two), selected by the low
+    bits of the hash. Each bucket has two slots: the first one keeps the deepest
+    result of the current search, the second one always takes the latest result
+    that did not fit in the first. Results of previous searches (see newsearch)
+    are replaced first, so that one table can be shared by successive searches.
+    '''
+    def __init__(self, size=1 << 20):
+        buckets = 1
+        while 2 * buckets <= size // 2:
+            buckets *= 2
+        self.__mask = buckets - 1
+        # Parallel lists indexed by slot: 2 * bucket (depth-preferred) and 2 * bucket + 1
+        self.__keys = [None] * (2 * buckets)
+        self.__entries = [None] * (2 * buckets)
+        self.__ages = [0] * (2 * buckets)
+        self.__age = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def size(self):
+        return len(self.__keys)
+
+    def newsearch(self):
+        '''Mark all the stored results as coming from a previous search.'''
+        self.__age += 1
+
+    def clear(self):
+        '''Remove all the stored results and start again from the first search.'''
+        for i in range(len(self.__keys)):
+            self.__keys[i] = None
+            self.__entries[i] = None
+            self.__ages[i] = 0
+        self.__age = 0
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        '''Return the (depth, value, kind, move) stored for 'key', or None.'''
+        slot = 2 * (key & self.__mask)
+        if self.__keys[slot] == key:
+            self.hits += 1
+            return self.__entries[slot]
+        if self.__keys[slot + 1] == key:
+            self.hits += 1
+            return self.__entries[slot + 1]
+        self.misses += 1
+        return None
+
+    def put(self, key, depth, value, kind=EXACT, move=None):
+        '''Store the result of the search of a position.
+        Pre: 'key' is the hash of the position, 'depth' the depth searched from it
+             and 'kind' one of EXACT, LOWER and UPPER.
+        Post: The result has been stored, possibly replacing another one.
+        '''
+        keys, entries, ages = self.__keys, self.__entries, self.__ages
+        slot = 2 * (key & self.__mask)
+        entry = (depth, value, kind, move)
+        if keys[slot] == key or keys[slot] is None or ages[slot] != self.__age or entries[slot][0] <= depth:
+            # The evicted result still gets a chance in the always-replace slot
+            if keys[slot] is not None and keys[slot] != key:
+                keys[slot + 1], entries[slot + 1], ages[slot + 1] = keys[slot], entries[slot], ages[slot]
+            keys[slot], entries[slot], ages[slot] = key, entry, self.__age
+        else:
+            keys[slot + 1], entries[slot + 1], ages[slot + 1] = key, entry, self.__age
+
+    def __len__(self):
+        return sum(1 for key in self.__keys if key is not None)
+
+    def __contains__(self, key):
+        slot = 2 * (key & self.__mask)
+        return self.__keys[slot] == key or self.__keys[slot + 1] == key
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# mcts.py
+# Monte Carlo tree search client for the King & Assassins game
+
+import argparse
+import math
+import multiprocessing
+import os
+import socket
+import time
+
+from kingandassassins_Original import BitboardKingAndAssassinsState
+from search import SearchKingAndAssassinsClient, evaluate, terminalvalue
+
+# End of the turn, as an action of the search tree
+PASS = None
+
+
+class _Node:
+    '''Node of the search tree, where 'player' chooses the next action.'''
+    __slots__ = ('player', 'children', 'visits', 'value')
+
+    def __init__(self, player):
+        self.player = player
+        self.children = {}
+        self.visits = 0
+        # Sum of the rewards of the player who chose the action leading here
+        self.value = 0.0
+
+
+class _Simulation:
+    '''Class representing a game being simulated, action by action, from a client's view.'''
+    def __init__(self, state, player, card, assassins, cards):
+        self.state = state
+        state._data['hidden'] = {'assassins': None, 'cards': cards}
+        state.setassassins(assassins)
+        self.player = player
+        self.budgets, self.fetter = state._budgets(card)
+        self.last = None
+        self.turns = 0
+
+    def actions(self):
+        # Available (action, pool, cost, reverse) of the current player, PASS ending the turn
+        budgets = self.budgets
+        assassins = self.state._data['hidden']['assassins'] if self.player == 0 else None
+        actions = [a for a in self.state._actions(self.player, budgets, self.fetter, assassins)
+                   if a[2] <= budgets[a[1]] and a[0] != self.last]
+        actions.append((PASS, None, 0, None))
+        return actions
+
+    def play(self, action, pool, cost, reverse):
+        state = self.state
+        if action is PASS:
+            # The assassins' team ends the round and a new card is drawn
+            if self.player == 0:
+                state._drawcard(state._visible, state._data['hidden'])
+            self.player = 1 - self.player
+            self.budgets, self.fetter = state._budgets(state._visible['card'])
+            self.last = None
+            self.turns += 1
+        else:
+            state._playaction(action, self.player)
+            self.budgets[pool] -= cost
+            self.last = reverse
+        return state.winner()
+
+
+def turnstatistics(root):
+    '''Return the visits and value of the nodes of the first turn of a search tree.
+    Post: The returned dictionary maps each sequence of actions played from the root by
+          its player, the last one possibly PASS, to the list [visits, value].
+    '''
+    statistics = {}
+    nodes = [((), root)]
+    while len(nodes) > 0:
+        sequence, node = nodes.pop()
+        for action, child in node.children.items():
+            statistics[sequence + (action,)] = [child.visits, child.value]
+            if action is not PASS and child.player == root.player:
+                nodes.append((sequence + (action,), child))
+    return statistics
+
+
+def bestsequence(statistics):
+    '''Return the actions to play, following the most visited ones of turnstatistics() until PASS.'''
+    children = {}
+    for sequence in statistics:
+        children.setdefault(sequence[:-1], []).append(sequence)
+    actions = ()
+    while actions in children:
+        actions = max(children[actions], key=lambda sequence: statistics[sequence][0])
+        if actions[-1] is PASS:
+            return list(actions[:-1])
+    return list(actions)
+
+
+class MCTSKingAndAssassinsClient(SearchKingAndAssassinsClient):
+    '''Class representing a Monte Carlo tree search client for the King & Assassins game.
+
+    Each move is searched for 'budget' seconds of wall-clock time. The tree has one
+    edge per single action, plus PASS ending the turn, and every iteration plays on
+    a copy of the state with the bitboard engine. The hidden information is sampled
+    at each iteration: the order of the cards not seen yet and, for the king's side,
+    the assassins. Rollouts play random actions for 'horizon' turns, after which the
+    position is scored by evaluate().
+    '''
+    def __init__(self, name, server, verbose=False, budget=1.0, horizon=4, exploration=0.7, seed=None, latency=None,
+                 games=1):
+        self.budget = budget
+        self.horizon = horizon
+        self.exploration = exploration
+        self.lastsearch = None
+        self.__verbose = verbose
+        super().__init__(name, server, verbose=verbose, seed=seed, latency=latency, games=games)
+
+    def search(self, state):
+        '''Search the actions to play in 'state' for 'budget' seconds.
+        Pre: 'state' is a BitboardKingAndAssassinsState where this client has to play.
+        Post: The returned value is the list of actions to play. The number of
+              iterations and their rate are stored in 'lastsearch'.
+        '''
+        start = time.perf_counter()
+        root = self.searchtree(state, self.remainingcards(), self.budget)
+        elapsed = time.perf_counter() - start
+        self.lastsearch = {'iterations': root.visits, 'seconds': elapsed, 'ips': root.visits / elapsed}
+        if self.__verbose:
+            print('   MCTS: {} iterations in {:.2f}s ({:.0f} iterations/s)'.format(root.visits, elapsed, root.visits / elapsed))
+        return bestsequence(turnstatistics(root))
+
+    def searchtree(self, state, remaining, budget, assassins=None):
+        '''Return the root of the tree searched from 'state' for 'budget' seconds.
+        Pre: 'remaining' is the list of the cards not drawn yet and 'assassins' the hidden
+             assassins of every iteration, or None to sample them at each iteration.
+        '''
+        player = self._playernb
+        card = state._visible['card']
+        root = _Node(player)
+        deadline = time.perf_counter() + budget
+        while root.visits == 0 or time.perf_counter() < deadline:
+            cards = self._random.sample(remaining, len(remaining))
+            guess = self.sampleassassins(state) if assassins is None else assassins
+            self._iterate(root, _Simulation(state.copy(), player, card, guess, cards))
+        return root
+
+    def _iterate(self, root, simulation):
+        node = root
+        path = [root]
+        winner = -1
+        # Selection and expansion of one new node
+        while winner == -1:
+            actions = simulation.actions()
+            unexplored = [a for a in actions if a[0] not in node.children]
+            if len(unexplored) > 0:
+                action = self._random.choice(unexplored)
+            else:
+                action = self._select(node, actions)
+            winner = simulation.play(*action)
+            child = node.children.get(action[0])
+            if child is None:
+                child = node.children[action[0]] = _Node(simulation.player)
+                path.append(child)
+                break
+            node = child
+            path.append(node)
+        # Random rollout from the new node
+        turns = simulation.turns + self.horizon
+        while winner == -1 and simulation.turns < turns:
+            winner = simulation.play(*self._random.choice(simulation.actions()))
+        # Reward for the king's side
+        reward = evaluate(simulation.state) if winner == -1 else terminalvalue(winner)
+        for parent, child in zip(path, path[1:]):
+            child.visits += 1
+            child.value += reward if parent.player == 1 else 1 - reward
+        root.visits += 1
+
+    def _select(self, node, actions):
+        # UCB1 among the children whose action is available in this simulation
+        logn = math.log(node.visits + 1)
+        best, bestscore = None, -1
+        for action in actions:
+            child = node.children[action[0]]
+            score = child.value / child.visits + self.exploration * math.sqrt(logn / child.visits)
+            if score > bestscore:
+                best, bestscore = action, score
+        return best
+
+
+def _searchdeterminization(task):
+    # Search one determinization in a worker process and return the statistics of its first turn
+    visible, player, remaining, assassins, budget, horizon, exploration, seed = task
+    client = MCTSKingAndAssassinsClient('determinization', None, budget=budget, horizon=horizon,
+                                        exploration=exploration, seed=seed)
+    client._playernb = player
+    return turnstatistics(client.searchtree(BitboardKingAndAssassinsState(visible), remaining, budget, assassins))
+
+
+class DeterminizedMCTSKingAndAssassinsClient(MCTSKingAndAssassinsClient):
+    '''Class representing a MCTS client searching several determinizations in parallel.
+
+    Each move, 'determinizations' assignments of the hidden assassins (one per process
+    by default) are drawn, for the king's side from its belief (see belief.py), and
+    each is searched with MCTS by a pool of 'processes' worker processes, the order of
+    the cards still being sampled at each iteration. The visits of the sequences of
+    actions of the first turn are summed over the determinizations to choose the move,
+    within 'budget' seconds overall. The processes are stopped once the games on the
+    connection have ended, however they end; a client playing without server (see
+    GameServer.runlocal) must be closed instead.
+    '''
+    def __init__(self, name, server, verbose=False, budget=1.0, horizon=4, exploration=0.7, seed=None, latency=None,
+                 games=1, determinizations=None, processes=None):
+        self.processes = processes or os.cpu_count()
+        self.determinizations = determinizations or self.processes
+        self.__pool = None
+        self.__verbose = verbose
+        super().__init__(name, server, verbose=verbose, budget=budget, horizon=horizon, exploration=exploration,
+                         seed=seed, latency=latency, games=games)
+
+    def search(self, state):
+        '''Search the actions to play in 'state' on the pool of processes.
+        Pre: 'state' is a BitboardKingAndAssassinsState where this client has to play.
+        Post: The returned value is the list of actions to play. The number of
+              iterations, over all the determinizations, is stored in 'lastsearch'.
+        '''
+        if self.__pool is None:
+            self.__pool = multiprocessing.Pool(self.processes)
+        start = time.perf_counter()
+        # Determinizations that do not fit on the processes at once share the budget
+        rounds = math.ceil(self.determinizations / self.processes)
+        visible = state._state['visible']
+        remaining = self.remainingcards()
+        tasks = [(visible, self._playernb, remaining, self.sampleassassins(state), self.budget / rounds,
+                  self.horizon, self.exploration, self._random.getrandbits(32)) for i in range(self.determinizations)]
+        merged = {}
+        for statistics in self.__pool.imap_unordered(_searchdeterminization, tasks):
+            for sequence, (visits, value) in statistics.items():
+                total = merged.setdefault(sequence, [0, 0.0])
+                total[0] += visits
+                total[1] += value
+        elapsed = time.perf_counter() - start
+        iterations = sum(visits for sequence, (visits, value) in merged.items() if len(sequence) == 1)
+        self.lastsearch = {'iterations': iterations, 'seconds': elapsed, 'ips': iterations / elapsed,
+                           'determinizations': self.determinizations}
+        if self.__verbose:
+            print('   MCTS: {} determinizations, {} iterations in {:.2f}s'.format(self.determinizations, iterations, elapsed))
+        return bestsequence(merged)
+
+    def _gameloop(self):
+        try:
+            super()._gameloop()
+        finally:
+            self.close()
+
+    def close(self):
+        '''Stop the worker processes.'''
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='King & Assassins MCTS client')
+    parser.add_argument('name', help='name of the player')
+    parser.add_argument('--host', help='hostname of the server (default: localhost)',
+                        default=socket.gethostbyname(socket.gethostname()))
+    parser.add_argument('--port', help='port of the server (default: 5000)', default=5000)
+    parser.add_argument('--budget', type=float, help='seconds per move (default: 1)', default=1.0)
+    parser.add_argument('--determinizations', type=int, help='search this many determinizations in parallel')
+    parser.add_argument('-j', '--processes', type=int, help='processes searching the determinizations (default: all cores)')
+    parser.add_argument('--games', type=int, help='games to play on the connection, 0 for no limit (default: 1)', default=1)
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if args.processes is None and args.determinizations is None:
+        MCTSKingAndAssassinsClient(args.name, (args.host, int(args.port)), verbose=args.verbose, budget=args.budget,
+                                   games=args.games or None)
+    else:
+        DeterminizedMCTSKingAndAssassinsClient(
+            args.name, (args.host, int(args.port)), verbose=args.verbose, budget=args.budget, games=args.games or None,
+            determinizations=args.determinizations, processes=args.processes)
@@ -0,0 +1,164 @@
+# search.py
+# Common parts of the King & Assassins search clients (see mcts.py and expectimax.py)
+
+import random
+from abc import abstractmethod
+from collections import Counter
+
+import assassinchoice
+import deck
+import kingandassassins_Original as kingandassassins
+from belief import AssassinBelief
+from kingandassassins_Original import CARDS, PATHS, POPULATION, BitboardKingAndAssassinsState
+
+# Moves to a door counted for a king that cannot reach any
+FAR = 20
+
+
+def evaluate(state):
+    '''Return the estimated probability that the king's side wins from a state.
+    Pre: 'state' is a BitboardKingAndAssassinsState with its hidden assassins set.
+    Post: The returned value is between 0 and 1.
+    '''
+    visible = state._visible
+    king = state._king.bit_length() - 1
+    # Moves of the king to the nearest cell in front of a castle door, the door cells
+    # themselves being roofs it cannot enter
+    steps = [PATHS['king']['steps'][100 * king + 10 * x + y] for x, y, d in visible['castle']]
+    distance = min((n for n in steps if n is not None), default=FAR)
+    value = 0.9 - 0.04 * distance
+    if visible['king'] == 'injured':
+        value -= 0.2
+    value += 0.05 * (visible['killed']['assassins'] + state._caught)
+    # Assassins, revealed or not, that could attack the king next turn
+    assassins = state._data['hidden']['assassins'] or ()
+    for d, neighbours in BitboardKingAndAssassinsState.NEIGHBOURS.items():
+        cell = neighbours[king]
+        if cell >= 0 and (state._assassins >> cell & 1 or state._names.get(cell) in assassins):
+            value -= 0.1
+    return min(1.0, max(0.0, value))
+
+
+def terminalvalue(winner):
+    '''Return the value of a finished game for the king's side.'''
+    return 0.5 if winner is None else float(winner)
+
+
+class SearchKingAndAssassinsClient(kingandassassins.KingAndAssassinsClient):
+    '''Class representing a King & Assassins client choosing its actions with a search.
+
+    The client picks its assassins, keeps track of the cards seen so far and hands
+    every other turn to search(), with the state converted to the bitboard engine. On
+    the king's side, 'belief' tracks the probabilities of the hidden assassins.
+    '''
+    def __init__(self, name, server, verbose=False, seed=None, latency=None, games=1):
+        self._random = random.Random(seed)
+        self._assassins = None
+        self.__seen = []
+        # Whether the next state is sent again after an invalid move, rather than a new turn
+        self.__resent = False
+        self.belief = AssassinBelief()
+        super().__init__(name, server, verbose=verbose, latency=latency, games=games)
+
+    def _newgame(self):
+        super()._newgame()
+        self._assassins = None
+        self.__seen = []
+        self.__resent = False
+        self.belief.reset()
+
+    def _handle(self, message):
+        if message.startswith('ERROR'):
+            self.__resent = True
+        super()._handle(message)
+
+    def _nextmove(self, state):
+        visible = state._state['visible']
+        # Every state but the ones sent again is a new turn, with a new card (possibly
+        # equal to the previous one, the deck having duplicates)
+        resent, self.__resent = self.__resent, False
+        if visible['card'] is None:
+            self._assassins = self.chooseassassins(state)
+            return {'assassins': self._assassins}
+        state = BitboardKingAndAssassinsState(visible)
+        if not resent:
+            self.__seen.append(tuple(visible['card']))
+            if self._playernb == 1:
+                self.belief.observe(state)
+        actions = self.search(state)
+        if self._playernb == 1:
+            # The villagers pushed by the knights must not count as moves of the assassins' side
+            after = state.copy()
+            for action in actions:
+                after._playaction(action, 1)
+            self.belief.played(after)
+        return {'actions': actions}
+
+    def chooseassassins(self, state):
+        '''Return the names of the three villagers chosen as assassins.
+
+        The best start cells found by assassinchoice.py are used when they have been
+        computed, random villagers otherwise.
+        '''
+        best = assassinchoice.besttriple(state)
+        if best is not None:
+            return best
+        visible = state._state['visible']
+        return self._random.sample(sorted(p for row in visible['people'] for p in row if p in POPULATION), 3)
+
+    @abstractmethod
+    def search(self, state):
+        '''Return the list of actions to play.
+        Pre: 'state' is a BitboardKingAndAssassinsState where this client has to play.
+        '''
+        ...
+
+    @property
+    def seencards(self):
+        return list(self.__seen)
+
+    def remainingcards(self):
+        '''Return the list of the cards not drawn yet.'''
+        remaining = Counter(CARDS)
+        remaining.subtract(self.__seen)
+        return list(remaining.elements())
+
+    def carddistribution(self, field, turns=1):
+        '''Return the distribution of a field of the next cards, given the cards seen (see deck.distribution).'''
+        return deck.distribution(self.__seen, field, turns)
+
+    def sampleassassins(self, state):
+        '''Return this player's assassins or, for the king's side, the hidden ones drawn from 'belief'.'''
+        if self._playernb == 0:
+            return self._assassins
+        return self.belief.sampleassassins(self._random)
+
+    def determinize(self, state, assassins, cards):
+        '''Return a copy of 'state' with the given hidden assassins and cards to draw.'''
+        state = state.copy()
+        state._data['hidden'] = {'assassins': None, 'cards': cards}
+        state.setassassins(assassins)
+        return state
+
+    def randomsequence(self, state, player, card, stop=0.1):
+        '''Play random actions of 'player' on 'state' with the action points of 'card'.
+        Pre: 'state' is a determinized state, which is modified.
+        Post: The returned value is the list of actions played. After each action,
+              the turn ends with probability 'stop' or when no action is left.
+        '''
+        budgets, fetter = state._budgets(card)
+        assassins = state._data['hidden']['assassins'] if player == 0 else None
+        actions = []
+        last = None
+        while len(actions) == 0 or self._random.random() >= stop:
+            choices = [c for c in state._actions(player, budgets, fetter, assassins)
+                       if c[2] <= budgets[c[1]] and c[0] != last]
+            if len(choices) == 0:
+                break
+            action, pool, cost, last = self._random.choice(choices)
+            state._playaction(action, player)
+            budgets[pool] -= cost
+            actions.append(action)
+            if state.winner() != -1:
+                break
+        return actions
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# tournament.py
+# Plays many King & Assassins games between two bots on all the cores of the machine
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import random
+
+import kingandassassins_Original as kingandassassins
+
+
+def loadclass(spec):
+    '''Return the class designated by a 'module:Class' specification.'''
+    module, name = spec.split(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def playgame(game):
+    '''Play one game in this process.
+    Pre: 'game' is a tuple (number, seed, players, stateclass) where 'players' contains the
+         'module:Class' specifications of two KingAndAssassinsClient subclasses, in playing
+         order, and 'stateclass' the one of the state engine.
+    Post: The returned dictionary describes the result of the game.
+    '''
+    number, seed, players, stateclass = game
+    # Bots drawing from the global random generator are reproducible too
+    random.seed(seed)
+    server = kingandassassins.KingAndAssassinsServer(stateclass=loadclass(stateclass), seed=seed)
+    clients = [loadclass(spec)(spec, None) for spec in players]
+    winner, turns, moves = server.runlocal(clients)
+    return {'game': number, 'seed': seed, 'players': list(players), 'winner': winner, 'turns': turns}
+
+
+def tournament(bots, games, seed=0, processes=None,
+               stateclass='kingandassassins_Original:BitboardKingAndAssassinsState'):
+    '''Play games between two bots on a pool of processes.
+    Pre: 'bots' contains two 'module:Class' specifications, 'games' > 0.
+    Post: The result of each game (see playgame) has been yielded as soon as it finished.
+          The bots swap sides every game and each game has its own seed, drawn from 'seed'.
+    '''
+    rng = random.Random(seed)
+    tasks = [(i, rng.getrandbits(32), tuple(bots) if i % 2 == 0 else tuple(reversed(bots)), stateclass)
+             for i in range(games)]
+    with multiprocessing.Pool(processes) as pool:
+        yield from pool.imap_unordered(playgame, tasks)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='King & Assassins tournament')
+    parser.add_argument('bots', nargs=2, help='bots as module:Class (KingAndAssassinsClient subclasses)')
+    parser.add_argument('-n', '--games', type=int, help='number of games (default: 100)', default=100)
+    parser.add_argument('--seed', type=int, help='seed of the tournament (default: 0)', default=0)
+    parser.add_argument('-j', '--processes', type=int, help='number of processes (default: all cores)')
+    parser.add_argument('--state', help='state engine as module:Class',
+                        default='kingandassassins_Original:BitboardKingAndAssassinsState')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print the result of each game')
+    args = parser.parse_args()
+
+    wins = [0, 0]
+    draws = 0
+    for result in tournament(args.bots, args.games, args.seed, args.processes, args.state):
+        if args.verbose:
+            print(json.dumps(result), flush=True)
+        if result['winner'] is None:
+            draws += 1
+        else:
+            # Bots swap sides every game
+            wins[result['winner'] if result['game'] % 2 == 0 else 1 - result['winner']] += 1
+    for i, bot in enumerate(args.bots):
+        print('Bot {} ({}): {} won'.format(i + 1, bot, wins[i]))
+    print('Draws: {}'.format(draws))